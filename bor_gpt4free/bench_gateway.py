@@ -0,0 +1,399 @@
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ==================================================================================
+# [DATA] WORKLOAD
+# ==================================================================================
+# Same instruction block AnalyzeGptCommand sends for every news item
+NEWS_TEMPLATE = """from NEWS title:
+{title}
+from NEWS content:
+{content}
+
+for markets: dow, audjpy, audusd, dxy, fed interest rate, dax, cac 40
+give: market sentiment , short summary
+return in json
+for each market in format:
+
+"markets": [
+{{
+   "magnitude": "", // classify from 1 min to 10 max
+   "market": "",
+   "sentiment": "Bearish or Bullish or Neutral",
+   "reason": "...",
+   "keywords": [],
+   "categories": []
+}}
+],
+"article_info": {{
+   "has_market_impact": false or true,
+   "title_headline": "",
+   "news_surprise_index": 0, // classify from 1 min to 10 max
+   "economy_impact": 0, // classify from 1 min to 10 max
+   "macro_keyword_heatmap": [],
+   "summary": ""
+}}"""
+
+QUESTION_PROMPTS = [
+    "Explain the theory of relativity in one sentence.",
+    "What is the distance between Earth and Mars?",
+    "Write a haiku about coding.",
+    "Convert 100 Celsius to Fahrenheit.",
+    "Who painted the Mona Lisa?",
+    "What is the capital of Australia?",
+    "Explain how a rainbow is formed.",
+    "Name three types of clouds.",
+    "What is the boiling point of nitrogen?",
+    "Who wrote Hamlet?",
+    "What is the square root of 144?",
+    "Define 'recursion' in programming.",
+    "What is the primary ingredient in hummus?",
+    "How many bones are in the human body?",
+    "What is the chemical symbol for Gold?",
+    "Explain the concept of inflation.",
+    "What year did the Titanic sink?",
+    "Write a random inspirational quote."
+]
+
+NEWS_WORDS = (
+    "fed rates inflation dollar yields treasury stocks dow dax cac tariffs china "
+    "jobs payrolls gdp growth recession ecb rba aussie yen oil gold earnings guidance "
+    "central bank policy hawkish dovish cut hike surprise data markets investors"
+).split()
+
+
+def make_news_item(rng, content_chars):
+    title = " ".join(rng.choice(NEWS_WORDS) for _ in range(rng.randint(6, 14))).capitalize()
+    size = rng.randint(*content_chars)
+    words = []
+    while sum(len(w) + 1 for w in words) < size:
+        words.append(rng.choice(NEWS_WORDS))
+    return {"title": title, "content": " ".join(words)[:size]}
+
+
+def make_news_prompt(rng, content_chars):
+    return NEWS_TEMPLATE.format(**make_news_item(rng, content_chars))
+
+
+def make_payload(rng, workload, content_chars, use_template=False):
+    """Request body without the cache flag; use_template sends news items as the gateway's news_analysis template."""
+    if workload == "questions" or (workload == "mixed" and rng.random() < 0.2):
+        return {"question": rng.choice(QUESTION_PROMPTS)}
+    if use_template:
+        return {"template": "news_analysis", "variables": make_news_item(rng, content_chars), "response_format": None}
+    return {"question": make_news_prompt(rng, content_chars)}
+
+# ==================================================================================
+# [CORE] CLIENT
+# ==================================================================================
+def parse_server_timing(header):
+    """Returns {name: seconds} from a Server-Timing header."""
+    timings = {}
+    for part in (header or "").split(","):
+        fields = [f.strip() for f in part.split(";")]
+        if not fields[0]:
+            continue
+        for f in fields[1:]:
+            if f.startswith("dur="):
+                try:
+                    timings[fields[0]] = float(f[4:]) / 1000.0
+                except ValueError:
+                    pass
+    return timings
+
+
+def classify_answer(payload):
+    """Maps an /api/ask-gpt 200 payload to an outcome class."""
+    if not payload:
+        return "quota_dropped"
+    answer = payload.get("answer") or ""
+    if payload.get("status") == "error":
+        return "server_error"
+    if not answer.startswith("Error"):
+        return "success"
+    text = answer.lower()
+    if "upstream circuit open" in text:
+        # Refused before going upstream, the class in brackets is why the breaker is open
+        return "locked"
+    if "rate limit" in text or "429" in text:
+        return "429"
+    if "406" in text or "invalid response" in text:
+        return "406"
+    if "503" in text:
+        return "503"
+    if "content" in text:
+        return "content_failure"
+    if "locked" in text or "cooling down" in text:
+        return "locked"
+    if "request processing failed" in text:
+        return "timeout"
+    return "upstream_error"
+
+
+def send_request(url, payload, timeout, use_cache=True):
+    if not use_cache:
+        payload = dict(payload, cache=False)
+    body = json.dumps(payload).encode("utf-8")
+    # The gateway cancels the request once we stop waiting, rather than spending quota on it
+    headers = {"Content-Type": "application/json", "X-Request-Timeout": str(timeout)}
+    req = urllib.request.Request(url, data=body, headers=headers)
+    started = time.perf_counter()
+    result = {"request_bytes": len(body), "upstream": None}
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            raw = resp.read()
+            result["status"] = resp.status
+            result["upstream"] = parse_server_timing(resp.headers.get("Server-Timing")).get("upstream")
+        payload = json.loads(raw or b"{}")
+        result["outcome"] = classify_answer(payload)
+        result["answer_chars"] = len(payload.get("answer") or "")
+        result["backend"] = payload.get("backend")
+    except urllib.error.HTTPError as e:
+        result["status"] = e.code
+        result["outcome"] = "deadline_exceeded" if e.code == 504 else f"http_{e.code}"
+        if e.code in (429, 503):
+            # Gateway admission control: {"error": "quota" | "rate" | "client_quota" | "locked", "retry_after": s}
+            try:
+                error = json.loads(e.read() or b"{}").get("error")
+            except ValueError:
+                error = None
+            if error:
+                result["outcome"] = "locked" if error == "locked" else "quota_dropped"
+                result["retry_after"] = e.headers.get("Retry-After")
+    except (TimeoutError, urllib.error.URLError) as e:
+        reason = getattr(e, "reason", e)
+        result["status"] = 0
+        result["outcome"] = "client_timeout" if isinstance(reason, TimeoutError) or "timed out" in str(reason) else "connection_error"
+    result["latency"] = time.perf_counter() - started
+    return result
+
+# ==================================================================================
+# [CORE] REPORT
+# ==================================================================================
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, math.ceil(pct / 100.0 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def summarize(samples):
+    ok = [s for s in samples if s["outcome"] == "success"]
+    return {
+        "count": len(samples),
+        "p50": percentile([s["latency"] for s in samples], 50),
+        "p95": percentile([s["latency"] for s in samples], 95),
+        "p99": percentile([s["latency"] for s in samples], 99),
+        "success_p50": percentile([s["latency"] for s in ok], 50),
+        "success_p95": percentile([s["latency"] for s in ok], 95),
+        "success_p99": percentile([s["latency"] for s in ok], 99),
+    }
+
+
+def build_report(config, samples, wall_time):
+    outcomes, backends = {}, {}
+    for s in samples:
+        outcomes[s["outcome"]] = outcomes.get(s["outcome"], 0) + 1
+        if s.get("backend"):
+            backends[s["backend"]] = backends.get(s["backend"], 0) + 1
+
+    timed = [s for s in samples if s["upstream"] is not None]
+    overhead = [max(0.0, s["latency"] - s["upstream"]) for s in timed]
+    successes = outcomes.get("success", 0)
+
+    return {
+        "config": config,
+        "wall_time": wall_time,
+        "requests": len(samples),
+        "throughput_rps": len(samples) / wall_time if wall_time else 0.0,
+        "success_rps": successes / wall_time if wall_time else 0.0,
+        "outcomes": outcomes,
+        "backends": backends,
+        "latency": summarize(samples),
+        "upstream": {
+            "samples": len(timed),
+            "p50": percentile([s["upstream"] for s in timed], 50),
+            "p95": percentile([s["upstream"] for s in timed], 95),
+            "p99": percentile([s["upstream"] for s in timed], 99),
+        },
+        "gateway_overhead": {
+            "mean": sum(overhead) / len(overhead) if overhead else None,
+            "p50": percentile(overhead, 50),
+            "p95": percentile(overhead, 95),
+            "p99": percentile(overhead, 99),
+        },
+    }
+
+# ==================================================================================
+# [CORE] RUNNER
+# ==================================================================================
+def run_benchmark(base_url="http://localhost:5000", requests=100, concurrency=8, rate=0.0,
+                  duration=0.0, workload="news", content_chars=(300, 3000), timeout=330,
+                  seed=0, use_cache=True, use_template=False, stop_event=None):
+    """
+    Drives /api/ask-gpt and returns the report dict.
+
+    rate=0 is a closed loop: `concurrency` workers send back to back.
+    rate>0 is an open loop: Poisson arrivals at `rate` req/s, at most
+    `concurrency` in flight. Stops after `requests` or `duration` seconds,
+    whichever comes first (0 disables that limit).
+    """
+    url = base_url.rstrip("/") + "/api/ask-gpt"
+    rng = random.Random(seed)
+    stop_event = stop_event or threading.Event()
+    samples, samples_lock = [], threading.Lock()
+    slots = threading.Semaphore(concurrency)
+    config = {
+        "url": url, "requests": requests, "concurrency": concurrency, "rate": rate,
+        "duration": duration, "workload": workload, "content_chars": list(content_chars),
+        "timeout": timeout, "seed": seed, "use_cache": use_cache, "use_template": use_template,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+    def worker(payload):
+        try:
+            sample = send_request(url, payload, timeout, use_cache)
+            with samples_lock:
+                samples.append(sample)
+        finally:
+            slots.release()
+
+    started = time.perf_counter()
+    next_arrival = started
+    sent = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while not stop_event.is_set():
+            if requests and sent >= requests:
+                break
+            if duration and time.perf_counter() - started >= duration:
+                break
+            if rate > 0:
+                next_arrival += rng.expovariate(rate)
+                delay = next_arrival - time.perf_counter()
+                if delay > 0 and stop_event.wait(delay):
+                    break
+            if not slots.acquire(timeout=1.0):
+                next_arrival = max(next_arrival, time.perf_counter())
+                continue
+            pool.submit(worker, make_payload(rng, workload, content_chars, use_template))
+            sent += 1
+
+    return build_report(config, samples, time.perf_counter() - started)
+
+
+# ==================================================================================
+# [TEST] OPENAI-COMPATIBLE STUB
+# ==================================================================================
+# Stands in for a LAN llama.cpp / vLLM server when testing the gateway's router:
+#   python3 bench_gateway.py --openai-stub 8081 --stub-latency 2 --stub-error-rate 0.1
+#   GATEWAY_FALLBACKS='[{"name": "local", "base_url": "http://localhost:8081/v1"}]' python3 my-ai-webserver.py
+def make_openai_stub(latency=1.0, error_rate=0.0, seed=0, model="stub-openai"):
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _json(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/models"):
+                return self._json(200, {"object": "list", "data": [{"id": model, "object": "model"}]})
+            self._json(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                return self._json(404, {"error": {"message": "not found"}})
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            with lock:
+                fail = rng.random() < error_rate
+                delay = max(0.0, rng.gauss(latency, latency * 0.2))
+            time.sleep(delay)
+            if fail:
+                return self._json(503, {"error": {"message": "stub overloaded"}})
+            prompt = (request.get("messages") or [{}])[-1].get("content") or ""
+            text = f"[openai stub] {len(prompt)} chars received."
+            if "json" in prompt.lower():
+                text = json.dumps({"markets": [], "article_info": {"has_market_impact": False, "summary": text}})
+            if not request.get("stream"):
+                return self._json(200, {"object": "chat.completion", "model": model, "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}]})
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for start in range(0, len(text), 16):
+                chunk = {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": text[start:start + 16]}}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.close_connection = True
+
+    return Handler
+
+
+def serve_openai_stub(port, host="0.0.0.0", **options):
+    server = ThreadingHTTPServer((host, port), make_openai_stub(**options))
+    print(f"[STUB] OpenAI-compatible stub on http://{host}:{port}/v1", file=sys.stderr)
+    server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test for the /api/ask-gpt gateway")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("-n", "--requests", type=int, default=100)
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("-r", "--rate", type=float, default=0.0, help="arrivals per second, 0 = closed loop")
+    parser.add_argument("-d", "--duration", type=float, default=0.0, help="seconds, 0 = until --requests")
+    parser.add_argument("-w", "--workload", choices=["news", "questions", "mixed"], default="news")
+    parser.add_argument("--content-chars", type=int, nargs=2, default=[300, 3000], metavar=("MIN", "MAX"))
+    parser.add_argument("--timeout", type=float, default=330)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-cache", action="store_true", help="send \"cache\": false so every request goes upstream")
+    parser.add_argument("--template", action="store_true", help="send news items as template variables")
+    parser.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--openai-stub", type=int, metavar="PORT", help="serve an OpenAI-compatible stub instead")
+    parser.add_argument("--stub-latency", type=float, default=1.0)
+    parser.add_argument("--stub-error-rate", type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    if args.openai_stub:
+        serve_openai_stub(args.openai_stub, latency=args.stub_latency, error_rate=args.stub_error_rate, seed=args.seed)
+        return
+
+    report = run_benchmark(
+        base_url=args.url, requests=args.requests, concurrency=args.concurrency,
+        rate=args.rate, duration=args.duration, workload=args.workload,
+        content_chars=tuple(args.content_chars), timeout=args.timeout, seed=args.seed,
+        use_cache=not args.no_cache, use_template=args.template,
+    )
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+        print(f"[BENCH] Report saved to {args.output}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
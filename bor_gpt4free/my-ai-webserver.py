@@ -1,4 +1,5 @@
 import traceback
+import atexit
 import sys
 import os
 import asyncio
@@ -7,8 +8,39 @@ import time
 import datetime
 import logging
 import random
-from threading import Lock, Thread
-from flask import Flask, request, render_template_string, jsonify
+import math
+import heapq
+import bisect
+import itertools
+import contextvars
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+import hashlib
+import base64
+import re
+import zlib
+import uuid
+import sqlite3
+from array import array
+from collections import OrderedDict, deque
+from threading import Condition, Event, Lock, Thread
+from urllib.parse import parse_qs
+import argparse
+import urllib.error
+import urllib.request
+import jinja2
+from flask import Flask, Response, request
+
+try:
+    import uvicorn
+except ImportError:
+    # Only needed for --asgi
+    uvicorn = None
+
+try:
+    import numpy as np
+except ImportError:
+    # Optional, near-duplicate signatures fall back to pure Python
+    np = None
 
 # ==================================================================================
 # [SETUP] LOGGING SILENCER
@@ -36,89 +68,3121 @@ try:
     # Prevent the lib from trying to load browser cookies automatically
     gemini_webapi.utils.load_browser_cookies = lambda: {}
 except ImportError as e:
-    print(f"[CRITICAL] Import failed: {e}")
-    sys.exit(1)
+    # Only fatal for the gemini backend, the stub backend runs without it
+    GeminiClient = None
+    GEMINI_IMPORT_ERROR = e
 
 
-# 1. The filename to read from
+# 1. The filename to read from (browser export, Netscape format)
 INPUT_FILENAME = "gemini.google.com_cookies.txt"
 # 2. The filename to save to (for your main bot script)
 OUTPUT_FILENAME = "gemini_cookies.json"
 COOKIE_FILENAME = "gemini_cookies.json"
-# (Optional) I will create the file with your data so this script runs immediately for you.
-# If you already have the file locally, you can remove this block.
-raw_cookie_data = ""
-
-# Write the dummy file if it doesn't exist so the script below works
-if not os.path.exists(INPUT_FILENAME):
-    with open(INPUT_FILENAME, "w", encoding="utf-8") as f:
-        f.write(raw_cookie_data)
-    print(f"Created temporary file: {INPUT_FILENAME}")
 
 def convert_netscape_to_json():
+    """Refreshes OUTPUT_FILENAME from the browser export. Runs from startup(), never at import."""
+    if not os.path.exists(INPUT_FILENAME):
+        print(f"[SYS] No {INPUT_FILENAME}, keeping the existing {OUTPUT_FILENAME}")
+        return False
+
     print(f"Reading from {INPUT_FILENAME}...")
 
     cookies = {}
+    with open(INPUT_FILENAME, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            parts = line.strip().split('\t')
+            if len(parts) >= 7:
+                name = parts[5]
+                value = parts[6]
+                cookies[name] = value
+
+    if not cookies:
+        # An empty export would wipe working cookies
+        print(f"⚠️  No cookies in {INPUT_FILENAME}, keeping the existing {OUTPUT_FILENAME}")
+        return False
+
+    with open(OUTPUT_FILENAME, 'w') as f:
+        json.dump(cookies, f, indent=2)
+
+    print(f"✅ Success! Extracted {len(cookies)} cookies.")
+    print(f"📂 Saved to: {OUTPUT_FILENAME}")
+    return True
+
+# ==================================================================================
+# [CONFIG] BACKEND SELECTION
+# ==================================================================================
+# GATEWAY_BACKEND=gemini (default) talks to gemini.google.com
+# GATEWAY_BACKEND=stub answers locally, GATEWAY_STUB_CONFIG holds a JSON object
+# with StubBackend settings, e.g. '{"latency_mean": 2, "error_rates": {"429": 0.01}}'
+BACKEND_NAME = os.environ.get("GATEWAY_BACKEND", "gemini")
+STUB_CONFIG = json.loads(os.environ.get("GATEWAY_STUB_CONFIG", "{}") or "{}")
+# GATEWAY_FALLBACKS lists extra OpenAI-compatible endpoints the router may send
+# requests to, e.g. '[{"name": "lan-llama", "base_url": "http://10.0.0.5:8080/v1",
+# "model": "qwen2.5-7b-instruct", "hourly_budget": 600, "max_concurrency": 2}]'
+FALLBACK_CONFIG = json.loads(os.environ.get("GATEWAY_FALLBACKS", "[]") or "[]")
+
+# ==================================================================================
+# [CORE] METRICS
+# ==================================================================================
+# Prometheus text format, served on /metrics. Each metric holds its own lock
+# only for a dict update, and Callback metrics read their source at scrape
+# time, so the request path never waits on a scrape and vice versa.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120, 300)
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.lock = Lock()
+        self.values = {}  # label values tuple -> value
+
+    def samples(self):
+        """Yields (name suffix, label names, label values, value)."""
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in sorted(items):
+            yield "", self.labels, key, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(names, values)} {float(value)!r}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Callback(Metric):
+    """Read at scrape time: fn() returns a number, or {label values tuple: number}."""
+    def __init__(self, name, doc, fn, labels=(), kind="gauge"):
+        super().__init__(name, doc, labels)
+        self.fn = fn
+        self.kind = kind
+
+    def samples(self):
+        try:
+            value = self.fn()
+        except Exception as e:
+            # A broken source drops its own samples, not the whole scrape
+            print(f"[METRICS ERROR] {self.name}: {e}")
+            return
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for key, v in sorted(items):
+            yield "", self.labels, key, v
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self.lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        bounds = [f"{b:g}" for b in self.buckets] + ["+Inf"]
+        for key, counts, total in sorted(items):
+            running = 0
+            for bound, count in zip(bounds, counts):
+                running += count
+                yield "_bucket", self.labels + ("le",), key + (bound,), running
+            yield "_sum", self.labels, key, total
+            yield "_count", self.labels, key, running
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+REQUESTS_TOTAL = METRICS.add(Counter(
+    "gateway_requests_total", "HTTP requests by route and outcome class.", ("route", "outcome")))
+REQUEST_SECONDS = METRICS.add(Histogram(
+    "gateway_request_seconds", "End-to-end request latency, streams until the last chunk.", ("route",)))
+REQUESTS_IN_FLIGHT = METRICS.add(Gauge(
+    "gateway_requests_in_flight", "HTTP requests currently being handled."))
+UPSTREAM_SECONDS = METRICS.add(Histogram(
+    "gateway_upstream_seconds", "Latency of single upstream generation attempts.", ("backend",)))
+UPSTREAM_ERRORS_TOTAL = METRICS.add(Counter(
+    "gateway_upstream_errors_total", "Failed upstream attempts by error class, retries included.", ("backend", "kind")))
+QUEUE_WAIT_SECONDS = METRICS.add(Histogram(
+    "gateway_queue_wait_seconds", "Time spent waiting for a scheduler slot.", ("priority",)))
+BREAKER_TRIPS_TOTAL = METRICS.add(Counter(
+    "gateway_breaker_trips_total", "Times a circuit breaker opened, by error class.", ("kind",)))
+CHAT_RECYCLED_TOTAL = METRICS.add(Counter(
+    "gateway_chat_recycled_total", "Chat sessions retired, by task and reason.", ("task", "reason")))
+STRUCTURED_TOTAL = METRICS.add(Counter(
+    "gateway_structured_answers_total", "response_format answers: valid, repaired or invalid.", ("result",)))
+
+# ==================================================================================
+# [CORE] EVENT LOG
+# ==================================================================================
+# Structured JSON lines, one object per event. emit() only appends to an
+# in-memory queue; a background thread batches the writes, flushes once per
+# `flush_seconds` and rotates files by size. Prompts are logged as a hash
+# unless GATEWAY_LOG_PROMPTS=1.
+EVENTS_LOG = "gateway_events.log"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 3
+LOG_QUEUE_LIMIT = 10000
+LOG_FLUSH_SECONDS = 1.0
+LOG_FULL_PROMPTS = os.environ.get("GATEWAY_LOG_PROMPTS", "") == "1"
+
+
+class EventLog:
+    def __init__(self, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, queue_limit=LOG_QUEUE_LIMIT,
+                 flush_seconds=LOG_FLUSH_SECONDS, full_prompts=LOG_FULL_PROMPTS):
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue_limit = queue_limit
+        self.flush_seconds = flush_seconds
+        self.full_prompts = full_prompts
+        self.pending = deque()  # (path, record); deque appends/pops need no lock
+        self.dropped = 0
+        self.dropped_total = 0
+        self.write_lock = Lock()
+        self.start_lock = Lock()
+        self.wakeup = Event()
+        self.thread = None
+
+    def prompt_fields(self, prompt):
+        fields = {"prompt_sha256": hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16],
+                  "prompt_chars": len(prompt)}
+        if self.full_prompts:
+            fields["prompt"] = prompt
+        return fields
+
+    def emit(self, path, event, **fields):
+        """Never blocks: the record is queued, or dropped and counted when the queue is full."""
+        if len(self.pending) >= self.queue_limit:
+            self.dropped += 1
+            self.dropped_total += 1
+            return
+        record = {"ts": datetime.datetime.now().isoformat(timespec="milliseconds"), "event": event}
+        record.update(fields)
+        self.pending.append((path, record))
+        if self.thread is None:
+            self._start()
+        elif len(self.pending) >= self.queue_limit // 2:
+            # Error storm: flush early instead of waiting for the next tick
+            self.wakeup.set()
+
+    def _start(self):
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name="event-log", daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.flush_seconds)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self.write_lock:
+            batches = {}
+            while self.pending:
+                path, record = self.pending.popleft()
+                batches.setdefault(path, []).append(json.dumps(record, default=str) + "\n")
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                batches.setdefault(EVENTS_LOG, []).append(json.dumps({
+                    "ts": datetime.datetime.now().isoformat(timespec="milliseconds"),
+                    "event": "log_dropped", "count": dropped}) + "\n")
+
+            for path, lines in batches.items():
+                data = "".join(lines)
+                try:
+                    self._rotate(path, len(data.encode("utf-8")))
+                    with open(path, "a", encoding="utf-8") as f:
+                        f.write(data)
+                except OSError as e:
+                    print(f"[LOG ERROR] {path}: {e}")
+
+    def _rotate(self, path, incoming):
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if not size or size + incoming <= self.max_bytes:
+            return
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{path}.{n}"):
+                os.replace(f"{path}.{n}", f"{path}.{n + 1}")
+        if self.backups:
+            os.replace(path, f"{path}.1")
+        else:
+            os.remove(path)
+
+
+EVENT_LOG = EventLog()
+
+# ==================================================================================
+# [CORE] REQUEST TRACING
+# ==================================================================================
+# Every routed request gets a RequestTrace in a context variable; code along the
+# way records spans (admit, queue, cache, pacing, client_init, upstream,
+# retry_sleep, ...). The totals go out as Server-Timing, the last
+# DEBUG_RING_SIZE traces are kept for /debug/requests, and slow ones are
+# sampled into SLOW_REQUESTS_LOG through the event log writer.
+DEBUG_RING_SIZE = int(os.environ.get("GATEWAY_DEBUG_REQUESTS", "200"))
+SLOW_REQUEST_SECONDS = float(os.environ.get("GATEWAY_SLOW_SECONDS", "30"))
+SLOW_REQUEST_SAMPLE = float(os.environ.get("GATEWAY_SLOW_SAMPLE", "1.0"))
+SLOW_REQUESTS_LOG = "slow_requests.log"
+TRACE_MAX_SPANS = 64
+UNTRACED_ROUTES = ("/metrics", "/healthz", "/readyz", "/debug/requests", "/debug/requests/<req_id>")
+
+CURRENT_TRACE = contextvars.ContextVar("gateway_trace", default=None)
+
+
+class RequestTrace:
+    def __init__(self, method, path):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.ts = time.time()
+        self.started = time.perf_counter()
+        self.spans = []
+        self.dropped_spans = 0
+        self.attrs = {}
+
+    def add(self, name, start, end, **attrs):
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            self.dropped_spans += 1
+            return
+        entry = {"name": name, "start_ms": round((start - self.started) * 1000, 1),
+                 "dur_ms": round((end - start) * 1000, 1)}
+        if attrs:
+            entry.update(attrs)
+        self.spans.append(entry)
+
+    def totals(self):
+        totals = {}
+        for entry in self.spans:
+            totals[entry["name"]] = totals.get(entry["name"], 0.0) + entry["dur_ms"]
+        return totals
+
+    def server_timing(self, existing=""):
+        """Server-Timing value; entries a handler already set (e.g. upstream) are kept as they are."""
+        present = {part.split(";")[0].strip() for part in existing.split(",") if part.strip()}
+        parts = [existing] if existing else []
+        parts += [f"{name};dur={ms:.1f}" for name, ms in self.totals().items() if name not in present]
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(parts)
+
+    def summary(self, status, outcome):
+        return {
+            "id": self.id, "ts": datetime.datetime.fromtimestamp(self.ts).isoformat(timespec="milliseconds"),
+            "method": self.method, "route": self.path, "status": status, "outcome": outcome,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "breakdown_ms": {name: round(ms, 1) for name, ms in self.totals().items()},
+            "spans": list(self.spans), "dropped_spans": self.dropped_spans, **self.attrs,
+        }
+
+
+@contextmanager
+def span(name, **attrs):
+    """Times the block into the current request's trace; a no-op outside a request."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace = CURRENT_TRACE.get()
+        if trace is not None:
+            trace.add(name, started, time.perf_counter(), **attrs)
+
+
+def record_span(name, started, **attrs):
+    """Adds a span that began at perf_counter() value `started` and ends now."""
+    trace = CURRENT_TRACE.get()
+    if trace is not None:
+        trace.add(name, started, time.perf_counter(), **attrs)
+
+
+def current_request_id():
+    """X-Request-Id of the request being handled, None outside one."""
+    trace = CURRENT_TRACE.get()
+    return trace.id if trace is not None else None
+
+
+def trace_note(**attrs):
+    """Attaches fields (client, task, query ids, ...) to the current request's trace."""
+    trace = CURRENT_TRACE.get()
+    if trace is not None:
+        for key, value in attrs.items():
+            if key in ("queries", "backends"):
+                trace.attrs.setdefault(key, []).append(value)
+            else:
+                trace.attrs[key] = value
+
+
+class RequestLog:
+    """Ring buffer of finished request traces, plus sampling of slow ones to disk."""
+    def __init__(self, size=DEBUG_RING_SIZE, slow_seconds=SLOW_REQUEST_SECONDS, sample=SLOW_REQUEST_SAMPLE):
+        self.entries = deque(maxlen=size)
+        self.slow_seconds = slow_seconds
+        self.sample = sample
+        self.lock = Lock()
+        self.slow_total = 0
+
+    def record(self, trace, status, outcome):
+        entry = trace.summary(status, outcome)
+        with self.lock:
+            self.entries.append(entry)
+        if entry["total_ms"] >= self.slow_seconds * 1000 and random.random() < self.sample:
+            self.slow_total += 1
+            EVENT_LOG.emit(SLOW_REQUESTS_LOG, "slow_request", **entry)
+
+    def find(self, req_id):
+        with self.lock:
+            return next((e for e in self.entries if e["id"] == req_id), None)
+
+    def recent(self, limit=50, route=None, min_ms=0.0, outcome=None):
+        with self.lock:
+            entries = list(self.entries)
+        entries.reverse()
+        if route:
+            entries = [e for e in entries if e["route"] == route]
+        if outcome:
+            entries = [e for e in entries if e["outcome"] == outcome]
+        return [e for e in entries if e["total_ms"] >= min_ms][:limit]
+
+
+REQUEST_LOG = RequestLog()
+
+# ==================================================================================
+# [CORE] DEADLINES
+# ==================================================================================
+# Callers say how long they will wait: X-Request-Timeout (seconds from now, what
+# an HTTP client's own timeout is) or X-Request-Deadline (unix time). The tighter
+# one is kept as a monotonic instant in CURRENT_DEADLINE; instrument() cancels the
+# handler when it passes, which also takes it out of the scheduler queue and
+# refunds its quota reservation.
+TIMEOUT_HEADER = "X-Request-Timeout"
+DEADLINE_HEADER = "X-Request-Deadline"
+
+CURRENT_DEADLINE = contextvars.ContextVar("gateway_deadline", default=None)
+REQUESTS_ABANDONED_TOTAL = METRICS.add(Counter(
+    "gateway_requests_abandoned_total", "Requests whose work was cancelled before it finished.", ("reason",)))
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def request_deadline(req):
+    """Monotonic deadline from the request headers, or None when the caller sent neither."""
+    budgets = []
+    try:
+        budgets.append(float(req.header(TIMEOUT_HEADER)))
+    except (TypeError, ValueError):
+        pass
+    try:
+        budgets.append(float(req.header(DEADLINE_HEADER)) - time.time())
+    except (TypeError, ValueError):
+        pass
+    return time.monotonic() + min(budgets) if budgets else None
+
+
+def deadline_remaining():
+    deadline = CURRENT_DEADLINE.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+async def within_deadline(aw):
+    """Awaits aw, cancelling it and raising DeadlineExceeded once the current deadline passes."""
+    remaining = deadline_remaining()
+    if remaining is None:
+        return await aw
+    if remaining <= 0:
+        if asyncio.iscoroutine(aw):
+            aw.close()
+        raise DeadlineExceeded("Deadline passed before the work started")
+    try:
+        return await asyncio.wait_for(aw, remaining)
+    except asyncio.TimeoutError:
+        if deadline_remaining() > 0:
+            # A timeout of the work's own, not ours
+            raise
+        raise DeadlineExceeded(f"Deadline exceeded after {remaining:.1f}s") from None
+
+
+def deadline_response(req, error):
+    req.outcome = "deadline_exceeded"
+    REQUESTS_ABANDONED_TOTAL.inc("deadline")
+    return json_response({"status": "error", "error": "deadline_exceeded", "message": str(error)}, 504)
+
+# ==================================================================================
+# [CORE] BACKENDS
+# ==================================================================================
+class Backend:
+    """
+    Upstream used by GeminiManager.
+    create_client() returns an initialised client with start_chat(), and the chat
+    objects expose `await send_message(prompt)` returning an object with `.text`.
+    Backends with supports_streaming also offer `send_message_stream(prompt)`, an
+    async iterator of partial outputs carrying `.text` and `.text_delta`.
+    """
+    name = "base"
+    model = "default"
+    human_like_pacing = False
+    supports_streaming = False
+
+    async def create_client(self, cookie_file):
+        raise NotImplementedError
+
+    def identity(self):
+        return f"{self.name}:{self.model}"
+
+
+class GeminiBackend(Backend):
+    name = "gemini"
+    human_like_pacing = True
+    supports_streaming = True
+
+    USER_AGENTS = [
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36"
+    ]
+
+    def __init__(self, init_timeout=40):
+        self.init_timeout = init_timeout
+
+    async def create_client(self, cookie_file):
+        if GeminiClient is None:
+            raise RuntimeError(f"gemini_webapi import failed: {GEMINI_IMPORT_ERROR}")
+        if not os.path.exists(cookie_file):
+            print(f"[CRITICAL] Cookie file missing: {cookie_file}")
+            raise FileNotFoundError(f"Missing {cookie_file}")
+
+        with open(cookie_file, 'r') as f:
+            raw = json.load(f)
+
+        # Normalize to dict
+        cookies = {c['name']: c['value'] for c in raw if 'name' in c} if isinstance(raw, list) else raw
+
+        client = GeminiClient(
+            secure_1psid=cookies.get("__Secure-1PSID"),
+            secure_1psidts=cookies.get("__Secure-1PSIDTS")
+        )
+
+        if hasattr(client, "session"):
+            client.session.headers["User-Agent"] = random.choice(self.USER_AGENTS)
+            client.session.headers["Referer"] = "https://gemini.google.com/"
+            client.session.cookies.update(cookies)
+
+        for k, v in cookies.items():
+            client.cookies[k] = v
+
+        await client.init(timeout=self.init_timeout)
+        return client
+
+
+class ChatResponse:
+    def __init__(self, text, text_delta=""):
+        self.text = text
+        self.text_delta = text_delta
+
+
+class StubChat:
+    def __init__(self, backend, metadata=None):
+        self.backend = backend
+        # Resuming only restores the context size, which is all the latency model looks at
+        self.turns, self.context_chars = metadata or (0, 0)
+
+    @property
+    def metadata(self):
+        return [self.turns, self.context_chars]
+
+    async def send_message(self, prompt):
+        self.turns += 1
+        text = await self.backend.generate(prompt, self.context_chars)
+        self.context_chars += len(prompt) + len(text)
+        return ChatResponse(text)
+
+    async def send_message_stream(self, prompt):
+        self.turns += 1
+        text = ""
+        async for text, delta in self.backend.generate_stream(prompt, self.context_chars):
+            yield ChatResponse(text, delta)
+        self.context_chars += len(prompt) + len(text)
+
+
+class StubClient:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def start_chat(self, metadata=None, **kwargs):
+        return StubChat(self.backend, metadata)
+
+
+class StubBackend(Backend):
+    """
+    Local upstream for benchmarks and offline regression runs.
+    Latency, answer size and injected errors are drawn from a seeded RNG so the
+    same config and seed replays the same sequence of outcomes.
+
+    error_rates keys: 429, 406, 503, 500, content (failed to generate contents),
+    auth, timeout. A timeout hangs for `hang_seconds`, longer than any
+    generation timeout, so the manager's own wait_for fires.
+
+    Streaming spends `first_chunk_share` of the latency before the first of
+    `stream_chunks` chunks and spreads the rest evenly; stream_chunks=0 turns
+    streaming off.
+
+    context_slowdown adds that many seconds per 1k chars already in the chat,
+    modelling a conversation that gets slower as it grows.
+    """
+    name = "stub"
+
+    ERROR_MESSAGES = {
+        "429": "429 Too Many Requests",
+        "406": "406 Invalid response from upstream",
+        "503": "503 Service Unavailable",
+        "500": "500 Internal Server Error",
+        "content": "Failed to generate contents",
+        "auth": "auth session expired, login required",
+    }
+
+    def __init__(self, latency_dist="lognormal", latency_mean=1.0, latency_sigma=0.5,
+                 latency_min=0.0, latency_max=60.0, init_latency=0.0,
+                 answer_chars=(400, 1600), error_rates=None, hang_seconds=3600,
+                 seed=0, model="stub-1", human_like_pacing=False,
+                 stream_chunks=8, first_chunk_share=0.3, context_slowdown=0.0):
+        if latency_dist not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency_dist: {latency_dist}")
+        self.latency_dist = latency_dist
+        self.latency_mean = float(latency_mean)
+        self.latency_sigma = float(latency_sigma)
+        self.latency_min = float(latency_min)
+        self.latency_max = float(latency_max)
+        self.init_latency = float(init_latency)
+        self.answer_chars = tuple(answer_chars)
+        self.error_rates = {str(k): float(v) for k, v in (error_rates or {}).items()}
+        unknown = set(self.error_rates) - set(self.ERROR_MESSAGES) - {"timeout"}
+        if unknown:
+            raise ValueError(f"Unknown error classes: {sorted(unknown)}")
+        self.hang_seconds = float(hang_seconds)
+        self.model = model
+        self.human_like_pacing = human_like_pacing
+        self.stream_chunks = int(stream_chunks)
+        self.supports_streaming = self.stream_chunks > 0
+        self.first_chunk_share = float(first_chunk_share)
+        self.context_slowdown = float(context_slowdown)
+        self.rng = random.Random(seed)
+        self.calls = 0
+
+    async def create_client(self, cookie_file=None):
+        # As a fallback it is created without a cookie file, like the OpenAI backend
+        if self.init_latency:
+            await asyncio.sleep(self.init_latency)
+        return StubClient(self)
+
+    def _draw_latency(self, context_chars=0):
+        mean, sigma = self.latency_mean, self.latency_sigma
+        if self.latency_dist == "fixed":
+            value = mean
+        elif self.latency_dist == "uniform":
+            value = self.rng.uniform(mean - sigma, mean + sigma)
+        elif self.latency_dist == "normal":
+            value = self.rng.gauss(mean, sigma)
+        else:
+            # lognormal with the requested arithmetic mean, sigma is the shape parameter
+            value = mean * self.rng.lognormvariate(-(sigma ** 2) / 2, sigma)
+        value += self.context_slowdown * context_chars / 1000
+        return min(max(value, self.latency_min), self.latency_max)
+
+    def _draw_error(self):
+        roll = self.rng.random()
+        for error_class, rate in self.error_rates.items():
+            if roll < rate:
+                return error_class
+            roll -= rate
+        return None
+
+    def _make_answer(self, prompt):
+        tasks = re.findall(r"<<<TASK (\w+)>>>\n(.*?)\n<<<END TASK \1>>>", prompt, re.S)
+        if tasks:
+            return "\n".join(f"<<<ITEM {i}>>>\n{self._make_single_answer(p)}\n<<<END {i}>>>" for i, p in tasks)
+        return self._make_single_answer(prompt)
+
+    def _make_single_answer(self, prompt):
+        size = self.rng.randint(*self.answer_chars)
+        head = f"[stub #{self.calls}] {len(prompt)} chars received. "
+        filler = "lorem ipsum dolor sit amet " * (size // 27 + 1)
+        text = (head + filler)[:max(size, len(head))]
+        if "json" in prompt.lower():
+            return "```json\n" + json.dumps({"markets": [], "article_info": {"has_market_impact": False, "summary": text}}) + "\n```"
+        return text
+
+    async def generate(self, prompt, context_chars=0):
+        self.calls += 1
+        latency = self._draw_latency(context_chars)
+        error_class = self._draw_error()
+        answer = self._make_answer(prompt)
+
+        if error_class == "timeout":
+            await asyncio.sleep(self.hang_seconds)
+        await asyncio.sleep(latency)
+        if error_class:
+            raise Exception(self.ERROR_MESSAGES[error_class])
+        return answer
+
+    async def generate_stream(self, prompt, context_chars=0):
+        """Yields (text so far, delta) pairs."""
+        self.calls += 1
+        latency = self._draw_latency(context_chars)
+        error_class = self._draw_error()
+        answer = self._make_answer(prompt)
+
+        if error_class == "timeout":
+            await asyncio.sleep(self.hang_seconds)
+        await asyncio.sleep(latency * self.first_chunk_share)
+        if error_class:
+            raise Exception(self.ERROR_MESSAGES[error_class])
+
+        step = max(1, math.ceil(len(answer) / self.stream_chunks))
+        pause = latency * (1 - self.first_chunk_share) / self.stream_chunks
+        for start in range(0, len(answer), step):
+            if start:
+                await asyncio.sleep(pause)
+            yield answer[:start + step], answer[start:start + step]
+
+
+class OpenAIChat:
+    """Conversation kept on our side; the endpoint is stateless, so every turn sends the history."""
+    def __init__(self, client, history=None):
+        self.client = client
+        self.history = list(history or [])
+
+    @property
+    def metadata(self):
+        return list(self.history)
+
+    async def send_message(self, prompt):
+        messages = self.history + [{"role": "user", "content": prompt}]
+        text = await asyncio.to_thread(self.client.backend.complete, messages)
+        self.history = messages + [{"role": "assistant", "content": text}]
+        return ChatResponse(text)
+
+    async def send_message_stream(self, prompt):
+        messages = self.history + [{"role": "user", "content": prompt}]
+        text = ""
+        async for delta in self.client.backend.complete_stream(messages):
+            text += delta
+            yield ChatResponse(text, delta)
+        self.history = messages + [{"role": "assistant", "content": text}]
+
+
+class OpenAIClient:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def start_chat(self, metadata=None, **kwargs):
+        return OpenAIChat(self, metadata)
+
+
+class OpenAIBackend(Backend):
+    """
+    Any OpenAI-compatible /chat/completions endpoint (llama.cpp server, vLLM,
+    Ollama, ...). Calls go out with urllib on worker threads. HTTP errors are
+    raised as "<status> <reason>" and an unreachable host as a 503, so
+    upstream_error_kind() and the breaker treat them like the other backends.
+    """
+    def __init__(self, name="openai", base_url="http://localhost:8080/v1", model="default", api_key=None,
+                 timeout=120, stream=True, max_tokens=None, temperature=None):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.api_key = api_key
+        self.timeout = float(timeout)
+        self.supports_streaming = bool(stream)
+        self.options = {k: v for k, v in (("max_tokens", max_tokens), ("temperature", temperature)) if v is not None}
+
+    async def create_client(self, cookie_file=None):
+        return OpenAIClient(self)
+
+    def _open(self, messages, stream):
+        body = json.dumps({"model": self.model, "messages": messages, "stream": stream, **self.options})
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        req = urllib.request.Request(self.base_url + "/chat/completions", data=body.encode("utf-8"), headers=headers)
+        try:
+            return urllib.request.urlopen(req, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            detail = e.read(300).decode("utf-8", "replace")
+            raise Exception(f"{e.code} {e.reason}: {detail}") from None
+        except urllib.error.URLError as e:
+            raise Exception(f"503 {self.name} unreachable: {e.reason}") from None
+
+    def complete(self, messages):
+        with self._open(messages, False) as resp:
+            payload = json.loads(resp.read())
+        return payload["choices"][0]["message"].get("content") or ""
+
+    async def complete_stream(self, messages):
+        """Yields text deltas of a streamed completion; a reader thread parses the server-sent events."""
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        stop = Event()
+
+        def read():
+            try:
+                with self._open(messages, True) as resp:
+                    for raw in resp:
+                        if stop.is_set():
+                            return
+                        line = raw.decode("utf-8", "replace").strip()
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        choices = json.loads(data).get("choices") or [{}]
+                        delta = (choices[0].get("delta") or {}).get("content")
+                        if delta:
+                            loop.call_soon_threadsafe(chunks.put_nowait, delta)
+                loop.call_soon_threadsafe(chunks.put_nowait, None)
+            except Exception as e:
+                loop.call_soon_threadsafe(chunks.put_nowait, e)
+
+        loop.run_in_executor(None, read)
+        try:
+            while True:
+                item = await chunks.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Cancelled or done: the reader drops the connection at its next line
+            stop.set()
+
+
+def create_backend(kind=BACKEND_NAME, **config):
+    if kind == "stub":
+        return StubBackend(**(config or STUB_CONFIG))
+    if kind == "gemini":
+        return GeminiBackend(**config)
+    if kind == "openai":
+        return OpenAIBackend(**config)
+    raise ValueError(f"Unknown backend: {kind}")
+
+
+class Answer(str):
+    """Successful answer text, plus how it was produced (still usable as a plain str)."""
+    def __new__(cls, text, upstream_seconds=0.0, backend=None, cached=False, coalesced=False):
+        obj = super().__new__(cls, text)
+        obj.upstream_seconds = upstream_seconds
+        obj.backend = backend
+        obj.cached = cached
+        # True when this caller joined another caller's in-flight upstream request
+        obj.coalesced = coalesced
+        # (client, chat, chat metadata) right after this answer, to continue the conversation
+        obj.followup = None
+        # {"source_request", "similarity"} when reused from an earlier, near-identical article
+        obj.near_duplicate = None
+        return obj
+
+
+class Failure(str):
+    """Error text returned instead of an Answer; `kind` is its outcome class."""
+    def __new__(cls, text, kind="error"):
+        obj = super().__new__(cls, text)
+        obj.kind = kind
+        return obj
+
+
+def upstream_error_kind(error_str):
+    """Classifies a lowercased upstream exception message."""
+    if "429" in error_str or "too many requests" in error_str:
+        return "429"
+    if any(x in error_str for x in ["406", "invalid response"]):
+        return "406"
+    if any(x in error_str for x in ["auth", "login", "session"]):
+        return "auth"
+    if "failed to generate contents" in error_str:
+        return "content_failure"
+    if "503" in error_str:
+        return "503"
+    if "500" in error_str:
+        return "500"
+    return "error"
+
+
+def outcome_class(result):
+    """success, or the Failure kind."""
+    if isinstance(result, Failure):
+        return result.kind
+    if result.startswith("Error"):
+        return "error"
+    return "success"
+
+# ==================================================================================
+# [CORE] RESPONSE CACHE
+# ==================================================================================
+CACHE_FILENAME = "response_cache.sqlite3"
+CACHE_TTL_SECONDS = 7 * 24 * 3600
+CACHE_MEMORY_ENTRIES = 512
+CACHE_MEMORY_BYTES = 32 * 1024 * 1024
+CACHE_DISK_BYTES = 256 * 1024 * 1024
+CACHE_TOUCH_FLUSH_SECONDS = 30  # hits update accessed_at on disk in one batch this often
+
+def normalize_prompt(prompt):
+    return " ".join(prompt.split())
+
+def prompt_cache_key(prompt, identity):
+    return hashlib.sha256(f"{identity}\n{normalize_prompt(prompt)}".encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Content-addressed answer cache: bounded in-memory LRU in front of a SQLite
+    table that survives restarts. Entries expire after `ttl` seconds; both tiers
+    evict least recently used entries once over their size budget. A hit only
+    notes its time in memory; a background thread writes those to disk in
+    batches, so the hit path never waits for a commit.
+    """
+    def __init__(self, path=CACHE_FILENAME, ttl=CACHE_TTL_SECONDS,
+                 memory_entries=CACHE_MEMORY_ENTRIES, memory_bytes=CACHE_MEMORY_BYTES,
+                 disk_bytes=CACHE_DISK_BYTES):
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.lock = Lock()
+        self.memory = OrderedDict()  # key -> (answer, backend, created_at)
+        self.memory_size = 0
+        self.stats = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self.path = path
+        self.db = None  # memory only until open()
+        self.touched = {}  # key -> last hit time not yet written to accessed_at
+
+    def open(self):
+        with self.lock:
+            if self.path and self.db is None:
+                self.db = sqlite3.connect(self.path, check_same_thread=False)
+                self.db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    " key TEXT PRIMARY KEY, answer TEXT NOT NULL, backend TEXT,"
+                    " created_at REAL NOT NULL, accessed_at REAL NOT NULL, size INTEGER NOT NULL)"
+                )
+                self.db.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed_at)")
+                self.db.commit()
+                self.disk_size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                Thread(target=self._flush_loop, name="cache-touch", daemon=True).start()
+                atexit.register(self.flush_touched)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(CACHE_TOUCH_FLUSH_SECONDS)
+            self.flush_touched()
+
+    def flush_touched(self):
+        with self.lock:
+            if self.touched:
+                self._write_touched()
+                self.db.commit()
+
+    def _write_touched(self):
+        self.db.executemany("UPDATE responses SET accessed_at = ? WHERE key = ?",
+                            [(at, key) for key, at in self.touched.items()])
+        self.touched.clear()
+
+    def _remember(self, key, entry):
+        if key in self.memory:
+            self.memory_size -= len(self.memory.pop(key)[0])
+        self.memory[key] = entry
+        self.memory_size += len(entry[0])
+        while self.memory and (len(self.memory) > self.memory_entries or self.memory_size > self.memory_bytes):
+            _, old = self.memory.popitem(last=False)
+            self.memory_size -= len(old[0])
+
+    def _forget(self, key):
+        self.touched.pop(key, None)
+        if key in self.memory:
+            self.memory_size -= len(self.memory.pop(key)[0])
+        if self.db:
+            row = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if row:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.db.commit()
+                self.disk_size -= row[0]
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            tier = "memory"
+            if entry is None and self.db:
+                row = self.db.execute(
+                    "SELECT answer, backend, created_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row:
+                    entry, tier = tuple(row), "disk"
+
+            if entry is None or now - entry[2] > self.ttl:
+                if entry is not None:
+                    self._forget(key)
+                self.stats["misses"] += 1
+                return None
+
+            self.stats["hits"] += 1
+            self.stats[f"{tier}_hits"] += 1
+            self._remember(key, entry)
+            self.memory.move_to_end(key)
+            if self.db:
+                self.touched[key] = now
+            return entry[0], entry[1]
+
+    def put(self, key, answer, backend=None):
+        now = time.time()
+        size = len(answer)
+        with self.lock:
+            self.stats["stores"] += 1
+            self._remember(key, (answer, backend, now))
+            if not self.db:
+                return
+            row = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, answer, backend, created_at, accessed_at, size)"
+                " VALUES (?, ?, ?, ?, ?, ?)", (key, answer, backend, now, now, size)
+            )
+            self.touched.pop(key, None)
+            self.disk_size += size - (row[0] if row else 0)
+            if self.disk_size > self.disk_bytes:
+                self._evict_disk(now)
+            self.db.commit()
+
+    def _evict_disk(self, now):
+        # Least recently used is decided on disk, so pending hits have to be there first
+        self._write_touched()
+        cur = self.db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        self.stats["evictions"] += cur.rowcount
+        self.disk_size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        # Drop the least recently used rows until back under 90% of the budget
+        target = self.disk_bytes * 0.9
+        victims = []
+        for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            if self.disk_size <= target:
+                break
+            victims.append((key,))
+            self.disk_size -= size
+        self.db.executemany("DELETE FROM responses WHERE key = ?", victims)
+        self.stats["evictions"] += len(victims)
+
+    def dump_state(self):
+        """Keys of the memory tier, least recently used first."""
+        with self.lock:
+            return list(self.memory)
+
+    def load_state(self, keys):
+        """Reloads a saved memory tier from disk, so a restart doesn't begin with every hit on SQLite."""
+        now = time.time()
+        with self.lock:
+            if not self.db:
+                return
+            for key in keys:
+                row = self.db.execute(
+                    "SELECT answer, backend, created_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row and now - row[2] <= self.ttl:
+                    self._remember(key, tuple(row))
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(
+                self.stats,
+                hit_ratio=self.stats["hits"] / lookups if lookups else 0.0,
+                memory_entries=len(self.memory),
+                memory_bytes=self.memory_size,
+                disk_bytes=self.disk_size if self.db else 0,
+            )
+
+# ==================================================================================
+# [CORE] BATCH PACKING
+# ==================================================================================
+# Several prompts share one upstream generation. Each task is wrapped in TASK
+# markers and the model must answer inside matching ITEM markers, so the reply
+# can be split back per item and validated one by one.
+BATCH_MAX_ITEMS = 8
+BATCH_MAX_PROMPT_CHARS = 12000
+BATCH_RETRY_ROUNDS = 2
+
+BATCH_HEADER = (
+    "You will receive {count} independent tasks. Answer every task separately and completely.\n"
+    "Start each answer on its own line with <<<ITEM id>>> and end it with <<<END id>>>, "
+    "using the id of the task. Do not merge, reorder or skip tasks.\n"
+)
+BATCH_ANSWER_RE = re.compile(r"<<<ITEM\s+(\w+)>>>\s*(.*?)\s*<<<END\s+\1>>>", re.S)
+
+def pack_batches(items, max_items=BATCH_MAX_ITEMS, max_chars=BATCH_MAX_PROMPT_CHARS):
+    """Greedy packing of (id, prompt) pairs: short articles share a call, long ones travel alone."""
+    batches, current, size = [], [], 0
+    for item in items:
+        length = len(item[1])
+        if current and (len(current) >= max_items or size + length > max_chars):
+            batches.append(current)
+            current, size = [], 0
+        current.append(item)
+        size += length
+    if current:
+        batches.append(current)
+    return batches
+
+def build_batch_prompt(batch):
+    parts = [BATCH_HEADER.format(count=len(batch))]
+    for item_id, prompt in batch:
+        parts.append(f"<<<TASK {item_id}>>>\n{prompt.strip()}\n<<<END TASK {item_id}>>>")
+    return "\n\n".join(parts)
+
+def split_batch_answer(text):
+    return {item_id: answer for item_id, answer in BATCH_ANSWER_RE.findall(text)}
+
+def extract_json_block(text):
+    """Same rule the PHP callers use: first '{' to last '}'."""
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    try:
+        return json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+
+def validate_item_answer(prompt, answer):
+    if not answer or answer.startswith("Error"):
+        return False
+    if "json" in prompt.lower() and extract_json_block(answer) is None:
+        return False
+    return True
+
+# ==================================================================================
+# [CORE] STRUCTURED OUTPUT
+# ==================================================================================
+# Opt-in "response_format" on /api/ask-gpt: the gateway extracts the JSON from
+# the answer and checks it against a schema. A bad answer gets a short repair
+# turn in the same chat (the model still sees what it wrote) instead of a new
+# full-length generation, and the caller receives the parsed object.
+STRUCTURED_DEFAULT_REPAIRS = 1
+STRUCTURED_MAX_REPAIRS = 2
+
+# Shape requested by AnalyzeGptCommand / BecomeRichCommand / DebugGptController
+NEWS_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "required": ["markets", "article_info"],
+    "properties": {
+        "markets": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "required": ["market", "sentiment"],
+                "properties": {
+                    "magnitude": {"type": ["number", "string"]},
+                    "market": {"type": "string"},
+                    "sentiment": {"type": "string"},
+                    "reason": {"type": "string"},
+                    "keywords": {"type": "array"},
+                    "categories": {"type": "array"},
+                },
+            },
+        },
+        "article_info": {
+            "type": "object",
+            "required": ["has_market_impact", "summary"],
+            "properties": {
+                "has_market_impact": {"type": "boolean"},
+                "title_headline": {"type": "string"},
+                "news_surprise_index": {"type": ["number", "string"]},
+                "economy_impact": {"type": ["number", "string"]},
+                "macro_keyword_heatmap": {"type": "array"},
+                "summary": {"type": "string"},
+            },
+        },
+    },
+}
+RESPONSE_SCHEMAS = {"news_analysis": NEWS_ANALYSIS_SCHEMA}
+
+STRUCTURED_INSTRUCTION = "\n\nReturn only JSON, no commentary.{schema_hint}"
+REPAIR_PROMPT = (
+    "Your previous answer could not be used: {problems}.\n"
+    "Reply with only the corrected JSON, no explanations and no markdown.{schema_hint}{previous}"
+)
+JSON_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)```", re.S)
+JSON_TYPE_NAMES = {dict: "object", list: "array", str: "string", bool: "boolean", int: "integer",
+                   float: "number", type(None): "null"}
+
+
+class ResponseFormatError(ValueError):
+    pass
+
+
+def parse_response_format(spec):
+    """
+    Accepts "json", a schema name from RESPONSE_SCHEMAS, {"type": "json_object"}
+    or {"type": "json_schema", ...} with "name" or an inline "schema" (also the
+    OpenAI-style {"json_schema": {"schema": ...}}). Returns {"name", "schema", "max_repairs"}.
+    """
+    if isinstance(spec, str):
+        spec = {"type": "json_object"} if spec == "json" else {"type": "json_schema", "name": spec}
+    if not isinstance(spec, dict):
+        raise ResponseFormatError("response_format must be a string or an object")
+
+    kind = spec.get("type", "json_schema")
+    nested = spec.get("json_schema") if isinstance(spec.get("json_schema"), dict) else {}
+    name = spec.get("name") or nested.get("name")
+    schema = spec.get("schema") or nested.get("schema")
+    if kind == "json_object":
+        name, schema = "json_object", None
+    elif kind != "json_schema":
+        raise ResponseFormatError(f"Unknown response_format type: {kind}")
+    elif schema is None:
+        if name not in RESPONSE_SCHEMAS:
+            raise ResponseFormatError(f"Unknown schema: {name} (known: {', '.join(RESPONSE_SCHEMAS)})")
+        schema = RESPONSE_SCHEMAS[name]
+    elif not isinstance(schema, dict):
+        raise ResponseFormatError("schema must be a JSON object")
+
     try:
-        with open(INPUT_FILENAME, 'r', encoding='utf-8') as f:
-            for line in f:
-                if line.startswith('#') or not line.strip():
+        repairs = int(spec.get("max_repairs", STRUCTURED_DEFAULT_REPAIRS))
+    except (TypeError, ValueError):
+        raise ResponseFormatError("max_repairs must be an integer")
+    return {"name": name or "inline", "schema": schema,
+            "max_repairs": min(max(repairs, 0), STRUCTURED_MAX_REPAIRS)}
+
+def extract_json(text):
+    """Returns (value, error): fenced ```json blocks first, then the whole text, then the outermost braces."""
+    for candidate in JSON_FENCE_RE.findall(text) + [text]:
+        try:
+            return json.loads(candidate.strip()), None
+        except ValueError:
+            pass
+    error = "no JSON found"
+    for opening, closing in (("{", "}"), ("[", "]")):
+        start, end = text.find(opening), text.rfind(closing)
+        if start == -1 or end <= start:
+            continue
+        try:
+            return json.loads(text[start:end + 1]), None
+        except ValueError as e:
+            error = str(e)
+    return None, error
+
+def _json_type_ok(value, expected):
+    if expected == "integer":
+        return isinstance(value, int) and not isinstance(value, bool)
+    if expected == "number":
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    return JSON_TYPE_NAMES.get(type(value)) == expected
+
+def schema_errors(value, schema, path="$"):
+    """
+    The JSON Schema subset the gateway checks: type, enum, required, properties,
+    additionalProperties: false, items, minItems/maxItems, minimum/maximum, minLength.
+    Returns a list of human-readable problems (empty when valid).
+    """
+    expected = schema.get("type")
+    if expected:
+        expected = [expected] if isinstance(expected, str) else expected
+        if not any(_json_type_ok(value, t) for t in expected):
+            return [f"{path}: expected {' or '.join(expected)}, got {JSON_TYPE_NAMES.get(type(value), 'unknown')}"]
+
+    errors = []
+    if "enum" in schema and value not in schema["enum"]:
+        errors.append(f"{path}: must be one of {json.dumps(schema['enum'])}")
+    if isinstance(value, dict):
+        properties = schema.get("properties", {})
+        errors += [f"{path}: missing required property '{key}'" for key in schema.get("required", []) if key not in value]
+        for key, sub_schema in properties.items():
+            if key in value:
+                errors += schema_errors(value[key], sub_schema, f"{path}.{key}")
+        if schema.get("additionalProperties") is False:
+            errors += [f"{path}: unexpected property '{key}'" for key in value if key not in properties]
+    elif isinstance(value, list):
+        if len(value) < schema.get("minItems", 0):
+            errors.append(f"{path}: needs at least {schema['minItems']} items")
+        if "maxItems" in schema and len(value) > schema["maxItems"]:
+            errors.append(f"{path}: allows at most {schema['maxItems']} items")
+        if "items" in schema:
+            for index, item in enumerate(value):
+                errors += schema_errors(item, schema["items"], f"{path}[{index}]")
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        if "minimum" in schema and value < schema["minimum"]:
+            errors.append(f"{path}: must be >= {schema['minimum']}")
+        if "maximum" in schema and value > schema["maximum"]:
+            errors.append(f"{path}: must be <= {schema['maximum']}")
+    elif isinstance(value, str) and len(value) < schema.get("minLength", 0):
+        errors.append(f"{path}: must be at least {schema['minLength']} characters")
+    return errors
+
+def check_structured(text, response_format):
+    """Returns (parsed value, problems)."""
+    value, error = extract_json(text)
+    if error:
+        return None, [f"not valid JSON ({error})"]
+    if response_format["schema"] is None:
+        return value, [] if isinstance(value, dict) else ["expected a JSON object"]
+    return value, schema_errors(value, response_format["schema"])
+
+def _schema_hint(response_format):
+    if response_format["schema"] is None:
+        return ""
+    return "\nIt must match this JSON schema:\n" + json.dumps(response_format["schema"], separators=(",", ":"))
+
+def structured_prompt(prompt, response_format):
+    # Callers that already describe the JSON they want are sent unchanged
+    if "json" in prompt.lower():
+        return prompt
+    instruction = STRUCTURED_INSTRUCTION.format(schema_hint=_schema_hint(response_format))
+    if isinstance(prompt, TemplatePrompt):
+        return TemplatePrompt(prompt.rstrip() + instruction, prompt.template, prompt.turn.rstrip() + instruction)
+    return prompt.rstrip() + instruction
+
+def build_repair_prompt(problems, response_format, previous=None):
+    """`previous` is only needed when the repair cannot continue the original chat."""
+    listed = "; ".join(problems[:8]) + (f" (and {len(problems) - 8} more)" if len(problems) > 8 else "")
+    return REPAIR_PROMPT.format(
+        problems=listed,
+        schema_hint=_schema_hint(response_format),
+        previous=f"\n\nYour previous answer was:\n{previous}" if previous is not None else "",
+    )
+
+def response_format_fingerprint(response_format):
+    return "[response_format] " + json.dumps(response_format["schema"] or response_format["name"], sort_keys=True)
+
+def structured_cache_key(prompt, response_format, identity):
+    return prompt_cache_key(f"{prompt}\n{response_format_fingerprint(response_format)}", identity)
+
+# ==================================================================================
+# [CORE] PROMPT TEMPLATES
+# ==================================================================================
+# {"template": name, "variables": {...}} on /api/ask-gpt and /api/jobs. A pooled
+# chat gets the full instructions once; later turns in the same chat only carry
+# the variables plus a one-line reminder. A fresh or recycled chat is primed
+# again simply by sending it the full prompt on its first turn.
+NEWS_INSTRUCTIONS = """for markets: dow, audjpy, audusd, dxy, fed interest rate, dax, cac 40
+give: market sentiment , short summary
+return in json
+for each market in format:
+
+"markets": [
+{
+   "magnitude": "", // classify from 1 min to 10 max
+   "market": "",
+   "sentiment": "Bearish or Bullish or Neutral",
+   "reason": "...",
+   "keywords": [],
+   "categories": []
+}
+],
+"article_info": {
+   "has_market_impact": false or true,
+   "title_headline": "",
+   "news_surprise_index": 0, // classify from 1 min to 10 max
+   "economy_impact": 0, // classify from 1 min to 10 max
+   "macro_keyword_heatmap": [],
+   "summary": ""
+}"""
+
+PROMPT_TEMPLATES = {
+    "news_analysis": {
+        "task": "news",
+        "response_format": "news_analysis",
+        # First turn of a chat: same wording the PHP commands used to send every time
+        "full": "from NEWS title:\n{title}\nfrom NEWS content:\n{content}\n\n" + NEWS_INSTRUCTIONS,
+        # Later turns: the article and a reminder, the instructions are already in the chat
+        "turn": "Next article, same instructions and JSON format as before.\n"
+                "from NEWS title:\n{title}\nfrom NEWS content:\n{content}",
+    },
+}
+# Extra templates as JSON: {"name": {"full": "...{var}...", "turn": "...{var}...", "task": "...", "response_format": "..."}}
+PROMPT_TEMPLATES.update(json.loads(os.environ.get("GATEWAY_TEMPLATES", "{}") or "{}"))
+TEMPLATE_VAR_RE = re.compile(r"{(\w+)}")
+
+
+class TemplateError(ValueError):
+    pass
+
+
+class TemplatePrompt(str):
+    """Full prompt text (cache key, coalescing, one-shot chats) plus the short turn for primed chats."""
+    def __new__(cls, full, template, turn):
+        obj = super().__new__(cls, full)
+        obj.template = template
+        obj.turn = turn
+        return obj
+
+
+def template_variables(template):
+    return sorted(set(TEMPLATE_VAR_RE.findall(template["full"])) | set(TEMPLATE_VAR_RE.findall(template["turn"])))
+
+
+def render_template(name, variables):
+    template = PROMPT_TEMPLATES.get(name)
+    if template is None:
+        raise TemplateError(f"Unknown template: {name} (known: {', '.join(PROMPT_TEMPLATES)})")
+    if not isinstance(variables, dict):
+        raise TemplateError("variables must be an object")
+    missing = [v for v in template_variables(template) if v not in variables]
+    if missing:
+        raise TemplateError(f"Missing template variables: {', '.join(missing)}")
+    # Variables are substituted verbatim, braces in an article are not template syntax
+    fill = lambda text: TEMPLATE_VAR_RE.sub(lambda m: str(variables[m.group(1)]).strip(), text)
+    return TemplatePrompt(fill(template["full"]), name, fill(template["turn"]))
+
+# ==================================================================================
+# [CORE] NEAR-DUPLICATE INDEX
+# ==================================================================================
+# The same story arrives syndicated under another headline or with a trimmed body
+# and never matches the exact cache. The article part of a prompt is cut into word
+# shingles and reduced to a MinHash signature; LSH buckets over bands of that
+# signature find candidates without a scan, and the share of equal signature values
+# estimates the Jaccard similarity. At or above the threshold, with the same
+# instructions around the article, the answer stored for the earlier one is reused.
+NEAR_DUP_THRESHOLD = float(os.environ.get("GATEWAY_NEARDUP_THRESHOLD", "0.8"))  # above 1 turns it off
+NEAR_DUP_MAX_ENTRIES = int(os.environ.get("GATEWAY_NEARDUP_ENTRIES", "30000"))  # ~1KB each
+NEAR_DUP_MIN_WORDS = 50       # shorter texts: a few edited words swing the estimate too much
+NEAR_DUP_SHINGLE_WORDS = 5
+NEAR_DUP_PERMUTATIONS = 64   # all of them estimate the similarity
+NEAR_DUP_BANDS = 8            # 8 bands x 4 rows for LSH: a pair at 0.8 shares a bucket 98.5% of the time,
+NEAR_DUP_ROWS = 4             # at 0.9 99.98%, at 0.3 6%
+NEAR_DUP_SEED = 20240601      # fixed, signatures have to stay comparable across restarts
+MASK64 = (1 << 64) - 1
+NEWS_ARTICLE_RE = re.compile(
+    r"from NEWS title:\s*(?P<title>.*?)\s*from NEWS content:\s*(?P<content>.*?)\s*\n\n(?="
+    + re.escape(NEWS_INSTRUCTIONS.split("\n", 1)[0]) + ")", re.S)
+WORD_RE = re.compile(r"\w+")
+
+NEAR_DUPLICATES_TOTAL = METRICS.add(Counter(
+    "gateway_near_duplicates_total", "Near-duplicate lookups: hit, miss, or stale (answer left the cache).",
+    ("outcome",)))
+
+
+def article_section(prompt):
+    """(article text, prompt with the article cut out) for a news prompt, else None."""
+    match = NEWS_ARTICLE_RE.search(prompt)
+    if match is None:
+        return None
+    context = prompt[:match.start()] + "{article}" + prompt[match.end():]
+    return f"{match['title']}\n{match['content']}", normalize_prompt(context)
+
+
+def shingle_hashes(text):
+    """crc32 of every NEAR_DUP_SHINGLE_WORDS-word window, or None when the text is too short to compare."""
+    words = WORD_RE.findall(text.lower())
+    if len(words) < NEAR_DUP_MIN_WORDS:
+        return None
+    n = NEAR_DUP_SHINGLE_WORDS
+    return {zlib.crc32(" ".join(words[i:i + n]).encode("utf-8")) for i in range(len(words) - n + 1)}
+
+
+class NearDuplicateIndex:
+    """
+    MinHash signatures of indexed articles in LSH buckets. Holds only signatures
+    and cache keys (~1KB per article), the answers stay in the ResponseCache;
+    least recently used entries are dropped beyond `max_entries`.
+    """
+    def __init__(self, threshold=NEAR_DUP_THRESHOLD, max_entries=NEAR_DUP_MAX_ENTRIES,
+                 permutations=NEAR_DUP_PERMUTATIONS, bands=NEAR_DUP_BANDS, rows=NEAR_DUP_ROWS, seed=NEAR_DUP_SEED):
+        if bands * rows > permutations:
+            raise ValueError("bands x rows must not exceed permutations")
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.bands = bands
+        self.rows = rows
+        # Multiply-shift hash family: h(x) = ((a * x + b) mod 2^64) >> 32, with a odd
+        rng = random.Random(seed)
+        self.coeffs = [(rng.getrandbits(64) | 1, rng.getrandbits(64)) for _ in range(permutations)]
+        # Signatures are only comparable between indexes with the same hash family
+        self.family = hashlib.sha256(repr((seed, permutations)).encode()).hexdigest()[:16]
+        if np is not None:
+            self.np_a = np.array([a for a, _ in self.coeffs], dtype=np.uint64)[:, None]
+            self.np_b = np.array([b for _, b in self.coeffs], dtype=np.uint64)[:, None]
+        self.lock = Lock()
+        self.entries = OrderedDict()  # cache key -> (scope, signature, source request id, created_at)
+        self.buckets = {}  # band hash -> cache key, or a list of keys once several share the band
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "stores": 0, "evictions": 0}
+
+    @property
+    def enabled(self):
+        return self.threshold <= 1
+
+    def signature(self, hashes):
+        if np is not None:
+            x = np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+            # uint64 arithmetic wraps, which is the mod 2^64
+            return array("I", ((self.np_a * x + self.np_b) >> np.uint64(32)).min(axis=1).astype(np.uint32).tobytes())
+        return array("I", (min(((a * x + b) & MASK64) >> 32 for x in hashes) for a, b in self.coeffs))
+
+    def _band_keys(self, scope, sig):
+        rows = self.rows
+        return [hash((scope, band, sig[band * rows:(band + 1) * rows].tobytes())) for band in range(self.bands)]
+
+    def _prepare(self, prompt, scope):
+        """(scope, signature) for the prompt's article, or None when it has none worth comparing."""
+        if not self.enabled:
+            return None
+        section = article_section(prompt)
+        hashes = shingle_hashes(section[0]) if section else None
+        if not hashes:
+            return None
+        scope = sys.intern(hashlib.sha256(f"{scope}\n{section[1]}".encode("utf-8")).hexdigest()[:16])
+        return scope, self.signature(hashes)
+
+    def lookup(self, prompt, scope=""):
+        """(cache key, source request id, similarity) of the closest indexed article above the threshold."""
+        prepared = self._prepare(prompt, scope)
+        if prepared is None:
+            return None
+        scope, sig = prepared
+        best, best_similarity = None, 0.0
+        with self.lock:
+            seen = set()
+            for band_key in self._band_keys(scope, sig):
+                held = self.buckets.get(band_key)
+                for key in (held if isinstance(held, list) else (held,) if held else ()):
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    entry = self.entries[key]
+                    if entry[0] != scope:
+                        continue
+                    similarity = sum(x == y for x, y in zip(sig, entry[1])) / len(sig)
+                    if similarity > best_similarity:
+                        best, best_similarity = key, similarity
+            if best is None or best_similarity < self.threshold:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self.entries.move_to_end(best)
+            return best, self.entries[best][2], best_similarity
+
+    def add(self, prompt, key, scope="", source=None):
+        """Indexes the prompt's article; its answer is the one stored under `key` in the cache."""
+        prepared = self._prepare(prompt, scope)
+        if prepared is None:
+            return False
+        scope, sig = prepared
+        with self.lock:
+            self._insert(key, scope, sig, source, time.time())
+            self.stats["stores"] += 1
+            while len(self.entries) > self.max_entries:
+                self._drop(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+        return True
+
+    def _insert(self, key, scope, sig, source, created_at):
+        if key in self.entries:
+            self._drop(key)
+        self.entries[key] = (scope, sig, source, created_at)
+        for band_key in self._band_keys(scope, sig):
+            held = self.buckets.get(band_key)
+            if held is None:
+                self.buckets[band_key] = key
+            elif isinstance(held, list):
+                held.append(key)
+            else:
+                self.buckets[band_key] = [held, key]
+
+    def discard(self, key, stale=False):
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+                if stale:
+                    self.stats["stale"] += 1
+
+    def _drop(self, key):
+        scope, sig = self.entries.pop(key)[:2]
+        for band_key in self._band_keys(scope, sig):
+            held = self.buckets.get(band_key)
+            if isinstance(held, list):
+                held.remove(key)
+                if len(held) == 1:
+                    self.buckets[band_key] = held[0]
+            elif held == key:
+                del self.buckets[band_key]
+
+    def dump_state(self):
+        """Entries least recently used first; band keys use hash(), which differs per process, so they are rebuilt on load."""
+        with self.lock:
+            entries = list(self.entries.items())
+        return {"family": self.family, "entries": [
+            [key, scope, base64.b64encode(sig.tobytes()).decode("ascii"), source, created_at]
+            for key, (scope, sig, source, created_at) in entries]}
+
+    def load_state(self, state):
+        if state["family"] != self.family:
+            return
+        with self.lock:
+            for key, scope, sig, source, created_at in state["entries"][-self.max_entries:]:
+                self._insert(key, sys.intern(scope), array("I", base64.b64decode(sig)), source, created_at)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), max_entries=self.max_entries,
+                        buckets=len(self.buckets), threshold=self.threshold, enabled=self.enabled,
+                        numpy=np is not None)
+
+# ==================================================================================
+# [CORE] TRIAGE
+# ==================================================================================
+# Most articles come back with has_market_impact = false, each one after a full
+# upstream call. Every validated news_analysis answer is kept as a labelled example
+# (article text -> has_market_impact) and a Naive Bayes log-count-ratio model over
+# TF-IDF features is refitted from them in the background. Scoring is one matrix
+# product, hundreds of articles take milliseconds. The skip threshold comes from
+# cross-validated scores and keeps TRIAGE_TARGET_RECALL of the impactful articles.
+# Until there are enough examples (or without numpy) a keyword score only ranks.
+TRIAGE_FILENAME = "triage.sqlite3"
+TRIAGE_MAX_EXAMPLES = 3000
+TRIAGE_MIN_EXAMPLES = 100     # before the model is used, with TRIAGE_MIN_CLASS of each label
+TRIAGE_MIN_CLASS = 20
+TRIAGE_REFIT_EVERY = 25       # new examples between refits
+TRIAGE_VOCAB_SIZE = 4096
+TRIAGE_FOLDS = 5
+TRIAGE_CHUNK = 512            # examples vectorised at a time while fitting
+TRIAGE_SMOOTHING = 1.0
+TRIAGE_MAX_BATCH = 2000
+TRIAGE_TARGET_RECALL = float(os.environ.get("GATEWAY_TRIAGE_RECALL", "0.97"))
+TRIAGE_TOKEN_RE = re.compile(r"[a-z][a-z0-9]{2,}")
+TRIAGE_KEYWORDS_RE = re.compile(
+    r"\b(fed|fomc|rates?|hikes?|cuts?|inflation|cpi|ppi|gdp|payrolls|jobs|unemployment|tariffs?|yields?|"
+    r"treasur\w*|ecb|boj|rba|central bank|recession|stocks?|dollar|euro|yen|oil|earnings|sanctions|stimulus)\b")
+
+TRIAGE_TOTAL = METRICS.add(Counter(
+    "gateway_triage_total", "Articles scored by the local triage model, by verdict.", ("verdict",)))
+
+
+def triage_tokens(text):
+    return TRIAGE_TOKEN_RE.findall(text.lower())
+
+
+def keyword_score(text):
+    """Cold-start score in [0, 1) from macro/market keywords."""
+    return 1 - math.exp(-len(TRIAGE_KEYWORDS_RE.findall(text.lower())) / 4)
+
+
+def triage_matrix(docs, vocab, idf):
+    """L2-normalised sublinear TF-IDF rows for tokenised docs."""
+    index = [i * len(idf) + j for i, tokens in enumerate(docs) for j in map(vocab.get, tokens) if j is not None]
+    counts = np.bincount(np.array(index, dtype=np.int64), minlength=len(docs) * len(idf))
+    matrix = np.log1p(counts.reshape(len(docs), len(idf)).astype(np.float32)) * idf
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-9)
+
+
+class TriageModel:
+    """
+    Labelled examples in SQLite, the fitted model in memory. A refit runs on
+    its own thread and swaps self.model in one assignment, score() never waits.
+    """
+    def __init__(self, path=TRIAGE_FILENAME, target_recall=TRIAGE_TARGET_RECALL):
+        self.path = path
+        self.target_recall = target_recall
+        self.lock = Lock()
+        self.db = None  # opened by open(), startup() does that before serving
+        self.model = None
+        self.new_examples = 0
+        self.fitting = False
+
+    def open(self):
+        with self.lock:
+            if self.db is not None:
+                return
+            self.db = sqlite3.connect(self.path or ":memory:", check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS examples (key TEXT PRIMARY KEY, text TEXT NOT NULL,"
+                            " label INTEGER NOT NULL, created_at REAL NOT NULL)")
+            self.db.commit()
+        self.refit()
+
+    def observe(self, examples, wait=False):
+        """
+        Keeps labelled (article, impact) pairs, the newest TRIAGE_MAX_EXAMPLES.
+        Refits in the background every TRIAGE_REFIT_EVERY new ones, or right away with wait=True.
+        """
+        now = time.time()
+        rows = [(hashlib.sha256(normalize_prompt(article).encode("utf-8")).hexdigest(), article, int(bool(impact)), now)
+                for article, impact in examples]
+        with self.lock:
+            if self.db is None or not rows:
+                return
+            self.db.executemany("INSERT OR REPLACE INTO examples (key, text, label, created_at) VALUES (?, ?, ?, ?)", rows)
+            self.db.execute("DELETE FROM examples WHERE key NOT IN"
+                            " (SELECT key FROM examples ORDER BY created_at DESC LIMIT ?)", (TRIAGE_MAX_EXAMPLES,))
+            self.db.commit()
+            self.new_examples += len(rows)
+            due = wait or self.new_examples >= TRIAGE_REFIT_EVERY
+        if due:
+            self.refit(wait)
+
+    def refit(self, wait=False):
+        with self.lock:
+            if self.fitting or self.db is None or np is None:
+                return
+            self.fitting = True
+            self.new_examples = 0
+            rows = self.db.execute("SELECT text, label FROM examples ORDER BY key").fetchall()
+        if wait:
+            self._fit(rows)
+        else:
+            Thread(target=self._fit, args=(rows,), name="triage-fit", daemon=True).start()
+
+    def _fit(self, rows):
+        try:
+            labels = np.array([label for _, label in rows], dtype=np.int64)
+            positives = int(labels.sum())
+            if len(rows) < TRIAGE_MIN_EXAMPLES or min(positives, len(rows) - positives) < TRIAGE_MIN_CLASS:
+                return
+            started = time.perf_counter()
+            docs = [triage_tokens(text) for text, _ in rows]
+            df = {}
+            for tokens in docs:
+                for token in set(tokens):
+                    df[token] = df.get(token, 0) + 1
+            terms = [t for t, n in sorted(df.items(), key=lambda kv: (-kv[1], kv[0])) if n >= 2][:TRIAGE_VOCAB_SIZE]
+            vocab = {t: i for i, t in enumerate(terms)}
+            idf = (np.log((1 + len(docs)) / (1 + np.array([df[t] for t in terms], dtype=np.float32))) + 1)
+            folds = np.arange(len(docs)) % TRIAGE_FOLDS  # rows come sorted by content hash, i.e. shuffled
+
+            # Per fold and label feature sums: a fold's model is the totals minus its own share
+            sums = np.zeros((TRIAGE_FOLDS, 2, len(terms)))
+            counts = np.zeros((TRIAGE_FOLDS, 2))
+            for start in range(0, len(docs), TRIAGE_CHUNK):
+                matrix = triage_matrix(docs[start:start + TRIAGE_CHUNK], vocab, idf)
+                for fold in range(TRIAGE_FOLDS):
+                    for label in (0, 1):
+                        mask = (folds[start:start + TRIAGE_CHUNK] == fold) & (labels[start:start + TRIAGE_CHUNK] == label)
+                        sums[fold, label] += matrix[mask].sum(axis=0)
+                        counts[fold, label] += mask.sum()
+
+            def fit(s, c):
+                p, q = s[1] + TRIAGE_SMOOTHING, s[0] + TRIAGE_SMOOTHING
+                return np.log(p / p.sum()) - np.log(q / q.sum()), math.log(c[1] / c[0])
+
+            held_out = [fit(sums.sum(0) - sums[k], counts.sum(0) - counts[k]) for k in range(TRIAGE_FOLDS)]
+            weights = np.stack([w for w, _ in held_out], axis=1).astype(np.float32)
+            biases = np.array([b for _, b in held_out], dtype=np.float32)
+            scores = np.empty(len(docs), dtype=np.float32)
+            for start in range(0, len(docs), TRIAGE_CHUNK):
+                chunk = slice(start, start + TRIAGE_CHUNK)
+                by_fold = triage_matrix(docs[chunk], vocab, idf) @ weights + biases
+                scores[chunk] = by_fold[np.arange(len(by_fold)), folds[chunk]]
+
+            impactful, other = scores[labels == 1], scores[labels == 0]
+            threshold = float(np.quantile(impactful, 1 - self.target_recall))
+            w, b = fit(sums.sum(0), counts.sum(0))
+            self.model = {
+                "vocab": vocab, "idf": idf, "weights": w.astype(np.float32), "bias": b, "threshold": threshold,
+                "examples": len(docs), "impactful": positives, "fitted_at": time.time(),
+                "recall": float((impactful >= threshold).mean()), "skip_rate": float((other < threshold).mean()),
+            }
+            print(f"[TRIAGE] 🧮 Refit on {len(docs)} examples ({positives} with impact) in "
+                  f"{time.perf_counter() - started:.2f}s: would skip {self.model['skip_rate']:.0%} of the rest "
+                  f"at {self.model['recall']:.0%} recall")
+        except Exception as e:
+            print(f"[TRIAGE ERROR] {e}")
+        finally:
+            with self.lock:
+                self.fitting = False
+
+    def score(self, texts, min_score=None):
+        """
+        [(score, skip)] per article text; score in [0, 1] ranks by likely market
+        impact. Skips below the fitted threshold, or below min_score when given;
+        the keyword fallback never skips on its own.
+        """
+        model = self.model
+        if model is None:
+            scores = [keyword_score(text) for text in texts]
+            cut = min_score
+        else:
+            raw = triage_matrix([triage_tokens(text) for text in texts], model["vocab"], model["idf"]) \
+                @ model["weights"] + model["bias"]
+            scores = (1 / (1 + np.exp(-raw.astype(np.float64)))).tolist()
+            cut = min_score if min_score is not None else 1 / (1 + math.exp(-model["threshold"]))
+        verdicts = [(round(s, 4), cut is not None and s < cut) for s in scores]
+        for _, skip in verdicts:
+            TRIAGE_TOTAL.inc("skip" if skip else "pass")
+        return verdicts
+
+    def snapshot(self):
+        with self.lock:
+            stored = self.db.execute("SELECT COUNT(*), COALESCE(SUM(label), 0) FROM examples").fetchone() \
+                if self.db else (0, 0)
+        model = self.model
+        payload = {"model": "naive_bayes" if model else "keywords", "examples": stored[0],
+                   "examples_with_impact": stored[1], "target_recall": self.target_recall, "numpy": np is not None}
+        if model:
+            payload.update(
+                fitted_examples=model["examples"], fitted_with_impact=model["impactful"], vocabulary=len(model["vocab"]),
+                threshold=round(1 / (1 + math.exp(-model["threshold"])), 4),
+                recall=round(model["recall"], 3), skip_rate=round(model["skip_rate"], 3),
+                fitted_at=datetime.datetime.fromtimestamp(model["fitted_at"]).isoformat(timespec="seconds"))
+        return payload
+
+# ==================================================================================
+# [CORE] JOB QUEUE
+# ==================================================================================
+JOBS_FILENAME = "jobs.sqlite3"
+MAX_QUEUED_JOBS = 500
+JOB_RETENTION_SECONDS = 24 * 3600
+JOB_WORKERS = 2
+JOB_MAX_WAIT_SECONDS = 60
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobQueue:
+    """
+    Bounded FIFO of prompts persisted in SQLite, drained by a few worker threads.
+    `handler(job)` returns ("done" | "failed", text) to finish a job, or
+    ("queued", seconds) / None to leave it queued and retry it after `seconds`
+    (idle_retry by default), e.g. while the hourly quota is exhausted.
+    Finished jobs are kept for `retention` seconds.
+    """
+    def __init__(self, handler, path=JOBS_FILENAME, max_queued=MAX_QUEUED_JOBS,
+                 retention=JOB_RETENTION_SECONDS, workers=JOB_WORKERS, idle_retry=30):
+        self.handler = handler
+        self.max_queued = max_queued
+        self.retention = retention
+        self.workers = workers
+        self.idle_retry = idle_retry
+        self.lock = Lock()
+        self.changed = Condition(self.lock)
+        self.running = False
+        self.last_purge = 0
+        self.watchers = {}  # job id -> [(loop, future)] of long-poll requests
+        self.path = path
+        self.db = None  # opened by start()
+
+    def open(self):
+        with self.lock:
+            if self.db is not None:
+                return
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE NOT NULL, status TEXT NOT NULL,"
+                " prompt TEXT NOT NULL, options TEXT, result TEXT, created_at REAL NOT NULL,"
+                " started_at REAL, finished_at REAL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, seq)")
+            if "not_before" not in [row[1] for row in self.db.execute("PRAGMA table_info(jobs)")]:
+                self.db.execute("ALTER TABLE jobs ADD COLUMN not_before REAL")
+            # Jobs interrupted by a restart go back to the queue
+            self.db.execute("UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running'")
+            self.db.commit()
+
+    def start(self):
+        self.open()
+        if self.running:
+            return
+        self.running = True
+        for n in range(self.workers):
+            Thread(target=self._worker, name=f"job-worker-{n}", daemon=True).start()
+
+    def stop(self):
+        with self.changed:
+            self.running = False
+            self.changed.notify_all()
+
+    def submit(self, prompt, options=None):
+        with self.changed:
+            queued = self.db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFullError(f"Job queue full ({queued}/{self.max_queued})")
+            job_id = uuid.uuid4().hex
+            self.db.execute(
+                "INSERT INTO jobs (id, status, prompt, options, created_at) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, prompt, json.dumps(options or {}), time.time())
+            )
+            self.db.commit()
+            self.changed.notify_all()
+            return job_id, queued + 1
+
+    def get(self, job_id):
+        with self.lock:
+            return self._get(job_id)
+
+    def _get(self, job_id):
+        row = self.db.execute(
+            "SELECT seq, id, status, result, created_at, started_at, finished_at FROM jobs WHERE id = ?",
+            (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        seq, job_id, status, result, created_at, started_at, finished_at = row
+        job = {"job_id": job_id, "status": status, "created_at": created_at,
+               "started_at": started_at, "finished_at": finished_at}
+        if status == "queued":
+            job["position"] = self.db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND seq <= ?", (seq,)
+            ).fetchone()[0]
+        elif status == "done":
+            job["answer"] = result
+        elif status == "failed":
+            job["error"] = result
+        return job
+
+    async def wait(self, job_id, timeout):
+        """Long-poll: returns the job once finished or when `timeout` runs out, without holding a thread."""
+        loop = asyncio.get_running_loop()
+        finished = loop.create_future()
+        watcher = (loop, finished)
+        with self.lock:
+            job = self._get(job_id)
+            if job is None or job["status"] in ("done", "failed") or timeout <= 0:
+                return job
+            self.watchers.setdefault(job_id, []).append(watcher)
+        try:
+            await asyncio.wait_for(finished, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.lock:
+                waiting = self.watchers.get(job_id, [])
+                if watcher in waiting:
+                    waiting.remove(watcher)
+                if not waiting:
+                    self.watchers.pop(job_id, None)
+        return self.get(job_id)
+
+    def _notify_watchers(self, job_id):
+        for loop, finished in self.watchers.pop(job_id, []):
+            loop.call_soon_threadsafe(lambda f=finished: f.done() or f.set_result(None))
+
+    def depth(self):
+        with self.lock:
+            rows = self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+    def _claim(self):
+        """Oldest queued job that isn't backing off, or the seconds until one is (None if the queue is empty)."""
+        now = time.time()
+        row = self.db.execute(
+            "SELECT seq, id, prompt, options FROM jobs WHERE status = 'queued'"
+            " AND (not_before IS NULL OR not_before <= ?) ORDER BY seq LIMIT 1", (now,)
+        ).fetchone()
+        if row is None:
+            next_try = self.db.execute("SELECT MIN(not_before) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            return None if next_try is None else max(0.0, next_try - now)
+        self.db.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE seq = ?", (time.time(), row[0]))
+        self.db.commit()
+        return {"id": row[1], "prompt": row[2], "options": json.loads(row[3] or "{}")}
+
+    def _purge(self):
+        now = time.time()
+        if now - self.last_purge < 60:
+            return
+        self.last_purge = now
+        self.db.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (now - self.retention,)
+        )
+        self.db.commit()
+
+    def _worker(self):
+        while True:
+            with self.changed:
+                job = None
+                while self.running:
+                    self._purge()
+                    job = self._claim()
+                    if isinstance(job, dict):
+                        break
+                    self.changed.wait(self.idle_retry if job is None else min(self.idle_retry, job + 0.01))
+                if not self.running:
+                    return
+
+            try:
+                outcome = self.handler(job)
+            except Exception as e:
+                outcome = ("failed", f"Error: {e}")
+
+            with self.changed:
+                if outcome is None or outcome[0] == "queued":
+                    # Nothing can go upstream right now: the job waits out its backoff, and since no
+                    # worker can claim it before then there is nobody to wake
+                    delay = outcome[1] if outcome and outcome[1] else self.idle_retry
+                    self.db.execute("UPDATE jobs SET status = 'queued', started_at = NULL, not_before = ? WHERE id = ?",
+                                    (time.time() + delay, job["id"]))
+                    self.db.commit()
                     continue
-                parts = line.strip().split('\t')
-                if len(parts) >= 7:
-                    name = parts[5]
-                    value = parts[6]
-                    cookies[name] = value
-
-        with open(OUTPUT_FILENAME, 'w') as f:
-            json.dump(cookies, f, indent=2)
-
-        print(f"✅ Success! Extracted {len(cookies)} cookies.")
-        print(f"📂 Saved to: {OUTPUT_FILENAME}")
-
-    except FileNotFoundError:
-        print(f"❌ Error: File {INPUT_FILENAME} not found.")
-
-convert_netscape_to_json()
-
-# ==================================================================================
-# [DATA] TEST PROMPTS (For Stress Testing)
-# ==================================================================================
-TEST_PROMPTS = [
-    "Explain the theory of relativity in one sentence.",
-    "What is the distance between Earth and Mars?",
-    "Write a haiku about coding.",
-    "Convert 100 Celsius to Fahrenheit.",
-    "Who painted the Mona Lisa?",
-    "What is the capital of Australia?",
-    "Explain how a rainbow is formed.",
-    "Name three types of clouds.",
-    "What is the boiling point of nitrogen?",
-    "Who wrote Hamlet?",
-    "What is the square root of 144?",
-    "Define 'recursion' in programming.",
-    "What is the primary ingredient in hummus?",
-    "How many bones are in the human body?",
-    "What is the chemical symbol for Gold?",
-    "Explain the concept of inflation.",
-    "What year did the Titanic sink?",
-    "Write a random inspirational quote."
-]
+                self.db.execute(
+                    "UPDATE jobs SET status = ?, result = ?, finished_at = ? WHERE id = ?",
+                    (outcome[0], outcome[1], time.time(), job["id"])
+                )
+                self.db.commit()
+                self.changed.notify_all()
+                self._notify_watchers(job["id"])
 
 # ==================================================================================
-# [GLOBALS] SAFETY SWITCHES
+# [CORE] SCHEDULER
 # ==================================================================================
-HOURLY_429_LOCKOUT = False
+# Callers name themselves with X-Client-Id (or X-Api-Key when "api_keys" is set).
+# weight = share of both the upstream slots and the hourly budget,
+# priority = most urgent class the client may use. Unknown names run as "default".
+PRIORITY_CLASSES = ("interactive", "normal", "bulk")
+SCHEDULER_SLOTS = int(os.environ.get("GATEWAY_SLOTS", "2"))
+DEFAULT_CLIENTS = {
+    "dashboard": {"weight": 3, "priority": "interactive"},
+    "web": {"weight": 1, "priority": "interactive"},
+    "debug": {"weight": 1, "priority": "interactive"},
+    "become-rich": {"weight": 2, "priority": "normal"},
+    "analyzer": {"weight": 3, "priority": "bulk"},
+    "default": {"weight": 1, "priority": "normal"},
+}
+CLIENTS = json.loads(os.environ.get("GATEWAY_CLIENTS", "null") or "null") or DEFAULT_CLIENTS
+API_KEYS = json.loads(os.environ.get("GATEWAY_API_KEYS", "{}") or "{}")  # api key -> client name
+
+
+class FairScheduler:
+    """
+    Admission in front of GeminiManager: at most `slots` upstream calls run at
+    once. A free slot goes to the most urgent class with waiters; inside a class,
+    clients are served by weighted fair queuing (smallest virtual finish tag).
+
+    Also decides per-client shares of the hourly budget (usage comes from the
+    QuotaLimiter): each client is guaranteed budget * weight / total_weight
+    calls per hour and may borrow beyond that only while part of the unused
+    guarantee of every more urgent client (QUOTA_RESERVE_FRACTION) stays
+    covered, so idle interactive shares still leave most of the budget to bulk.
+    """
+    def __init__(self, clients=CLIENTS, slots=SCHEDULER_SLOTS):
+        self.clients = {name: dict(cfg) for name, cfg in clients.items()}
+        self.clients.setdefault("default", {"weight": 1, "priority": "normal"})
+        self.total_weight = sum(c.get("weight", 1) for c in self.clients.values())
+        self.lock = Lock()
+        self.free = slots
+        self.seq = itertools.count()
+        self.waiting = {p: [] for p in PRIORITY_CLASSES}
+        self.virtual_time = {p: 0.0 for p in PRIORITY_CLASSES}
+        self.last_finish = {}
+        self.stats = {p: {"dispatched": 0, "wait_total": 0.0, "wait_max": 0.0} for p in PRIORITY_CLASSES}
+
+    def resolve(self, client=None, api_key=None, priority=None):
+        """Maps request identity to (client, priority); a client may lower but not raise its class."""
+        name = API_KEYS.get(api_key) if api_key else None
+        name = name or client
+        if name not in self.clients:
+            name = "default"
+        allowed = self.clients[name].get("priority", "normal")
+        if priority not in PRIORITY_CLASSES or PRIORITY_CLASSES.index(priority) < PRIORITY_CLASSES.index(allowed):
+            priority = allowed
+        return name, priority
+
+    @asynccontextmanager
+    async def slot(self, client, priority):
+        await self.acquire(client, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, client, priority):
+        """Waits for a slot. Must run on the manager loop, which also does every release."""
+        weight = self.clients[client].get("weight", 1)
+        granted = asyncio.get_running_loop().create_future()
+        key = (priority, client)
+        with self.lock:
+            previous = self.last_finish.get(key)
+            start = max(self.virtual_time[priority], previous or 0.0)
+            tag = start + 1.0 / weight
+            self.last_finish[key] = tag
+            heapq.heappush(self.waiting[priority], (tag, next(self.seq), granted))
+            self._dispatch()
+        enqueued = time.monotonic()
+
+        try:
+            await granted
+        except asyncio.CancelledError:
+            # Cancelled entries are skipped by _dispatch; a slot granted in the meantime goes back
+            if granted.done() and not granted.cancelled():
+                self.release()
+            # The call never ran, so it must not count against the client's share
+            with self.lock:
+                if self.last_finish.get(key) == tag:
+                    if previous is None:
+                        del self.last_finish[key]
+                    else:
+                        self.last_finish[key] = previous
+                else:
+                    # Later calls of this client are already queued on top of it
+                    self.last_finish[key] = max(self.virtual_time[priority], self.last_finish[key] - 1.0 / weight)
+            raise
+
+        waited = time.monotonic() - enqueued
+        QUEUE_WAIT_SECONDS.observe(waited, priority)
+        record_span("queue", time.perf_counter() - waited, priority=priority)
+        with self.lock:
+            stats = self.stats[priority]
+            stats["dispatched"] += 1
+            stats["wait_total"] += waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+
+    def release(self):
+        with self.lock:
+            self.free += 1
+            self._dispatch()
+
+    def _dispatch(self):
+        for priority in PRIORITY_CLASSES:
+            queue = self.waiting[priority]
+            while queue and self.free > 0:
+                tag, _, granted = heapq.heappop(queue)
+                if granted.done():
+                    continue
+                self.virtual_time[priority] = tag
+                self.free -= 1
+                granted.set_result(None)
+
+    def share(self, client, budget):
+        return int(budget * self.clients[client].get("weight", 1) / self.total_weight)
+
+    def may_spend(self, client, budget, used_total, usage):
+        """usage: calls per client in the current window."""
+        if usage.get(client, 0) < self.share(client, budget):
+            return True
+        rank = PRIORITY_CLASSES.index(self.clients[client].get("priority", "normal"))
+        reserved = sum(
+            min(max(0, self.share(name, budget) - usage.get(name, 0)),
+                math.ceil(self.share(name, budget) * QUOTA_RESERVE_FRACTION))
+            for name, cfg in self.clients.items()
+            if name != client and PRIORITY_CLASSES.index(cfg.get("priority", "normal")) < rank
+        )
+        return budget - used_total - 1 >= reserved
+
+    def snapshot(self, budget, usage):
+        with self.lock:
+            classes = {}
+            for priority in PRIORITY_CLASSES:
+                stats = self.stats[priority]
+                classes[priority] = {
+                    "queued": len(self.waiting[priority]),
+                    "dispatched": stats["dispatched"],
+                    "wait_avg": stats["wait_total"] / stats["dispatched"] if stats["dispatched"] else 0.0,
+                    "wait_max": stats["wait_max"],
+                }
+            clients = {
+                name: {"priority": cfg.get("priority", "normal"), "weight": cfg.get("weight", 1),
+                       "share": self.share(name, budget), "used": usage.get(name, 0)}
+                for name, cfg in self.clients.items()
+            }
+            return {"free_slots": self.free, "classes": classes, "clients": clients}
+
+# ==================================================================================
+# [CORE] QUOTA LIMITER
+# ==================================================================================
+# At most `limit` upstream calls in any rolling hour, paced by a token bucket
+# that refills at limit/hour with up to `burst` calls saved up. There is no
+# reset at :00, so a backlog cannot burst out at the top of the hour. Less
+# urgent classes leave QUOTA_PRIORITY_RESERVE tokens in the bucket so an
+# interactive request is not refused just because bulk work drained it.
+QUOTA_FILENAME = "quota.sqlite3"
+QUOTA_WINDOW_SECONDS = 3600
+QUOTA_BURST = int(os.environ.get("GATEWAY_QUOTA_BURST", "5"))
+QUOTA_PRIORITY_RESERVE = {"interactive": 0, "normal": 1, "bulk": 1}
+QUOTA_RESERVE_FRACTION = 0.25
+QUOTA_FLUSH_SECONDS = 1.0   # writes reach quota.sqlite3 in batches at most this often
+QUOTA_MESSAGES = {
+    "locked": "Upstream circuit open after 429/503/repeated failures, retry later.",
+    "quota": "Hourly upstream budget used up.",
+    "rate": "Upstream calls are paced across the hour, next one is not available yet.",
+    "client_quota": "This client's share of the hourly budget is used up.",
+}
+
+
+class QuotaTicket:
+    """Outcome of QuotaLimiter.acquire(); an allowed ticket holds one reserved call until settled."""
+    def __init__(self, allowed, status=200, reason=None, retry_after=0, remaining=0, limit=0, event_id=None):
+        self.allowed = allowed
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+        self.remaining = remaining
+        self.limit = limit
+        self.event_id = event_id
+        self.settled = False
+        self.probe = False  # this call is the circuit breaker's half-open trial
+        # False when admitted only because a fallback backend can take the call
+        self.primary = allowed
+
+
+class QuotaLimiter:
+    """
+    Sliding-window + token-bucket limiter persisted in SQLite, so a restart
+    neither forgets the calls already made nor hands out a fresh budget.
+    acquire() checks and reserves in one step under one lock (no
+    check-then-increment race); settle() gives the reservation back when the
+    call did not end up spending upstream budget. Both only change memory and
+    queue their SQL; a writer thread commits it in batches, so admission never
+    waits for the disk (a crash loses at most QUOTA_FLUSH_SECONDS of calls).
+    """
+    def __init__(self, limit, window=QUOTA_WINDOW_SECONDS, burst=QUOTA_BURST, path=QUOTA_FILENAME):
+        self.limit = limit
+        self.window = window
+        self.burst = max(1, burst)
+        self.rate = limit / window  # tokens per second
+        self.lock = Lock()
+        self.events = deque()  # (ts, event id, client), oldest first
+        # Memory only until open() loads the saved window and bucket over these
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.ids = itertools.count(1)
+        self.path = path
+        self.db = None  # opened by open(), startup() does that before serving
+        self.pending = []  # (sql, params) not written yet
+        self.dirty = False  # tokens changed since the last write
+        self.db_lock = Lock()  # held by whoever writes, so batches commit in order
+        self.wakeup = Event()
+
+    def open(self):
+        with self.lock:
+            if self.db is not None:
+                return
+            self.db = sqlite3.connect(self.path or ":memory:", check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS quota_events (id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                            " ts REAL NOT NULL, client TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS quota_state (key TEXT PRIMARY KEY, value REAL NOT NULL)")
+            now = time.time()
+            self.db.execute("DELETE FROM quota_events WHERE ts <= ?", (now - self.window,))
+            self.db.commit()
+            self.events = deque(self.db.execute("SELECT ts, id, client FROM quota_events ORDER BY ts").fetchall())
+            state = dict(self.db.execute("SELECT key, value FROM quota_state").fetchall())
+            self.tokens = min(state.get("tokens", self.burst), self.burst)
+            self.updated = min(state.get("updated", now), now)
+            # Ids are handed out here, the rows follow in the next batch
+            self.ids = itertools.count(self.db.execute("SELECT COALESCE(MAX(id), 0) FROM quota_events").fetchone()[0] + 1)
+        Thread(target=self._writer, name="quota-writer", daemon=True).start()
+        atexit.register(self.flush)
+
+    def _writer(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            self.flush()
+            time.sleep(QUOTA_FLUSH_SECONDS)
+
+    def _queue(self, sql, params=()):
+        if self.db is None:
+            return
+        self.pending.append((sql, params))
+        self.wakeup.set()
+
+    def flush(self):
+        if self.db is None:
+            return
+        with self.db_lock:
+            with self.lock:
+                ops, self.pending = self.pending, []
+                if self.dirty:
+                    ops.append(("INSERT OR REPLACE INTO quota_state (key, value) VALUES (?, ?), (?, ?)",
+                                ("tokens", self.tokens, "updated", self.updated)))
+                    self.dirty = False
+            if ops:
+                for sql, params in ops:
+                    self.db.execute(sql, params)
+                self.db.commit()
+
+    def _advance(self, now):
+        expired = False
+        while self.events and self.events[0][0] <= now - self.window:
+            self.events.popleft()
+            expired = True
+        if expired:
+            self._queue("DELETE FROM quota_events WHERE ts <= ?", (now - self.window,))
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _save_tokens(self):
+        self.dirty = True
+        self.wakeup.set()
+
+    def _usage(self):
+        usage = {}
+        for _, _, client in self.events:
+            usage[client] = usage.get(client, 0) + 1
+        return usage
+
+    def _reject(self, status, reason, retry_after):
+        return QuotaTicket(False, status, reason, max(1, math.ceil(retry_after)),
+                           self.limit - len(self.events), self.limit)
+
+    def acquire(self, client="default", priority="normal", share_check=None):
+        """share_check(usage, used_total) -> bool adds the per-client policy."""
+        with self.lock:
+            now = time.time()
+            self._advance(now)
+            used = len(self.events)
+            if used >= self.limit:
+                return self._reject(429, "quota", self.events[0][0] + self.window - now)
+
+            needed = 1 + QUOTA_PRIORITY_RESERVE.get(priority, 0)
+            if self.tokens < needed:
+                return self._reject(429, "rate", (needed - self.tokens) / self.rate)
+
+            if share_check is not None and not share_check(self._usage(), used):
+                own = [ts for ts, _, name in self.events if name == client]
+                retry_after = (own[0] + self.window - now) if own else (1 / self.rate)
+                return self._reject(429, "client_quota", retry_after)
+
+            self.tokens -= 1
+            event_id = next(self.ids)
+            self._queue("INSERT INTO quota_events (id, ts, client) VALUES (?, ?, ?)", (event_id, now, client))
+            self.events.append((now, event_id, client))
+            self._save_tokens()
+            return QuotaTicket(True, remaining=self.limit - len(self.events), limit=self.limit, event_id=event_id)
+
+    def settle(self, ticket, spent):
+        """Keeps the reservation when the call spent upstream budget, otherwise refunds it. Only the first call counts."""
+        if not ticket.allowed or ticket.settled:
+            return
+        ticket.settled = True
+        if spent:
+            return
+        with self.lock:
+            for entry in self.events:
+                if entry[1] == ticket.event_id:
+                    self.events.remove(entry)
+                    break
+            else:
+                return
+            self._queue("DELETE FROM quota_events WHERE id = ?", (ticket.event_id,))
+            self._advance(time.time())
+            self.tokens = min(self.burst, self.tokens + 1)
+            self._save_tokens()
+
+    def usage(self):
+        with self.lock:
+            self._advance(time.time())
+            return self._usage()
+
+    def snapshot(self):
+        with self.lock:
+            self._advance(time.time())
+            return {
+                "limit": self.limit,
+                "used": len(self.events),
+                "remaining": self.limit - len(self.events),
+                "window_seconds": self.window,
+                "tokens": round(self.tokens, 2),
+                "burst": self.burst,
+                "seconds_per_call": round(1 / self.rate, 1),
+                "oldest_expires_in": round(self.events[0][0] + self.window - time.time(), 1) if self.events else 0,
+            }
+
+# ==================================================================================
+# [CORE] CIRCUIT BREAKER
+# ==================================================================================
+# Replaces the rest-of-the-hour lockout. Each upstream error class has its own
+# breaker: `threshold` consecutive failures open it for an exponentially growing,
+# jittered backoff (never shorter than an upstream retry hint). Once that runs
+# out it goes half-open and lets exactly one trial call through; only a success
+# closes it, a failed trial re-opens it with the next backoff.
+BREAKER_POLICIES = {
+    # error class: (consecutive failures to open, first backoff s, max backoff s)
+    "429": (1, 300, 3600),
+    "503": (1, 30, 1800),
+    "content_failure": (3, 120, 3600),
+    "500": (5, 15, 600),
+    "timeout": (3, 30, 900),
+}
+BREAKER_JITTER = 0.2          # backoff is scaled by a random factor in [1 - j, 1 + j]
+BREAKER_PROBE_WAIT = 5        # Retry-After while the half-open trial is in flight
+BREAKER_PROBE_TIMEOUT = 330   # a trial that never reports back is given up after this
+BREAKER_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+RETRY_HINT_RE = re.compile(r"retry[- _]?after\D{0,3}(\d+)", re.I)
+
+
+def retry_hint(error_str):
+    """Seconds from a 'Retry-After: N' style hint in an upstream error message, or None."""
+    match = RETRY_HINT_RE.search(error_str)
+    return int(match.group(1)) if match else None
+
+
+class CircuitBreaker:
+    def __init__(self, policies=BREAKER_POLICIES, jitter=BREAKER_JITTER, rng=None, name=None):
+        # name: set for a fallback backend's breaker, which stays out of the primary's metrics
+        self.name = name
+        self.tag = f"[BREAKER {name}]" if name else "[BREAKER]"
+        self.policies = policies
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+        self.lock = Lock()
+        self.breakers = {
+            kind: {"state": "closed", "failures": 0, "trips": 0, "open_until": 0.0, "last_error": None}
+            for kind in policies
+        }
+        self.probe_started = None  # set while the half-open trial call is out
+
+    def _refresh(self, now):
+        for kind, b in self.breakers.items():
+            if b["state"] == "open" and now >= b["open_until"]:
+                b["state"] = "half_open"
+                print(f"{self.tag} 🟡 {kind} half-open, next call is a trial")
+        if self.probe_started is not None and now - self.probe_started > BREAKER_PROBE_TIMEOUT:
+            self.probe_started = None
+
+    def _open(self, kind, now, hint=None):
+        b = self.breakers[kind]
+        _, base, cap = self.policies[kind]
+        b["trips"] += 1
+        delay = min(cap, base * 2 ** (b["trips"] - 1)) * self.rng.uniform(1 - self.jitter, 1 + self.jitter)
+        delay = min(cap, max(delay, hint or 0))
+        b.update(state="open", failures=0, open_until=now + delay)
+        if self.name is None:
+            BREAKER_TRIPS_TOTAL.inc(kind)
+        EVENT_LOG.emit(EVENTS_LOG, "breaker_open", backend=self.name, kind=kind, trips=b["trips"],
+                       seconds=round(delay, 1), hint=hint, error=b["last_error"])
+        print(f"{self.tag} 🛑 {kind} open for {int(delay)}s (trip {b['trips']})")
+
+    def admit(self):
+        """(retry_after, probe): retry_after > 0 while open; probe is True for the one half-open trial."""
+        now = time.time()
+        with self.lock:
+            self._refresh(now)
+            open_until = [b["open_until"] for b in self.breakers.values() if b["state"] == "open"]
+            if open_until:
+                return max(1, math.ceil(max(open_until) - now)), False
+            if any(b["state"] == "half_open" for b in self.breakers.values()):
+                if self.probe_started is not None:
+                    return BREAKER_PROBE_WAIT, False
+                self.probe_started = now
+                return 0, True
+            return 0, False
+
+    def open_for(self):
+        """(seconds, kinds) until every open breaker goes half-open; (0, []) when none is open."""
+        now = time.time()
+        with self.lock:
+            self._refresh(now)
+            kinds = [k for k, b in self.breakers.items() if b["state"] == "open"]
+            if not kinds:
+                return 0, []
+            return max(1, math.ceil(max(self.breakers[k]["open_until"] for k in kinds) - now)), kinds
+
+    def record_success(self):
+        with self.lock:
+            for kind, b in self.breakers.items():
+                if b["state"] != "closed":
+                    print(f"{self.tag} 🟢 {kind} closed after a successful trial")
+                    EVENT_LOG.emit(EVENTS_LOG, "breaker_closed", backend=self.name, kind=kind, trips=b["trips"])
+                b.update(state="closed", failures=0, trips=0)
+            self.probe_started = None
+
+    def record_failure(self, kind, error=None):
+        """Counts a failed upstream call; True when this failure opened a breaker."""
+        now = time.time()
+        hint = retry_hint(str(error or ""))
+        opened = False
+        if kind not in self.breakers:
+            # 406, auth, ...: says nothing about upstream health
+            return False
+        with self.lock:
+            self._refresh(now)
+            b = self.breakers[kind]
+            b["last_error"] = str(error)[:200] if error else kind
+            # A failed trial re-opens whatever was half-open, with the next backoff
+            if self.probe_started is not None:
+                for other, state in self.breakers.items():
+                    if state["state"] == "half_open":
+                        self._open(other, now, hint)
+                        opened = True
+                self.probe_started = None
+            if b["state"] == "open":
+                return opened
+            b["failures"] += 1
+            if b["failures"] >= self.policies[kind][0]:
+                self._open(kind, now, hint)
+                opened = True
+            return opened
+
+    def release_probe(self):
+        """The trial ended without an upstream verdict (cached, cancelled, ...): let the next call try."""
+        with self.lock:
+            self.probe_started = None
+
+    def failures(self, kind):
+        return self.breakers[kind]["failures"]
+
+    def dump_state(self):
+        with self.lock:
+            return {kind: dict(b) for kind, b in self.breakers.items()}
+
+    def load_state(self, state):
+        """open_until is wall clock, so a breaker still open is open for what is left of it; a trial that was out is not."""
+        with self.lock:
+            for kind, saved in state.items():
+                if kind in self.breakers:
+                    self.breakers[kind].update((k, saved[k]) for k in self.breakers[kind] if k in saved)
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            self._refresh(now)
+            return {
+                "probing": self.probe_started is not None,
+                "breakers": {
+                    kind: {
+                        "state": b["state"], "failures": b["failures"], "threshold": self.policies[kind][0],
+                        "trips": b["trips"], "retry_in": max(0, math.ceil(b["open_until"] - now)) if b["state"] == "open" else 0,
+                        "last_error": b["last_error"],
+                    }
+                    for kind, b in self.breakers.items()
+                },
+            }
+
+# ==================================================================================
+# [CORE] CHAT POOL
+# ==================================================================================
+# A few upstream conversations per task type instead of one shared 30-turn chat.
+# A session is recycled once its accumulated context gets large or its latency
+# drifts away from what it was when fresh; task "oneshot" always gets a new chat.
+CHAT_TASKS = ("news", "question", "summary")
+ONESHOT_TASK = "oneshot"
+CHAT_POOL_PER_TASK = int(os.environ.get("GATEWAY_CHATS_PER_TASK", "2"))
+CHAT_MAX_CONTEXT_CHARS = int(os.environ.get("GATEWAY_CHAT_CONTEXT_CHARS", "60000"))
+CHAT_MAX_TURNS = 30
+CHAT_BASELINE_TURNS = 3     # turns averaged into the "fresh session" cost
+CHAT_DRIFT_MIN_TURNS = 2    # turns after the baseline before drift can trigger
+CHAT_DRIFT_FACTOR = 1.75    # recycle when the recent cost exceeds baseline * factor
+CHAT_EWMA_ALPHA = 0.3
+
+SUMMARY_RE = re.compile(r"\b(summary|summari[sz]e|recap|overview|wrap[- ]?up)\b")
+MARKET_RE = re.compile(r"\b(market|markets|dow|dax|dxy|audusd|audjpy|cac|stocks|yields|fed)\b")
+
+
+def classify_task(prompt):
+    """Best guess of the task type when the caller didn't say."""
+    text = prompt[:3000].lower()
+    if "from news title" in text or "news_analysis" in text:
+        return "news"
+    if SUMMARY_RE.search(text) and MARKET_RE.search(text):
+        return "summary"
+    return "question"
+
+
+def resolve_task(data, prompt):
+    """Task from a request body ("task", or "stateless": true for one-shot); ValueError if unknown."""
+    if data.get('stateless'):
+        return ONESHOT_TASK
+    task = data.get('task')
+    if task is None:
+        if isinstance(prompt, TemplatePrompt):
+            return PROMPT_TEMPLATES[prompt.template].get("task") or classify_task(prompt)
+        return classify_task(prompt)
+    if task not in CHAT_TASKS + (ONESHOT_TASK,):
+        raise ValueError(f"Unknown task {task!r}, expected one of {', '.join(CHAT_TASKS + (ONESHOT_TASK,))}")
+    return task
+
+
+class ChatSession:
+    ids = itertools.count(1)
+
+    def __init__(self, task, client, chat):
+        self.id = next(self.ids)
+        self.task = task
+        self.client = client
+        self.chat = chat
+        self.created_at = time.time()
+        self.busy = 0
+        self.turns = 0
+        self.context_chars = 0
+        self.first_costs = []
+        self.baseline = None
+        self.recent = None
+        self.primed = None  # template whose instructions this chat has already seen
+
+    def record(self, sent_chars, received_chars, seconds):
+        """
+        Per-turn cost is seconds per 1k chars exchanged, so a long article
+        doesn't look like drift. The first turns set the baseline, an EWMA
+        tracks the recent cost.
+        """
+        self.turns += 1
+        self.context_chars += sent_chars + received_chars
+        cost = seconds / (1 + (sent_chars + received_chars) / 1000)
+        if len(self.first_costs) < CHAT_BASELINE_TURNS:
+            self.first_costs.append(cost)
+            self.baseline = sum(self.first_costs) / len(self.first_costs)
+        self.recent = cost if self.recent is None else CHAT_EWMA_ALPHA * cost + (1 - CHAT_EWMA_ALPHA) * self.recent
+
+    def recycle_reason(self):
+        if self.context_chars >= CHAT_MAX_CONTEXT_CHARS:
+            return "context"
+        if self.turns >= CHAT_MAX_TURNS:
+            return "turns"
+        if (self.turns >= CHAT_BASELINE_TURNS + CHAT_DRIFT_MIN_TURNS and self.baseline
+                and self.recent > self.baseline * CHAT_DRIFT_FACTOR):
+            return "latency_drift"
+        return None
+
+    def dump_state(self):
+        """What it takes to continue this conversation on a new client; None when the chat can't be resumed."""
+        metadata = getattr(self.chat, "metadata", None)
+        if not metadata:
+            return None
+        return {"metadata": list(metadata), "created_at": self.created_at, "turns": self.turns,
+                "context_chars": self.context_chars, "first_costs": self.first_costs, "baseline": self.baseline,
+                "recent": self.recent, "primed": self.primed}
+
+    @classmethod
+    def resume(cls, task, client, state):
+        session = cls(task, client, client.start_chat(metadata=state["metadata"]))
+        for field in ("created_at", "turns", "context_chars", "first_costs", "baseline", "recent", "primed"):
+            setattr(session, field, state[field])
+        return session
+
+    def snapshot(self):
+        return {
+            "id": self.id, "task": self.task, "busy": self.busy, "turns": self.turns,
+            "context_chars": self.context_chars, "age": round(time.time() - self.created_at, 1),
+            "baseline_cost": round(self.baseline, 3) if self.baseline is not None else None,
+            "recent_cost": round(self.recent, 3) if self.recent is not None else None,
+            "primed": self.primed,
+        }
+
+
+class ChatPool:
+    """
+    Sessions per task type, leased per upstream call, one turn at a time. Only
+    touched from the manager loop, so no lock is needed.
+    """
+    def __init__(self, per_task=CHAT_POOL_PER_TASK):
+        self.per_task = max(1, per_task)
+        self.sessions = {task: [] for task in CHAT_TASKS}
+        self.saved = {task: [] for task in CHAT_TASKS}  # session states from a snapshot, resumed by warm()
+        self.recycled = dict.fromkeys(("context", "turns", "latency_drift", "error", "cancelled"), 0)
+        self.primed_turns = 0
+        self.saved_chars = 0
+        self.resumed = 0
+        self.overflow = 0  # leases that found every pooled chat busy
+
+    def lease(self, client, task, template=None):
+        if task == ONESHOT_TASK:
+            session = ChatSession(task, client, client.start_chat())
+            session.busy += 1
+            return session
+        # Sessions from a previous client (re-init, account rotation) are unusable
+        live = self.sessions[task] = [s for s in self.sessions[task] if s.client is client]
+        idle = [s for s in live if not s.busy]
+        if idle:
+            # A chat already primed with this template saves resending the instructions
+            session = min(idle, key=lambda s: (template is not None and s.primed != template, s.context_chars))
+        elif len(live) < self.per_task:
+            session = self._new_session(task, client)
+            live.append(session)
+        else:
+            # Pool full and all busy: two turns in flight on one chat would race on its
+            # conversation ids, so this call gets a throwaway chat outside the pool
+            session = ChatSession(task, client, client.start_chat())
+            self.overflow += 1
+        session.busy += 1
+        return session
+
+    def release(self, session, sent_chars, received_chars=None, seconds=None, broken=False, cancelled=False):
+        """Records a finished turn; retires the session when it should not take another one."""
+        session.busy -= 1
+        if session.task == ONESHOT_TASK or session not in self.sessions[session.task]:
+            # One-shot or overflow chat, or one retired while this turn was out
+            return
+        if received_chars is not None:
+            session.record(sent_chars, received_chars, seconds)
+        reason = "cancelled" if cancelled else "error" if broken else session.recycle_reason()
+        if reason and session in self.sessions[session.task]:
+            self.sessions[session.task].remove(session)
+            self.recycled[reason] += 1
+            CHAT_RECYCLED_TOTAL.inc(session.task, reason)
+            EVENT_LOG.emit(EVENTS_LOG, "chat_recycled", reason=reason, **session.snapshot())
+
+    def _new_session(self, task, client):
+        """A saved session of this task if one is waiting, else a fresh chat."""
+        if self.saved[task]:
+            self.resumed += 1
+            return ChatSession.resume(task, client, self.saved[task].pop(0))
+        return ChatSession(task, client, client.start_chat())
+
+    def warm(self, client):
+        """
+        At least one idle session per task, so the first request of each kind
+        finds a chat. Saved sessions join the live ones (a request may have
+        opened one already) up to per_task.
+        """
+        for task in CHAT_TASKS:
+            live = self.sessions[task] = [s for s in self.sessions[task] if s.client is client]
+            while self.saved[task] and len(live) < self.per_task:
+                live.append(self._new_session(task, client))
+            if not live:
+                live.append(self._new_session(task, client))
+            self.saved[task] = []
+
+    def clear(self, saved=True):
+        """Drops the sessions and, unless saved=False, the ones waiting to be resumed."""
+        for task in CHAT_TASKS:
+            self.sessions[task] = []
+            if saved:
+                self.saved[task] = []
+
+    def dump_state(self):
+        """Resumable sessions per task, including saved ones warm() hasn't picked up yet."""
+        state = {}
+        for task in CHAT_TASKS:
+            states = [s.dump_state() for s in self.sessions[task]]
+            state[task] = [s for s in states if s is not None] + self.saved[task]
+        return state
+
+    def load_state(self, state):
+        for task in CHAT_TASKS:
+            self.saved[task] = list(state.get(task, ()))[:self.per_task]
+
+    def snapshot(self):
+        return {
+            "per_task": self.per_task,
+            "max_context_chars": CHAT_MAX_CONTEXT_CHARS,
+            "recycled": dict(self.recycled),
+            "primed_turns": self.primed_turns,
+            "saved_chars": self.saved_chars,
+            "resumed": self.resumed,
+            "overflow": self.overflow,
+            "pending_resume": {task: len(saved) for task, saved in self.saved.items() if saved},
+            "sessions": {task: [s.snapshot() for s in sessions] for task, sessions in self.sessions.items()},
+        }
+
+# ==================================================================================
+# [CORE] ADAPTIVE TIMEOUTS
+# ==================================================================================
+# With one fixed generation timeout a stalled call holds its chat, and everyone
+# queued behind it, for 100s when the same prompt normally answers in 8. Recent
+# latencies are kept per backend and prompt-size bucket; an attempt gets their
+# TIMEOUT_QUANTILE x TIMEOUT_SAFETY, clamped to [min, max]. The retry after a
+# timeout gets TIMEOUT_RETRY_FACTOR times longer, so a backend that really got
+# slower still answers, and the timed-out attempt counts as a sample at its limit,
+# which raises the quantile once timeouts are more than the odd outlier.
+TIMEOUT_MIN_SECONDS = float(os.environ.get("GATEWAY_TIMEOUT_MIN", "15"))
+TIMEOUT_MAX_SECONDS = float(os.environ.get("GATEWAY_TIMEOUT_MAX", "100"))
+TIMEOUT_QUANTILE = 0.95
+TIMEOUT_SAFETY = 2.0
+TIMEOUT_RETRY_FACTOR = 2.0
+TIMEOUT_MIN_SAMPLES = 20      # a bucket uses TIMEOUT_MAX_SECONDS until it has this many
+TIMEOUT_WINDOW = 200          # most recent samples kept per bucket
+PROMPT_SIZE_BUCKETS = ((500, "xs"), (2000, "s"), (8000, "m"), (float("inf"), "l"))  # by chars sent
+
+
+def size_bucket(chars):
+    return next(name for limit, name in PROMPT_SIZE_BUCKETS if chars <= limit)
+
+
+class LatencyTracker:
+    """Recent upstream latencies per (backend, prompt size bucket) and the attempt timeouts derived from them."""
+    def __init__(self, quantile=TIMEOUT_QUANTILE, safety=TIMEOUT_SAFETY, low=TIMEOUT_MIN_SECONDS,
+                 high=TIMEOUT_MAX_SECONDS, retry_factor=TIMEOUT_RETRY_FACTOR, min_samples=TIMEOUT_MIN_SAMPLES,
+                 window=TIMEOUT_WINDOW):
+        self.q = quantile
+        self.safety = safety
+        self.low = low
+        self.high = high
+        self.retry_factor = retry_factor
+        self.min_samples = min_samples
+        self.window = window
+        self.samples = {}  # (backend, bucket) -> deque of seconds, only touched from the manager loop
+
+    def observe(self, backend, chars, seconds):
+        key = (backend, size_bucket(chars))
+        if key not in self.samples:
+            self.samples[key] = deque(maxlen=self.window)
+        self.samples[key].append(seconds)
+
+    def quantile(self, backend, chars):
+        """The bucket's latency quantile, None while it has too few samples."""
+        samples = self.samples.get((backend, size_bucket(chars)))
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(self.q * len(ordered)))]
+
+    def timeout(self, backend, chars, retry=0):
+        """Seconds to give an attempt; `retry` counts the timeouts this request already had."""
+        latency = self.quantile(backend, chars)
+        if latency is None:
+            return self.high
+        return min(self.high, max(self.low, latency * self.safety) * self.retry_factor ** retry)
+
+    def dump_state(self):
+        return [[backend, bucket, [round(x, 3) for x in samples]] for (backend, bucket), samples in self.samples.items()]
+
+    def load_state(self, state):
+        for backend, bucket, samples in state:
+            self.samples[(backend, bucket)] = deque(samples, maxlen=self.window)
+
+    def snapshot(self):
+        buckets = {}
+        for (backend, bucket), samples in sorted(self.samples.items()):
+            chars = next(limit for limit, name in PROMPT_SIZE_BUCKETS if name == bucket)
+            latency = self.quantile(backend, chars)
+            buckets.setdefault(backend, {})[bucket] = {
+                "samples": len(samples), "quantile": round(latency, 2) if latency is not None else None,
+                "timeout": round(self.timeout(backend, chars), 1)}
+        return {"quantile": self.q, "safety": self.safety, "min_seconds": self.low, "max_seconds": self.high,
+                "retry_factor": self.retry_factor, "backends": buckets}
+
+# ==================================================================================
+# [CORE] ROUTER
+# ==================================================================================
+# The primary backend (GATEWAY_BACKEND: hourly quota, pacing, chat pool) plus any
+# GATEWAY_FALLBACKS. Each request goes to the backend with the lowest expected
+# cost: its latency EWMA, inflated by the recent error rate, by how busy it is and
+# by how little of its budget is left. A failed call fails over to the next one.
+# A non-streamed call still unanswered after HEDGE_FACTOR x the expected latency
+# is also sent to the best fallback; the first answer wins, the other is cancelled.
+# Hedges never go to the primary, whose hourly budget is the scarce one.
+ROUTER_EWMA_ALPHA = 0.2
+ROUTER_LATENCY_PRIOR = 10.0   # seconds assumed before a backend has answered anything
+ROUTER_ERROR_PENALTY = 4.0    # a backend failing every call looks 5x slower
+ROUTER_BUDGET_LOW = 0.2       # below this share of the hourly budget, cost rises steeply
+ROUTER_EXPLORE = 0.05         # chance of trying the runner-up, so idle estimates get refreshed
+HEDGE_FACTOR = float(os.environ.get("GATEWAY_HEDGE_FACTOR", "1.5"))  # 0 turns hedging off
+HEDGE_MIN_SECONDS = 5.0
+
+ROUTED_TOTAL = METRICS.add(Counter(
+    "gateway_routed_total", "Calls sent to each backend, by why it was picked (first, failover, hedge).",
+    ("backend", "role")))
+HEDGES_TOTAL = METRICS.add(Counter(
+    "gateway_hedges_total", "Hedged calls by which side answered first (won = the hedge).", ("outcome",)))
+
+
+class Upstream:
+    """One routable backend and what the router has learned about it."""
+    def __init__(self, backend, breaker, primary=False, hourly_budget=None, max_concurrency=None, cost_factor=1.0):
+        self.backend = backend
+        self.name = backend.name
+        self.breaker = breaker
+        self.primary = primary
+        self.hourly_budget = hourly_budget
+        self.max_concurrency = max_concurrency
+        self.cost_factor = float(cost_factor)
+        self.client = None  # fallbacks only, the primary's lives on the manager
+        self.latency = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.calls = deque()  # send times within the last hour, against hourly_budget
+
+    def budget_left(self):
+        """Share of the hourly budget still unused; 1.0 when unlimited."""
+        if self.primary:
+            return max(0.0, 1 - len(quota.events) / quota.limit) if quota.limit else 0.0
+        if self.hourly_budget is None:
+            return 1.0
+        cutoff = time.time() - 3600
+        while self.calls and self.calls[0] < cutoff:
+            self.calls.popleft()
+        return max(0.0, 1 - len(self.calls) / self.hourly_budget) if self.hourly_budget else 0.0
+
+    def usable(self):
+        """Breaker not open and, for a fallback, budget left. The primary's budget is checked at admission."""
+        if self.breaker.open_for()[1]:
+            return False
+        return self.primary or self.budget_left() > 0
+
+    def saturated(self):
+        return bool(self.max_concurrency) and self.in_flight >= self.max_concurrency
+
+    def expected_seconds(self):
+        latency = self.latency if self.latency is not None else ROUTER_LATENCY_PRIOR
+        return latency * (1 + ROUTER_ERROR_PENALTY * self.error_rate)
+
+    def cost(self):
+        cost = self.expected_seconds() * self.cost_factor
+        if self.max_concurrency:
+            cost *= 1 + self.in_flight / self.max_concurrency
+        left = self.budget_left()
+        if left < ROUTER_BUDGET_LOW:
+            cost /= max(left / ROUTER_BUDGET_LOW, 0.05)
+        return cost
+
+    def observe(self, ok=None, seconds=None):
+        """ok: True/False for an upstream verdict, None for none; seconds: a latency sample."""
+        if ok is not None:
+            self.error_rate += ROUTER_EWMA_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+        if seconds is not None:
+            self.latency = seconds if self.latency is None else \
+                self.latency + ROUTER_EWMA_ALPHA * (seconds - self.latency)
+
+    def dump_state(self):
+        return {"latency": self.latency, "error_rate": self.error_rate, "calls": list(self.calls),
+                "breaker": self.breaker.dump_state()}
+
+    def load_state(self, state):
+        self.latency = state["latency"]
+        self.error_rate = state["error_rate"]
+        cutoff = time.time() - 3600
+        self.calls = deque(t for t in state["calls"] if t >= cutoff)
+        self.breaker.load_state(state["breaker"])
+
+    def snapshot(self):
+        return {
+            "backend": self.backend.identity(), "primary": self.primary, "usable": self.usable(),
+            "latency": round(self.latency, 2) if self.latency is not None else None,
+            "error_rate": round(self.error_rate, 3), "expected_seconds": round(self.expected_seconds(), 2),
+            "cost": round(self.cost(), 2), "in_flight": self.in_flight, "max_concurrency": self.max_concurrency,
+            "budget_left": round(self.budget_left(), 3), "hourly_budget": self.hourly_budget,
+            "breaker": self.breaker.snapshot(),
+        }
+
+
+def create_fallbacks(config=FALLBACK_CONFIG):
+    """Upstreams for the GATEWAY_FALLBACKS entries; only builds objects, nothing is contacted."""
+    upstreams = []
+    for entry in config:
+        entry = dict(entry)
+        routing = {k: entry.pop(k) for k in ("hourly_budget", "max_concurrency", "cost_factor") if k in entry}
+        backend = create_backend(entry.pop("type", "openai"), **entry)
+        upstreams.append(Upstream(backend, CircuitBreaker(name=backend.name), **routing))
+    return upstreams
+
+
+class BackendRouter:
+    def __init__(self, primary, fallbacks=(), rng=None):
+        self.primary = primary
+        self.fallbacks = list(fallbacks)
+        self.upstreams = [primary] + self.fallbacks
+        self.rng = rng or random.Random()
+
+    def has_fallback(self):
+        return any(u.usable() for u in self.fallbacks)
+
+    def rank(self, allow_primary=True):
+        """Usable upstreams, cheapest first; saturated ones only after the rest."""
+        candidates = [u for u in self.upstreams if (allow_primary or not u.primary) and u.usable()]
+        candidates.sort(key=lambda u: (u.saturated(), u.cost()))
+        if len(candidates) > 1 and not candidates[1].saturated() and self.rng.random() < ROUTER_EXPLORE:
+            candidates[0], candidates[1] = candidates[1], candidates[0]
+        return candidates
+
+    def unavailable(self, allow_primary=True):
+        """The Failure to answer with when no backend can take the call, else None."""
+        if any(u.usable() for u in self.upstreams if allow_primary or not u.primary):
+            return None
+        retry_in, kinds = self.primary.breaker.open_for()
+        if kinds:
+            return Failure(f"Error: Upstream circuit open ({', '.join(kinds)}), retry in {retry_in}s.", "locked")
+        return Failure("Error: No backend available right now.", "locked")
+
+    def upstream_for(self, chat):
+        """The fallback a follow-up chat belongs to, None for the primary's chats."""
+        client = getattr(chat, "client", None)
+        return next((u for u in self.fallbacks if u.client is not None and u.client is client), None)
+
+    def owns(self, client):
+        return any(u.client is client for u in self.fallbacks if u.client is not None)
+
+    def dump_state(self):
+        return {u.backend.identity(): u.dump_state() for u in self.upstreams}
+
+    def load_state(self, state):
+        """Per backend identity; a backend that was reconfigured since starts from scratch."""
+        for upstream in self.upstreams:
+            if upstream.backend.identity() in state:
+                upstream.load_state(state[upstream.backend.identity()])
+
+    def snapshot(self):
+        return {"hedge_factor": HEDGE_FACTOR, "hedge_min_seconds": HEDGE_MIN_SECONDS,
+                "backends": [u.snapshot() for u in self.upstreams]}
+
+# ==================================================================================
+# [CORE] WARM RESTART
+# ==================================================================================
+# Quota, cache and jobs already live in SQLite; what a deploy or crash used to
+# throw away is the in-memory state: the pooled chats, breaker backoffs, router
+# and timeout estimates, the near-duplicate index and the cache's hot set. Every
+# SNAPSHOT_SECONDS (and at exit) those parts are written to one JSON file via a
+# temp file + os.replace, so a crash mid-write leaves the previous snapshot, and
+# startup() reads it back. The client itself (a live session with a short-lived
+# token) can't be saved; prewarm re-creates it in the background and resumes the
+# saved chats on it instead of opening fresh ones.
+SNAPSHOT_FILENAME = "gateway_state.json"
+SNAPSHOT_SECONDS = float(os.environ.get("GATEWAY_SNAPSHOT_SECONDS", "60"))  # 0 turns snapshots off
+SNAPSHOT_MAX_AGE_SECONDS = 6 * 3600   # older snapshots are ignored, the chats and estimates are stale by then
+SNAPSHOT_LOOP_TIMEOUT = 5             # for parts read on the manager loop
+SNAPSHOT_VERSION = 1
+
+
+class StateSnapshot:
+    """
+    Named parts, each a (dump, load) pair of JSON-able state. Parts that are
+    only touched from the manager loop (on_loop) are dumped and loaded there,
+    the rest on the calling thread; a part that fails is skipped, not fatal.
+    """
+    def __init__(self, loop, path=SNAPSHOT_FILENAME, interval=SNAPSHOT_SECONDS, max_age=SNAPSHOT_MAX_AGE_SECONDS):
+        self.loop = loop
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self.parts = {}
+        self.lock = Lock()
+        self.thread = None
+        self.stop_event = Event()
+        self.saved_at = None
+        self.size = 0
+        self.restored = {}  # part -> age of the snapshot it came from
+        self.last_error = None
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def register(self, name, dump, load, on_loop=False):
+        self.parts[name] = (dump, load, on_loop)
+
+    def _call(self, fn, on_loop, *args):
+        if on_loop and self.loop.is_running():
+            async def run():
+                return fn(*args)
+            return asyncio.run_coroutine_threadsafe(run(), self.loop).result(SNAPSHOT_LOOP_TIMEOUT)
+        return fn(*args)
+
+    def save(self):
+        state = {"version": SNAPSHOT_VERSION, "saved_at": time.time()}
+        for name, (dump, _, on_loop) in self.parts.items():
+            try:
+                state[name] = self._call(dump, on_loop)
+            except Exception as e:
+                print(f"[SNAPSHOT ERROR] {name}: {e!r}")
+        data = json.dumps(state, separators=(",", ":"))
+        with self.lock:
+            # Same directory as the target, so os.replace is an atomic rename
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self.saved_at = state["saved_at"]
+            self.size = len(data)
+
+    def restore(self):
+        """Loads every part the snapshot has; a missing, corrupt or stale file just means a cold start."""
+        if not self.enabled:
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"[SNAPSHOT] ⚠️  Unreadable {self.path} ({e}), starting cold")
+            return
+        age = time.time() - state.get("saved_at", 0)
+        if state.get("version") != SNAPSHOT_VERSION or age > self.max_age:
+            print(f"[SNAPSHOT] ⚠️  Ignoring {self.path} (version {state.get('version')}, {age:.0f}s old)")
+            return
+        for name, (_, load, on_loop) in self.parts.items():
+            if name not in state:
+                continue
+            try:
+                self._call(load, on_loop, state[name])
+                self.restored[name] = round(age, 1)
+            except Exception as e:
+                print(f"[SNAPSHOT ERROR] restoring {name}: {e!r}")
+        print(f"[SNAPSHOT] ♻️  Restored {', '.join(self.restored) or 'nothing'} from {age:.0f}s ago")
+
+    def start(self):
+        if not self.enabled or self.thread is not None:
+            return
+        self.thread = Thread(target=self._run, name="state-snapshot", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Final snapshot on the way out, so a clean restart loses nothing."""
+        self.stop_event.set()
+        self._save_logged()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self._save_logged()
+
+    def _save_logged(self):
+        try:
+            self.save()
+            self.last_error = None
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"[SNAPSHOT ERROR] Writing {self.path}: {e!r}")
+
+    def snapshot(self):
+        return {"enabled": self.enabled, "path": self.path, "interval": self.interval,
+                "saved_at": self.saved_at, "age": round(time.time() - self.saved_at, 1) if self.saved_at else None,
+                "bytes": self.size, "parts": list(self.parts), "restored": self.restored,
+                "last_error": self.last_error}
 
 # ==================================================================================
 # [CORE] PERSISTENT MANAGER
 # ==================================================================================
+PREWARM_RETRY_SECONDS = 30
+
 class GeminiManager:
-    def __init__(self):
+    def __init__(self, backend=None, cache=None):
+        self.backend = backend or create_backend()
+        self.cache = cache or ResponseCache()
+        self.near_dups = NearDuplicateIndex()
         self.client = None
-        self.chat = None
-        self.chat_request_count = 0
-        self.MAX_CHAT_TURNS = 30
+        self.pool = ChatPool()
 
         self.loop = asyncio.new_event_loop()
         self.async_lock = asyncio.Lock()
@@ -132,20 +3196,74 @@ class GeminiManager:
         self.query_counter = 0
         self.log_lock = Lock()
 
-        self.generation_timeout = 100
+        self.inflight = {}
+
+        # Each attempt's timeout comes from self.latency; total_timeout bounds the whole request
+        self.latency = LatencyTracker()
         self.total_timeout = 300
-        self.is_rate_limited = False
-        self.rate_limit_resume_time = 0
+        # Per error class backoff, replaces the hourly lockout
+        self.breaker = CircuitBreaker()
+        self.router = BackendRouter(Upstream(self.backend, self.breaker, primary=True), create_fallbacks())
+
+        # Set by prewarm(), reported by /readyz
+        self.started_at = None
+        self.warm_error = None
+        self.thread = None
+
+    def start(self):
+        """Opens the cache and starts the event loop thread. Construction does neither, so imports stay cheap."""
+        if self.thread is not None:
+            return
+        self.cache.open()
+        self.started_at = time.time()
+        self.thread = Thread(target=self._run_event_loop, name="manager-loop", daemon=True)
+        self.thread.start()
+
+    def _run_event_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def prewarm(self):
+        """Starts client init + first chat in the background so the first request doesn't pay for it."""
+        return asyncio.run_coroutine_threadsafe(self._prewarm(), self.loop)
+
+    async def _prewarm(self, retry_delay=PREWARM_RETRY_SECONDS):
+        while True:
+            started = time.perf_counter()
+            try:
+                await self._ensure_client()
+                async with self.async_lock:
+                    if self.client is not None:
+                        self.pool.warm(self.client)
+                self.warm_error = None
+                print(f"[SYSTEM] 🔥 Pre-warmed in {time.perf_counter() - started:.1f}s")
+                return
+            except Exception as e:
+                self.warm_error = str(e)
+                print(f"[SYSTEM] ⚠️  Pre-warm failed ({e}), retrying in {retry_delay}s")
+                await asyncio.sleep(retry_delay)
 
-        # [NEW] Track consecutive content failures
-        self.content_failure_count = 0
+    def readiness(self):
+        """(ready, reasons): a request sent now would go straight to an initialised client."""
+        reasons = []
+        if self.thread is None:
+            reasons.append("not started")
+        elif self.client is None:
+            reasons.append(f"client not initialised ({self.warm_error})" if self.warm_error
+                           else "client initialising")
+        retry_in, kinds = self.breaker.open_for()
+        if kinds:
+            reasons.append(f"circuit open ({', '.join(kinds)}), retry in {retry_in}s")
+        return not reasons, reasons
 
-        self.thread = Thread(target=self._run_event_loop, daemon=True)
-        self.thread.start()
+    def dump_chats(self):
+        return {"backend": self.backend.identity(), "account": self.current_account_index,
+                "sessions": self.pool.dump_state()}
 
-    def _run_event_loop(self):
-        asyncio.set_event_loop(self.loop)
-        self.loop.run_forever()
+    def load_chats(self, state):
+        """Saved chats only continue on the same backend and account."""
+        if state["backend"] == self.backend.identity() and state["account"] == self.current_account_index:
+            self.pool.load_state(state["sessions"])
 
     def _get_current_cookie_file(self):
         return self.cookie_files[self.current_account_index]
@@ -155,371 +3273,1649 @@ class GeminiManager:
             prev = self.current_account_index
             self.current_account_index = (self.current_account_index + 1) % len(self.cookie_files)
             print(f"[SYSTEM] 🔄 Rotating Account: {prev} -> {self.current_account_index}")
-            self.chat = None
-            self.chat_request_count = 0
+            self.pool.clear()
             return True
         return False
 
     def _log_rate_limit(self, q_id):
-        try:
-            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-            msg = f"[{timestamp}] HIT 429 ERROR at Request #{q_id}\n"
-            with open(self.rate_limit_log, "a") as f:
-                f.write(msg)
-        except Exception as e:
-            print(f"[LOGGING ERROR] {e}")
+        EVENT_LOG.emit(self.rate_limit_log, "rate_limit", req=q_id, backend=self.backend.identity(),
+                       account=self.current_account_index)
+
+    def _log_failure(self, path, event, q_id, prompt, error, **fields):
+        """Queues a structured error record; the event loop never touches the file."""
+        EVENT_LOG.emit(path, event, req=q_id, backend=self.backend.identity(), error=str(error),
+                       **fields, **EVENT_LOG.prompt_fields(prompt))
 
     async def _ensure_client(self):
             if self.client: return
+            with span("client_init"):
+                await self._init_client()
+
+    async def _init_client(self):
             async with self.async_lock:
                 if self.client: return
 
-                if self.is_rate_limited:
-                    if time.time() < self.rate_limit_resume_time:
-                        wait_time = int(self.rate_limit_resume_time - time.time())
-                        raise Exception(f"System cooling down. Waiting {wait_time}s.")
-                    else:
-                        self.is_rate_limited = False
-
-                target_cookie_file = self._get_current_cookie_file()
-                if not os.path.exists(target_cookie_file):
-                     print(f"[CRITICAL] Cookie file missing: {target_cookie_file}")
-                     raise FileNotFoundError(f"Missing {target_cookie_file}")
+                retry_in, kinds = self.breaker.open_for()
+                if kinds:
+                    raise Exception(f"Circuit open ({', '.join(kinds)}). Waiting {retry_in}s.")
 
                 try:
-                    with open(target_cookie_file, 'r') as f:
-                        raw = json.load(f)
-
-                    # Normalize to dict
-                    cookies = {c['name']: c['value'] for c in raw if 'name' in c} if isinstance(raw, list) else raw
-
-                    self.client = GeminiClient(
-                        secure_1psid=cookies.get("__Secure-1PSID"),
-                        secure_1psidts=cookies.get("__Secure-1PSIDTS")
-                    )
-
-                    user_agents = [
-                        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-                        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36"
-                    ]
-
-                    if hasattr(self.client, "session"):
-                        self.client.session.headers["User-Agent"] = random.choice(user_agents)
-                        self.client.session.headers["Referer"] = "https://gemini.google.com/"
-                        self.client.session.cookies.update(cookies)
-
-                    for k, v in cookies.items():
-                        self.client.cookies[k] = v
-
-                    await self.client.init(timeout=40)
-                    self.chat = None
-                    self.chat_request_count = 0
-                    print(f"[SYSTEM] Client Initialized with Full 6-Token Cookie Set")
+                    self.client = await self.backend.create_client(self._get_current_cookie_file())
+                    # Chats saved by a previous run are for this account, prewarm resumes them
+                    self.pool.clear(saved=False)
+                    print(f"[SYSTEM] Client Initialized ({self.backend.identity()})")
 
                 except Exception as e:
                     print(f"[INIT ERROR] {e}")
                     self.client = None
                     raise
 
-    async def _execute_with_retry(self, prompt, q_id):
-            global HOURLY_429_LOCKOUT
+    async def _send(self, chat, prompt, on_delta, progress, backend=None):
+        """One generation. With on_delta, partial text is forwarded as it arrives."""
+        if on_delta is None:
+            return (await chat.send_message(prompt)).text
+        if not (backend or self.backend).supports_streaming:
+            # No native streaming: the whole answer becomes one final chunk
+            text = (await chat.send_message(prompt)).text
+            progress["chars"] += len(text)
+            on_delta(text)
+            return text
+        text = ""
+        async for chunk in chat.send_message_stream(prompt):
+            delta = chunk.text_delta
+            text = chunk.text or text + delta
+            if delta:
+                progress["chars"] += len(delta)
+                on_delta(delta)
+        return text
 
-            if HOURLY_429_LOCKOUT:
-                return "Error: System Locked (429/503/RepeatedFailure). Waiting for next hour."
-
-            if self.is_rate_limited:
-                remaining = self.rate_limit_resume_time - time.time()
-                if remaining > 0:
-                    return f"Error: System cooling down ({int(remaining)}s remaining)."
-                else:
-                    self.is_rate_limited = False
+    async def _execute_with_retry(self, prompt, q_id, on_delta=None, chat=None, task="question", template=None):
+            # Half-open lets calls through, admit() already picked the single trial
+            retry_in, kinds = self.breaker.open_for()
+            if kinds:
+                return Failure(f"Error: Upstream circuit open ({', '.join(kinds)}), retry in {retry_in}s.", "locked")
 
             # --- HUMAN-LIKE DELAY ---
-            if len(prompt) < 150:
-                typing_speed = len(prompt) * random.uniform(0.05, 0.1)
-            else:
-                typing_speed = random.uniform(1, 2.5)
-            thinking_time = random.uniform(1, 3)
-            await asyncio.sleep(typing_speed + thinking_time)
+            if self.backend.human_like_pacing:
+                if len(prompt) < 150:
+                    typing_speed = len(prompt) * random.uniform(0.05, 0.1)
+                else:
+                    typing_speed = random.uniform(1, 2.5)
+                thinking_time = random.uniform(1, 3)
+                with span("pacing"):
+                    await asyncio.sleep(typing_speed + thinking_time)
             # ------------------------
 
             attempts = 0
             max_attempts = 2
+            timeouts = 0
+            upstream_seconds = 0.0
+            progress = {"chars": 0}
+            last_kind = "error"
 
             while attempts < max_attempts:
+                if progress["chars"]:
+                    # The caller already holds partial text, a silent retry would duplicate it
+                    return Failure("Error: Generation failed after partial output was streamed.", last_kind)
                 try:
                     await self._ensure_client()
 
-                    if self.chat is None or self.chat_request_count >= self.MAX_CHAT_TURNS:
-                        self.chat = self.client.start_chat()
-                        self.chat_request_count = 0
-
-                    self.chat_request_count += 1
-                    active_chat = self.chat
+                    send_text = prompt
+                    if chat is not None:
+                        # Follow-up turn in a specific conversation
+                        session, active_chat = None, chat
+                    else:
+                        session = self.pool.lease(self.client, task, template.template if template else None)
+                        active_chat = session.chat
+                        if template is not None and session.primed == template.template:
+                            # The chat has the instructions already, send only the variables
+                            send_text = template.turn
 
-                    response = await asyncio.wait_for(
-                        active_chat.send_message(prompt),
-                        timeout=self.generation_timeout
-                    )
+                    sent_at = time.perf_counter()
+                    text = None
+                    cancelled = False
+                    attempt_timeout = self.latency.timeout(self.backend.name, len(send_text), timeouts)
+                    try:
+                        text = await asyncio.wait_for(
+                            self._send(active_chat, send_text, on_delta, progress),
+                            timeout=attempt_timeout
+                        )
+                    except asyncio.CancelledError:
+                        cancelled = True
+                        raise
+                    except asyncio.TimeoutError:
+                        # Censored at the limit: frequent timeouts push the quantile (and the next limits) up
+                        self.latency.observe(self.backend.name, len(send_text), attempt_timeout)
+                        raise
+                    finally:
+                        elapsed = time.perf_counter() - sent_at
+                        upstream_seconds += elapsed
+                        UPSTREAM_SECONDS.observe(elapsed, self.backend.name)
+                        record_span("upstream", sent_at, attempt=attempts + 1, sent_chars=len(send_text),
+                                    timeout=round(attempt_timeout, 1), ok=text is not None, cancelled=cancelled)
+                        if session is not None:
+                            if text is not None and template is not None and session.task != ONESHOT_TASK:
+                                if send_text is template.turn:
+                                    self.pool.primed_turns += 1
+                                    self.pool.saved_chars += len(prompt) - len(send_text)
+                                session.primed = template.template
+                            # A turn that failed or was cancelled may have left the conversation half-written
+                            self.pool.release(session, len(send_text), None if text is None else len(text),
+                                              elapsed, broken=text is None, cancelled=cancelled)
 
-                    # [SUCCESS] Reset the failure count since we got a valid response
-                    self.content_failure_count = 0
-                    return response.text
+                    # [SUCCESS] Resets the failure counts and closes a half-open breaker
+                    self.breaker.record_success()
+                    self.latency.observe(self.backend.name, len(send_text), elapsed)
+                    answer = Answer(text, upstream_seconds, self.backend.identity())
+                    metadata = getattr(active_chat, "metadata", None)
+                    answer.followup = (self.client, active_chat, list(metadata) if metadata else None)
+                    return answer
 
                 except asyncio.TimeoutError:
-                    print(f"[WARN #{q_id}] Timeout")
+                    print(f"[WARN #{q_id}] Timeout after {attempt_timeout:.0f}s")
+                    timeouts += 1
+                    last_kind = "timeout"
+                    UPSTREAM_ERRORS_TOTAL.inc(self.backend.name, last_kind)
+                    if self.breaker.record_failure(last_kind):
+                        return Failure("Error: Upstream timing out repeatedly. Circuit open.", "timeout")
                     attempts += 1
 
                 except Exception as e:
                     error_str = str(e).lower()
                     print(f"[ERROR #{q_id}] {e}")
+                    last_kind = upstream_error_kind(error_str)
+                    UPSTREAM_ERRORS_TOTAL.inc(self.backend.name, last_kind)
 
                     # [CASE 1] Rate Limit (429)
-                    if "429" in error_str or "too many requests" in error_str:
+                    if last_kind == "429":
                         print(f"[ALERT #{q_id}] 🛑 429 Rate Limit!")
                         self._log_rate_limit(q_id)
                         if self._rotate_account():
                             print(f"[SYSTEM #{q_id}] ♻️ Switched Account. Retrying...")
                             async with self.async_lock:
                                 self.client = None
-                                self.chat = None
+                                self.pool.clear()
                             attempts += 1
                             continue
                         else:
-                            HOURLY_429_LOCKOUT = True
-                            self.is_rate_limited = True
-                            return "Error: Rate limit reached. Global lockout."
+                            self.breaker.record_failure(last_kind, e)
+                            return Failure("Error: Rate limit reached. Circuit open.", "429")
 
                     # [CASE 2] Session Rot (406, Invalid Response)
-                    elif any(x in error_str for x in ["406", "invalid response"]):
-                        print(f"\n{'='*20} [DEBUG] 406/INVALID RESPONSE - SKIPPING {'='*20}")
-
-                        # [DEBUG] Print the failed prompt to console
-                        print(f"FAILED PROMPT (REQ #{q_id}):\n{prompt}")
-                        print(f"{'='*60}\n")
-
-                        try:
-                            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-                            with open(self.invalid_response_log, "a", encoding="utf-8") as f:
-                                f.write(f"[{timestamp}] Req #{q_id} FAILED: {str(e)}\nPrompt: {prompt}\n{'-'*40}\n")
-                        except: pass
-                        return "Error: Skipped due to 406/Invalid Response."
+                    elif last_kind == "406":
+                        print(f"[DEBUG #{q_id}] 406/INVALID RESPONSE - SKIPPING (details in {self.invalid_response_log})")
+                        self._log_failure(self.invalid_response_log, "invalid_response", q_id, prompt, e,
+                                          attempt=attempts + 1, upstream_ms=round(upstream_seconds * 1000, 1))
+                        return Failure("Error: Skipped due to 406/Invalid Response.", "406")
 
                     # [CASE 3] Auth/Login issues (Only these trigger Re-init)
-                    elif any(x in error_str for x in ["auth", "login", "session"]):
+                    elif last_kind == "auth":
                         async with self.async_lock:
                             self.client = None
-                            self.chat = None
-                            self.chat_request_count = 0
+                            self.pool.clear()
 
                     # [CASE 4] Content Generation Failure (COUNT, LOG, & LOCKOUT)
-                    elif "failed to generate contents" in error_str:
-                        self.content_failure_count += 1
-
-                        # 1. Print and Log
-                        print(f"\n{'='*20} [DEBUG] FAILED TO GENERATE CONTENTS ({self.content_failure_count}/3) {'='*20}")
-                        print(f"FAILED PROMPT:\n{prompt}")
-                        print(f"{'='*60}\n")
-
-                        try:
-                            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-                            log_entry = (
-                                f"[{timestamp}] Req #{q_id} FAILED TO GENERATE CONTENTS\n"
-                                f"Count: {self.content_failure_count}/3\n"
-                                f"Prompt: {prompt}\n"
-                                f"{'-'*40}\n"
-                            )
-                            with open(self.debug_log, "a", encoding="utf-8") as f:
-                                f.write(log_entry)
-                        except Exception as log_err:
-                            print(f"[LOG ERROR] Could not write to debug file: {log_err}")
-
-                        # 2. Check Threshold
-                        if self.content_failure_count >= 3:
-                            print(f"\n[CRITICAL] 🛑 3 Consecutive Content Failures. Stopping requests for 1 hour.")
-                            HOURLY_429_LOCKOUT = True
-                            self.is_rate_limited = True
-                            return "Error: System Locked due to repeated content generation failures."
-
-                        return "Error: Failed to generate contents."
-
-                    # [CASE 5] Server Unavailable (503) - Global Lockout
-                    elif "503" in error_str:
-                        print(f"\n{'='*20} [DEBUG] 503 SERVICE UNAVAILABLE - LOCKING OUT {'='*20}")
-                        try:
-                            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-                            log_entry = (
-                                f"[{timestamp}] Request #{q_id} FAILED (503) -> GLOBAL LOCKOUT TRIGGERED\n"
-                                f"Error: {str(e)}\n"
-                                f"Prompt: {prompt}\n"
-                                f"{'-'*40}\n"
-                            )
-                            with open(self.debug_log, "a", encoding="utf-8") as f:
-                                f.write(log_entry)
-                        except Exception as log_err:
-                            print(f"[LOG ERROR] Could not write to debug file: {log_err}")
-
-                        HOURLY_429_LOCKOUT = True
-                        self.is_rate_limited = True
-                        return "Error: 503 Service Unavailable. Global lockout."
+                    elif last_kind == "content_failure":
+                        # 1. Count towards the breaker (opens after 3 in a row)
+                        opened = self.breaker.record_failure(last_kind, e)
+                        count = self.breaker.failures(last_kind) if not opened else BREAKER_POLICIES[last_kind][0]
+
+                        # 2. Print and Log
+                        print(f"[DEBUG #{q_id}] FAILED TO GENERATE CONTENTS ({count}/{BREAKER_POLICIES[last_kind][0]})")
+                        self._log_failure(self.debug_log, "content_failure", q_id, prompt, e,
+                                          count=count, attempt=attempts + 1,
+                                          upstream_ms=round(upstream_seconds * 1000, 1))
+
+                        if opened:
+                            print("\n[CRITICAL] 🛑 Consecutive Content Failures. Circuit open.")
+                            return Failure("Error: Circuit open due to repeated content generation failures.", "content_failure")
+
+                        return Failure("Error: Failed to generate contents.", "content_failure")
+
+                    # [CASE 5] Server Unavailable (503) - Opens the breaker
+                    elif last_kind == "503":
+                        print(f"[DEBUG #{q_id}] 503 SERVICE UNAVAILABLE - OPENING CIRCUIT")
+                        self._log_failure(self.debug_log, "breaker_503", q_id, prompt, e,
+                                          attempt=attempts + 1, upstream_ms=round(upstream_seconds * 1000, 1))
+
+                        self.breaker.record_failure(last_kind, e)
+                        return Failure("Error: 503 Service Unavailable. Circuit open.", "503")
 
                     # [CASE 6] Server Errors (500) - Retryable
-                    elif "500" in error_str:
-                            await asyncio.sleep(5)
+                    elif last_kind == "500":
+                            if self.breaker.record_failure(last_kind, e):
+                                return Failure("Error: Upstream failing repeatedly (500). Circuit open.", "500")
+                            with span("retry_sleep"):
+                                await asyncio.sleep(5)
 
                     attempts += 1
-                    await asyncio.sleep(3)
+                    with span("retry_sleep"):
+                        await asyncio.sleep(3)
+
+            return Failure("Error: Failed to generate response after retries.", last_kind)
+
+    async def _execute_fallback(self, upstream, prompt, q_id, on_delta=None, chat=None):
+        """One call to a fallback backend: no pacing and no retries, the router fails over instead."""
+        retry_after, probe = upstream.breaker.admit()
+        if retry_after:
+            return Failure(f"Error: {upstream.name} circuit open, retry in {retry_after}s.", "locked")
+        upstream.calls.append(time.time())
+        progress = {"chars": 0}
+        attempt_timeout = self.latency.timeout(upstream.name, len(prompt))
+        sent_at = time.perf_counter()
+        text, kind, error = None, None, None
+        try:
+            if upstream.client is None:
+                upstream.client = await upstream.backend.create_client()
+            active_chat = chat or upstream.client.start_chat()
+            text = await asyncio.wait_for(self._send(active_chat, prompt, on_delta, progress, upstream.backend),
+                                          timeout=attempt_timeout)
+            self.latency.observe(upstream.name, len(prompt), time.perf_counter() - sent_at)
+        except asyncio.TimeoutError:
+            kind, error = "timeout", f"timeout after {attempt_timeout:.0f}s"
+            self.latency.observe(upstream.name, len(prompt), attempt_timeout)
+        except asyncio.CancelledError:
+            if probe:
+                upstream.breaker.release_probe()
+            raise
+        except Exception as e:
+            kind, error = upstream_error_kind(str(e).lower()), e
+        finally:
+            elapsed = time.perf_counter() - sent_at
+            UPSTREAM_SECONDS.observe(elapsed, upstream.name)
+            record_span("upstream", sent_at, backend=upstream.name, timeout=round(attempt_timeout, 1), ok=text is not None)
+
+        if text is None:
+            print(f"[ERROR #{q_id}] {upstream.name}: {error}")
+            UPSTREAM_ERRORS_TOTAL.inc(upstream.name, kind)
+            if kind in upstream.breaker.policies:
+                upstream.breaker.record_failure(kind, error)
+            elif probe:
+                upstream.breaker.release_probe()
+            return Failure(f"Error: {upstream.name} failed ({kind}).", kind)
+        upstream.breaker.record_success()
+        answer = Answer(text, elapsed, upstream.backend.identity())
+        answer.followup = (upstream.client, active_chat, active_chat.metadata)
+        return answer
+
+    async def _call(self, upstream, role, prompt, q_id, on_delta=None, task="question", template=None):
+        """Runs the request on one backend and feeds the outcome into its routing estimate."""
+        ROUTED_TOTAL.inc(upstream.name, role)
+        trace_note(backends=upstream.name)
+        upstream.in_flight += 1
+        started = time.perf_counter()
+        result = None
+        try:
+            if upstream.primary:
+                result = await self._execute_with_retry(prompt, q_id, on_delta, None, task, template)
+            else:
+                result = await self._execute_fallback(upstream, prompt, q_id, on_delta)
+            return result
+        finally:
+            upstream.in_flight -= 1
+            elapsed = time.perf_counter() - started
+            if result is None:
+                # Cancelled (lost a hedge, deadline, disconnect): it took at least this long
+                if upstream.latency is None or elapsed > upstream.latency:
+                    upstream.observe(None, elapsed)
+            elif isinstance(result, Answer):
+                upstream.observe(True, elapsed)
+            elif result.kind != "locked":
+                upstream.observe(False, elapsed if result.kind == "timeout" else None)
+
+    async def _hedged(self, first, second, prompt, q_id, task, template):
+        """Sends to `first`; if it is still busy after the hedge delay, to `second` too. First answer wins."""
+        delay = max(HEDGE_MIN_SECONDS, HEDGE_FACTOR * first.expected_seconds())
+        calls = {asyncio.ensure_future(self._call(first, "first", prompt, q_id, None, task, template)): first}
+        result, winner = None, None
+        try:
+            done, pending = await asyncio.wait(calls, timeout=delay)
+            if not done:
+                print(f"[ROUTER #{q_id}] 🏁 {first.name} slower than {delay:.0f}s, hedging to {second.name}")
+                calls[asyncio.ensure_future(self._call(second, "hedge", prompt, q_id, None, task, template))] = second
+                pending = set(calls)
+            while done or pending:
+                if not done:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for finished in done:
+                    result = finished.result()
+                    if isinstance(result, Answer):
+                        winner = calls[finished]
+                        break
+                done = set()
+                if winner is not None:
+                    break
+            if len(calls) > 1:
+                HEDGES_TOTAL.inc("won" if winner is second else "lost" if winner is first else "failed")
+            return result, set(calls.values())
+        finally:
+            for call in calls:
+                if not call.done():
+                    call.cancel()
+
+    async def _route(self, prompt, q_id, on_delta=None, task="question", template=None, allow_primary=True):
+        """Picks a backend, hedges a slow non-streamed call, and fails over when a backend fails."""
+        candidates = self.router.rank(allow_primary)
+        if not candidates:
+            return self.router.unavailable(allow_primary)
+        first = candidates[0]
+        streamed = {"chars": 0}
+        if on_delta is not None:
+            forward = on_delta
+
+            def on_delta(delta):
+                streamed["chars"] += len(delta)
+                forward(delta)
+
+        hedge = None
+        if on_delta is None and HEDGE_FACTOR > 0:
+            hedge = next((u for u in candidates[1:] if not u.primary and not u.saturated()), None)
+        if hedge is not None:
+            result, tried = await self._hedged(first, hedge, prompt, q_id, task, template)
+        else:
+            result, tried = await self._call(first, "first", prompt, q_id, on_delta, task, template), {first}
+
+        for upstream in candidates[1:]:
+            # Partial output already went to the caller, another backend would start over
+            if isinstance(result, Answer) or streamed["chars"]:
+                break
+            if upstream in tried or not upstream.usable():
+                continue
+            print(f"[ROUTER #{q_id}] ↪️  {outcome_class(result)} from {first.name}, failing over to {upstream.name}")
+            tried.add(upstream)
+            result = await self._call(upstream, "failover", prompt, q_id, on_delta, task, template)
+        return result
+
+    async def _run_query(self, prompt, q_id, on_delta=None, chat=None, task="question", template=None,
+                         allow_primary=True):
+        """Routes the request (a follow-up stays with its chat's backend), plus one structured record of how it went."""
+        started = time.perf_counter()
+        result = None
+        try:
+            if chat is None:
+                result = await self._route(prompt, q_id, on_delta, task, template, allow_primary)
+            elif self.router.upstream_for(chat) is not None:
+                result = await self._execute_fallback(self.router.upstream_for(chat), prompt, q_id, on_delta, chat)
+            else:
+                result = await self._execute_with_retry(prompt, q_id, on_delta, chat, task, template)
+            return result
+        finally:
+            EVENT_LOG.emit(
+                EVENTS_LOG, "query", req=q_id, backend=getattr(result, "backend", None) or self.backend.identity(),
+                stream=on_delta is not None,
+                task="followup" if chat is not None else task, template=template.template if template else None,
+                outcome=outcome_class(result) if result is not None else "cancelled",
+                total_ms=round((time.perf_counter() - started) * 1000, 1),
+                upstream_ms=round(getattr(result, "upstream_seconds", 0.0) * 1000, 1),
+                answer_chars=len(result) if isinstance(result, Answer) else 0,
+                **EVENT_LOG.prompt_fields(prompt)
+            )
+
+    def cached_answer(self, prompt, similar=True):
+        """Stored answer for this prompt, else (similar=True) for a near-duplicate of its article."""
+        with span("cache"):
+            hit = self.cache.get(prompt_cache_key(prompt, self.backend.identity()))
+        if hit is not None:
+            return Answer(hit[0], backend=hit[1], cached=True)
+        return self.similar_answer(prompt) if similar else None
+
+    def similar_answer(self, prompt, scope=""):
+        """
+        Answer stored for an article near-identical to this prompt's, flagged with
+        the request that produced it. `scope` separates answers that are not
+        interchangeable for the same article (e.g. another response_format).
+        """
+        with span("near_duplicate"):
+            match = self.near_dups.lookup(prompt, f"{self.backend.identity()}\n{scope}")
+            if match is None:
+                if self.near_dups.enabled:
+                    NEAR_DUPLICATES_TOTAL.inc("miss")
+                return None
+            key, source, similarity = match
+            hit = self.cache.get(key)
+        if hit is None:
+            # Expired or evicted from the cache since, the signature alone is no use
+            self.near_dups.discard(key, stale=True)
+            NEAR_DUPLICATES_TOTAL.inc("stale")
+            return None
+        NEAR_DUPLICATES_TOTAL.inc("hit")
+        print(f"[CACHE] 🪞 Near-duplicate of {source} (similarity {similarity:.2f}), reusing its answer")
+        answer = Answer(hit[0], backend=hit[1], cached=True)
+        answer.near_duplicate = {"source_request": source, "similarity": round(similarity, 3)}
+        trace_note(near_duplicate_of=source)
+        return answer
+
+    def remember(self, prompt, key, text, backend, scope="", source=None):
+        """Stores an answer under its exact key and indexes the prompt's article for near-duplicate reuse."""
+        self.cache.put(key, text, backend)
+        self.near_dups.add(prompt, key, f"{self.backend.identity()}\n{scope}", source or current_request_id())
 
-            return "Error: Failed to generate response after retries."
+    async def query_async(self, prompt, cache_read=True, cache_write=True, task=None, allow_primary=True):
+        """
+        Runs on self.loop; HTTP handlers await this directly. `task` picks the
+        chat pool ("news", "question", "summary", or "oneshot" for a fresh
+        chat); None guesses it from the prompt. A TemplatePrompt sends only its
+        short turn to a chat already primed with that template.
+        allow_primary=False keeps the call on the fallbacks (the caller holds
+        no reservation of the primary's hourly budget).
+        """
+        if cache_read:
+            cached = self.cached_answer(prompt)
+            if cached is not None:
+                return cached
 
-    def query(self, prompt):
         with self.log_lock:
             self.query_counter += 1
             q_id = self.query_counter
+        trace_note(queries=q_id)
 
-        if self.is_rate_limited and time.time() < self.rate_limit_resume_time:
-             return f"Error: System cooling down ({int(self.rate_limit_resume_time - time.time())}s remaining)."
+        refused = self.router.unavailable(allow_primary)
+        if refused is not None:
+            return refused
 
+        template = prompt if isinstance(prompt, TemplatePrompt) else None
         clean_prompt = prompt.strip()
-        print(f"\n[QUERY #{q_id}] Processing...")
+        task = task or (PROMPT_TEMPLATES[template.template].get("task") if template else None) or classify_task(clean_prompt)
+        key = prompt_cache_key(clean_prompt, self.backend.identity())
 
-        future = asyncio.run_coroutine_threadsafe(
-            self._execute_with_retry(clean_prompt, q_id),
-            self.loop
-        )
+        # [SINGLE-FLIGHT] Identical prompts already in flight share one upstream call.
+        # Only touched from self.loop, so no lock is needed.
+        running = self.inflight.get(key)
+        if running is not None and running.done():
+            # Finished but not yet un-registered, never hand out a stale result
+            running = None
+        leader = running is None
+        if leader:
+            call = asyncio.ensure_future(self._run_query(clean_prompt, q_id, task=task, template=template,
+                                                         allow_primary=allow_primary))
+            call.waiters = 0
+            call.claimed = False
+            self.inflight[key] = call
+            source = current_request_id() or f"query-{q_id}"
+            call.add_done_callback(lambda t: self._finish_inflight(key, t, cache_write, clean_prompt, source))
+        else:
+            call = running
+            EVENT_LOG.emit(EVENTS_LOG, "coalesced", req=q_id, **EVENT_LOG.prompt_fields(clean_prompt))
+        return await self._collect(call, leader)
+
+    def inflight_call(self, prompt):
+        """The upstream call already running for an identical prompt, or None."""
+        call = self.inflight.get(prompt_cache_key(prompt.strip(), self.backend.identity()))
+        return None if call is None or call.done() else call
+
+    async def join_inflight(self, prompt):
+        """
+        Waits for the answer of an identical prompt already in flight; None when
+        there is none. Needs no admission: the caller holds no reservation and
+        never pays for the call, so the answer always comes back coalesced.
+        """
+        call = self.inflight_call(prompt)
+        if call is None:
+            return None
+        with self.log_lock:
+            self.query_counter += 1
+            q_id = self.query_counter
+        trace_note(queries=q_id)
+        EVENT_LOG.emit(EVENTS_LOG, "coalesced", req=q_id, **EVENT_LOG.prompt_fields(prompt.strip()))
+        return await self._collect(call, leader=False, claim=False)
 
+    async def _collect(self, call, leader, claim=True):
+        call.waiters += 1
         try:
-            result = future.result(timeout=self.total_timeout)
+            # shield: one caller giving up must not cancel the call the others wait on.
+            # The leader's spans are recorded by the call itself, a follower only sees the wait
+            with span("coalesced") if not leader else nullcontext():
+                result = await asyncio.wait_for(asyncio.shield(call), timeout=self.total_timeout)
+            if isinstance(result, Answer):
+                if call.claimed or not claim:
+                    followup = result.followup
+                    result = Answer(result, result.upstream_seconds, result.backend, coalesced=True)
+                    result.followup = followup
+                else:
+                    # The first caller to collect pays for the call, even if the leader has left
+                    call.claimed = True
             return result
         except Exception as e:
-            return f"Error: Request processing failed ({str(e)})"
+            return Failure(f"Error: Request processing failed ({str(e)})",
+                           "timeout" if isinstance(e, asyncio.TimeoutError) else "error")
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.done():
+                # Everyone who wanted this answer has gone, stop spending upstream time on it
+                call.cancel()
+
+    async def stream_async(self, prompt, on_delta, cache_read=True, cache_write=True, task=None, allow_primary=True):
+        """
+        Like query_async, but forwards partial text to on_delta(str) as the backend
+        produces it. Streaming callers get their own generation, they are not coalesced.
+        """
+        if cache_read:
+            cached = self.cached_answer(prompt)
+            if cached is not None:
+                on_delta(str(cached))
+                return cached
+
+        with self.log_lock:
+            self.query_counter += 1
+            q_id = self.query_counter
+        trace_note(queries=q_id)
+
+        refused = self.router.unavailable(allow_primary)
+        if refused is not None:
+            return refused
+
+        template = prompt if isinstance(prompt, TemplatePrompt) else None
+        clean_prompt = prompt.strip()
+        task = task or (PROMPT_TEMPLATES[template.template].get("task") if template else None) or classify_task(clean_prompt)
+        try:
+            result = await asyncio.wait_for(
+                self._run_query(clean_prompt, q_id, on_delta=on_delta, task=task, template=template,
+                                allow_primary=allow_primary),
+                timeout=self.total_timeout
+            )
+        except asyncio.TimeoutError as e:
+            return Failure(f"Error: Request processing failed ({str(e)})", "timeout")
+
+        if cache_write and isinstance(result, Answer):
+            self.remember(clean_prompt, prompt_cache_key(clean_prompt, self.backend.identity()), str(result),
+                          result.backend, source=current_request_id() or f"query-{q_id}")
+        return result
+
+    def followup_chat(self, answer):
+        """Chat positioned right after `answer`, or None when that conversation is gone."""
+        if not isinstance(answer, Answer) or answer.followup is None:
+            return None
+        client, chat, metadata = answer.followup
+        if client is not self.client and not self.router.owns(client):
+            # Account rotated or client re-initialised since, the old chat is unusable
+            return None
+        if metadata:
+            # Fork from the saved turn so concurrent traffic on the shared chat doesn't get in between
+            return client.start_chat(metadata=metadata)
+        return chat
+
+    async def followup_async(self, chat, prompt, allow_primary=True):
+        """Sends prompt as the next turn of `chat` (see followup_chat); never cached or coalesced."""
+        with self.log_lock:
+            self.query_counter += 1
+            q_id = self.query_counter
+        trace_note(queries=q_id)
+        try:
+            return await asyncio.wait_for(self._run_query(prompt.strip(), q_id, chat=chat, allow_primary=allow_primary),
+                                          timeout=self.total_timeout)
+        except asyncio.TimeoutError as e:
+            return Failure(f"Error: Request processing failed ({str(e)})", "timeout")
+
+    def query(self, prompt, cache_read=True, cache_write=True, task=None, allow_primary=True):
+        """Blocking variant for plain threads (job workers, benchmark)."""
+        return self.call(self.query_async(prompt, cache_read, cache_write, task, allow_primary))
+
+    def call(self, coro, timeout=None):
+        """Runs a coroutine on self.loop from another thread and waits for it; giving up cancels it."""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            # Timed out or interrupted: nobody will read the result, stop the upstream work too
+            future.cancel()
+            raise
+
+    def run_in_foreground(self, coro):
+        """Moves the event loop from its background thread to the calling thread and runs coro on it."""
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+        return self.loop.run_until_complete(coro)
+
+    def _finish_inflight(self, key, task, cache_write, prompt, source):
+        # Store before un-registering so late arrivals find either the task or the cache
+        try:
+            result = None if task.cancelled() or task.exception() else task.result()
+            if cache_write and isinstance(result, Answer):
+                self.remember(prompt, key, str(result), result.backend, source=source)
+        except Exception as e:
+            print(f"[CACHE ERROR] {e}")
+        finally:
+            # Failed results are dropped here too, so the next caller retries upstream
+            if self.inflight.get(key) is task:
+                del self.inflight[key]
 
 # ==================================================================================
-# [FLASK] APP SETUP
+# [HTTP] REQUEST / RESPONSE
 # ==================================================================================
-app = Flask(__name__)
-log = logging.getLogger('werkzeug')
-log.setLevel(logging.ERROR)
+# Route handlers are coroutines on bot_manager.loop, the same loop that runs
+# _execute_with_retry. The Flask and ASGI front-ends below only translate
+# their native request/response objects to these.
+class ApiRequest:
+    def __init__(self, method, path, headers, args, body, base_url):
+        self.method = method
+        self.path = path
+        self.headers = {k.lower(): v for k, v in headers.items()}
+        self.args = args
+        self.body = body
+        self.base_url = base_url
+        # Outcome class for /metrics; handlers set it when the status code alone is too coarse
+        self.outcome = None
 
-bot_manager = GeminiManager()
-STRESS_TEST_RUNNING = False
+    def header(self, name, default=None):
+        return self.headers.get(name.lower(), default)
 
-def run_stress_test_loop():
-    global STRESS_TEST_RUNNING, HOURLY_429_LOCKOUT
-    print("\n[TEST] 🧪 STARTED: Stress Testing with HUMAN-LIKE Timing...")
+    def json(self):
+        try:
+            data = json.loads(self.body or b"{}")
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
 
-    while STRESS_TEST_RUNNING:
-        if HOURLY_429_LOCKOUT:
-            print("[TEST] 🛑 System reported Global Lockout! Test stopping.")
-            break
+    def form(self):
+        return {k: v[0] for k, v in parse_qs(self.body.decode("utf-8", "replace")).items()}
 
-        prompt = random.choice(TEST_PROMPTS)
-        result = bot_manager.query(prompt)
+    def arg_float(self, name, default=0.0):
+        try:
+            return float(self.args.get(name, default))
+        except (TypeError, ValueError):
+            return default
 
-        if "Rate limit reached" in result or "Lockout" in result:
-            print("[TEST] 🛑 Received Lockout Error. Stopping.")
-            break
 
-        if result.startswith("Error"):
-             print(f"[TEST] ⚠️  {result}")
+class ApiResponse:
+    """`stream`, when set, is an async iterator of body chunks consumed on the manager loop."""
+    def __init__(self, body=b"", status=200, headers=None, content_type="application/json", stream=None):
+        self.body = body
+        self.status = status
+        self.headers = headers or {}
+        self.content_type = content_type
+        self.stream = stream
+
+
+def json_response(payload, status=200, headers=None):
+    return ApiResponse((json.dumps(payload) + "\n").encode("utf-8"), status, headers)
+
+# ==================================================================================
+# [HTTP] STREAMING
+# ==================================================================================
+# "sse": server-sent events (event: delta / event: done)
+# "jsonl": one JSON object per line ({"event": "delta", "text": ...}, then {"event": "done", ...})
+STREAM_CONTENT_TYPES = {"sse": "text/event-stream", "jsonl": "application/x-ndjson"}
+
+def stream_format(req, data):
+    """Returns "sse", "jsonl" or None (no streaming) for this request."""
+    wanted = data.get('stream') if 'stream' in data else req.args.get('stream')
+    if wanted in ("jsonl", "ndjson"):
+        return "jsonl"
+    if wanted in (True, "sse", "1", "true"):
+        return "jsonl" if "application/x-ndjson" in req.header('Accept', '') else "sse"
+    if wanted is None and "text/event-stream" in req.header('Accept', ''):
+        return "sse"
+    return None
+
+def encode_event(fmt, event, payload):
+    if fmt == "sse":
+        return f"event: {event}\ndata: {json.dumps(payload)}\n\n".encode("utf-8")
+    return (json.dumps(dict(payload, event=event)) + "\n").encode("utf-8")
+
+async def next_chunk(agen):
+    try:
+        return await agen.__anext__()
+    except StopAsyncIteration:
+        return None
+
+def stream_response(fmt, produce, final_payload):
+    """
+    Streams the deltas produce(on_delta) reports, then one "done" event with
+    final_payload(result). Closing the stream early (client went away) cancels produce.
+    """
+    # The body is pulled from fresh tasks, so carry the request's trace and deadline over explicitly
+    trace = CURRENT_TRACE.get()
+    deadline = CURRENT_DEADLINE.get()
+
+    async def traced(on_delta):
+        CURRENT_TRACE.set(trace)
+        CURRENT_DEADLINE.set(deadline)
+        try:
+            return await within_deadline(produce(on_delta))
+        except DeadlineExceeded:
+            REQUESTS_ABANDONED_TOTAL.inc("deadline")
+            raise
+
+    async def events():
+        chunks = asyncio.Queue()
+        task = asyncio.ensure_future(traced(chunks.put_nowait))
+        task.add_done_callback(lambda t: chunks.put_nowait(None))
+        try:
+            while True:
+                delta = await chunks.get()
+                if delta is None:
+                    break
+                yield encode_event(fmt, "delta", {"text": delta})
+            try:
+                payload = final_payload(task.result())
+            except DeadlineExceeded as e:
+                payload = {"status": "error", "error": "deadline_exceeded", "message": str(e)}
+            except Exception as e:
+                payload = {"status": "error", "message": str(e)}
+            yield encode_event(fmt, "done", payload)
+        finally:
+            if not task.done():
+                task.cancel()
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return ApiResponse(content_type=STREAM_CONTENT_TYPES[fmt], headers=headers, stream=events())
+
+
+ROUTES = []
+
+def route(path, methods=("GET",)):
+    def register(handler):
+        ROUTES.append((path, tuple(methods), instrument(path, handler)))
+        return handler
+    return register
+
+def status_outcome(status):
+    if status >= 500:
+        return "server_error"
+    if status >= 400:
+        return "client_error"
+    return "success"
+
+def instrument(path, handler):
+    """
+    Counts and times every request per route; a streamed body is timed until it closes.
+    Traced routes also get a RequestTrace: its breakdown goes out as Server-Timing
+    (for streams, whatever happened before the first byte) with X-Request-Id, and
+    the finished trace lands in REQUEST_LOG.
+    """
+    traced = path not in UNTRACED_ROUTES
+
+    async def instrumented(req, **params):
+        started = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+        trace = RequestTrace(req.method, path) if traced else None
+        token = CURRENT_TRACE.set(trace)
+        deadline_token = CURRENT_DEADLINE.set(request_deadline(req))
+
+        def finish(status, completed=True):
+            REQUESTS_IN_FLIGHT.dec()
+            if not completed:
+                REQUESTS_ABANDONED_TOTAL.inc("disconnect")
+            outcome = req.outcome or (status_outcome(status) if completed else "disconnected")
+            REQUESTS_TOTAL.inc(path, outcome)
+            REQUEST_SECONDS.observe(time.perf_counter() - started, path)
+            if trace is not None:
+                REQUEST_LOG.record(trace, status, outcome)
+
+        try:
+            resp = await within_deadline(handler(req, **params))
+        except DeadlineExceeded as e:
+            resp = deadline_response(req, e)
+        except asyncio.CancelledError:
+            # The client went away (ASGI) or the thread waiting on us gave up
+            finish(499, completed=False)
+            raise
+        except BaseException:
+            finish(500)
+            raise
+        finally:
+            CURRENT_TRACE.reset(token)
+            CURRENT_DEADLINE.reset(deadline_token)
+        if trace is not None:
+            resp.headers["Server-Timing"] = trace.server_timing(resp.headers.get("Server-Timing", ""))
+            resp.headers["X-Request-Id"] = trace.id
+        if resp.stream is None:
+            finish(resp.status)
         else:
-            clean_res = result.replace('\n', ' ').replace('\r', '')
-            short_res = (clean_res[:70] + '..') if len(clean_res) > 70 else clean_res
-            print(f"[TEST] ✅ Answer: {short_res}")
-
-        wait_time = random.uniform(10, 25)
-        if random.random() < 0.15:
-            extra = random.uniform(20, 60)
-            print(f"[TEST] ☕ Taking a break... (+{extra:.0f}s)")
-            wait_time += extra
-
-        time.sleep(wait_time)
-
-@app.route('/api/test-limit', methods=['POST'])
-def api_test_limit():
-    global STRESS_TEST_RUNNING
-    if STRESS_TEST_RUNNING:
-        return jsonify({"status": "error", "message": "Test already running"}), 400
-
-    STRESS_TEST_RUNNING = True
-    thread = Thread(target=run_stress_test_loop, daemon=True)
+            resp.stream = observed_stream(resp.stream, lambda completed: finish(resp.status, completed))
+        return resp
+
+    instrumented.__name__ = handler.__name__
+    return instrumented
+
+async def observed_stream(agen, finish):
+    completed = False
+    try:
+        async for chunk in agen:
+            yield chunk
+        completed = True
+    finally:
+        await agen.aclose()
+        finish(completed)
+
+# ==================================================================================
+# [HTTP] APP SETUP
+# ==================================================================================
+bot_manager = GeminiManager()
+BENCHMARK_STOP = None
+BENCHMARK_RESULTS_DIR = "bench_results"
+
+def run_benchmark_job(base_url, options, stop_event):
+    global BENCHMARK_STOP
+    import bench_gateway
+    print(f"\n[TEST] 🧪 STARTED: Benchmark against {base_url} {options}")
+    try:
+        report = bench_gateway.run_benchmark(base_url=base_url, stop_event=stop_event, **options)
+        os.makedirs(BENCHMARK_RESULTS_DIR, exist_ok=True)
+        out_file = os.path.join(BENCHMARK_RESULTS_DIR, time.strftime("bench_%Y%m%d_%H%M%S.json"))
+        with open(out_file, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"[TEST] ✅ Done: {report['requests']} req, {report['throughput_rps']:.2f} req/s, "
+              f"p95 {report['latency']['p95']}s -> {out_file}")
+    except Exception as e:
+        print(f"[TEST] ⚠️  Benchmark failed: {e}")
+    finally:
+        BENCHMARK_STOP = None
+
+@route('/api/test-limit', methods=['POST'])
+async def api_test_limit(req):
+    global BENCHMARK_STOP
+    if BENCHMARK_STOP is not None:
+        return json_response({"status": "error", "message": "Test already running"}, 400)
+
+    data = req.json()
+    allowed = ("requests", "concurrency", "rate", "duration", "workload", "content_chars", "timeout", "seed", "use_cache",
+               "use_template")
+    options = {k: data[k] for k in allowed if k in data}
+    options.setdefault("requests", 20)
+    options.setdefault("concurrency", 1)
+
+    BENCHMARK_STOP = Event()
+    thread = Thread(target=run_benchmark_job, args=(req.base_url, options, BENCHMARK_STOP), daemon=True)
     thread.start()
-    return jsonify({"status": "success", "message": "Stress test started."})
+    return json_response({"status": "success", "message": f"Benchmark started, report goes to {BENCHMARK_RESULTS_DIR}/."})
 
-@app.route('/api/stop-test', methods=['POST'])
-def api_stop_test():
-    global STRESS_TEST_RUNNING
-    STRESS_TEST_RUNNING = False
-    return jsonify({"status": "success", "message": "Stopping test..."})
+@route('/api/stop-test', methods=['POST'])
+async def api_stop_test(req):
+    if BENCHMARK_STOP is not None:
+        BENCHMARK_STOP.set()
+    return json_response({"status": "success", "message": "Stopping test..."})
 
 # ==================================================================================
-# [FLASK] API ROUTE
+# [HTTP] API ROUTE
 # ==================================================================================
-QUOTA_LOCK = Lock()
 MAX_HOURLY_REQUESTS = 91
-CURRENT_HOUR_TRACKER = -1
-SESSION_COUNTER = 0
 LAST_LOG_TIME = 0
 
-@app.route('/api/ask-gpt', methods=['POST'])
-def api_ask():
-    global SESSION_COUNTER, CURRENT_HOUR_TRACKER, LAST_LOG_TIME, HOURLY_429_LOCKOUT
-
-    with QUOTA_LOCK:
-        now = datetime.datetime.now()
-        this_hour = now.hour
-
-        if this_hour != CURRENT_HOUR_TRACKER:
-            print(f"[SYSTEM] 🕒 New Hour Detected ({this_hour}:00). Resetting Quotas & Lockouts.")
-            CURRENT_HOUR_TRACKER = this_hour
-            SESSION_COUNTER = 0
-            HOURLY_429_LOCKOUT = False
-            # [RESET] Also reset content failure count on new hour for safety
-            bot_manager.content_failure_count = 0
-
-        if HOURLY_429_LOCKOUT:
-            next_hour = (now + datetime.timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
-            minutes_left = int((next_hour - now).total_seconds() / 60) + 1
-            if time.time() - LAST_LOG_TIME > 10:
-                print(f"[API] ⛔ SYSTEM LOCKED. Paused until next hour (~{minutes_left} min left).")
-                LAST_LOG_TIME = time.time()
-            return jsonify({}), 200
+scheduler = FairScheduler()
+quota = QuotaLimiter(MAX_HOURLY_REQUESTS)
+triage = TriageModel()
+
+def request_identity(req, data):
+    client, priority = scheduler.resolve(
+        client=req.header('X-Client-Id'),
+        api_key=req.header('X-Api-Key'),
+        priority=req.header('X-Priority') or data.get('priority'),
+    )
+    trace_note(client=client, priority=priority)
+    return client, priority
 
-        if SESSION_COUNTER >= MAX_HOURLY_REQUESTS:
+def answer_payload(result):
+    payload = {"status": "success", "answer": result}
+    if isinstance(result, Answer) and result.backend:
+        payload["backend"] = result.backend
+    if isinstance(result, Answer) and result.cached:
+        payload["cached"] = True
+    if isinstance(result, Answer) and result.coalesced:
+        payload["coalesced"] = True
+    if isinstance(result, Answer) and result.near_duplicate:
+        payload["near_duplicate"] = result.near_duplicate
+    return payload
+
+def answer_response(result):
+    payload = answer_payload(result)
+    headers = {}
+    if isinstance(result, Answer):
+        headers["Server-Timing"] = f"upstream;dur={result.upstream_seconds * 1000:.1f}"
+        if result.backend:
+            headers["X-Backend"] = result.backend
+        if result.near_duplicate:
+            headers["X-Near-Duplicate-Of"] = str(result.near_duplicate["source_request"])
+    return json_response(payload, headers=headers)
+
+def admit(client="default", priority="normal"):
+    """
+    Checks the circuit breaker, then reserves one upstream call. Returns a
+    QuotaTicket. When the primary can't take the call but a fallback can, the
+    ticket is allowed without a reservation (ticket.primary is False).
+    """
+    global LAST_LOG_TIME
+
+    with span("admit"):
+        retry_after, probe = bot_manager.breaker.admit()
+        if retry_after:
+            if bot_manager.router.has_fallback():
+                return fallback_ticket("locked")
             if time.time() - LAST_LOG_TIME > 10:
-                print(f"[API] ⛔ HOURLY QUOTA REACHED ({SESSION_COUNTER}). Dropping requests.")
+                print(f"[API] ⛔ CIRCUIT OPEN. Rejecting requests for {retry_after}s.")
                 LAST_LOG_TIME = time.time()
-            return jsonify({}), 200
+            return QuotaTicket(False, 503, "locked", retry_after, quota.limit - len(quota.events), quota.limit)
+
+        ticket = quota.acquire(client, priority, lambda usage, used: scheduler.may_spend(client, quota.limit, used, usage))
+        if probe:
+            if ticket.allowed:
+                print(f"[BREAKER] 🧪 Trial request admitted for {client}")
+                ticket.probe = True
+            else:
+                bot_manager.breaker.release_probe()
+        if not ticket.allowed and bot_manager.router.has_fallback():
+            return fallback_ticket(ticket.reason)
+        if not ticket.allowed and ticket.reason == "quota" and time.time() - LAST_LOG_TIME > 10:
+            print(f"[API] ⛔ HOURLY QUOTA REACHED ({quota.limit}). Rejecting requests for {ticket.retry_after}s.")
+            LAST_LOG_TIME = time.time()
+        return ticket
+
+def fallback_ticket(reason):
+    """An allowed ticket that reserves nothing: the primary refused (`reason`), the fallbacks serve it."""
+    ticket = QuotaTicket(True, 200, reason, 0, quota.limit - len(quota.events), quota.limit)
+    ticket.primary = False
+    return ticket
+
+def settle_quota(ticket, result):
+    """
+    Keeps the reservation only for a fresh successful upstream answer; anything
+    else is refunded. Call again with None in a finally block: a reservation
+    already settled is left alone, one cut short (cancelled, raised) is refunded.
+    """
+    spent = (isinstance(result, str) and bool(result) and not result.startswith("Error")
+             and not getattr(result, "coalesced", False) and not getattr(result, "cached", False)
+             and getattr(result, "backend", None) == bot_manager.backend.identity())
+    already = ticket.settled
+    quota.settle(ticket, spent)
+    if ticket.probe and not spent:
+        # The trial produced no upstream verdict; a failed one has re-opened the breaker already
+        ticket.probe = False
+        bot_manager.breaker.release_probe()
+    if spent and not already and ticket.remaining % 5 == 0:
+        print(f"[API] 📊 Hourly Quota: {ticket.limit - ticket.remaining}/{ticket.limit}")
+
+def quota_rejection(req, ticket):
+    req.outcome = "locked" if ticket.reason == "locked" else "quota_dropped"
+    headers = {"Retry-After": str(ticket.retry_after),
+               "X-Quota-Remaining": str(ticket.remaining), "X-Quota-Limit": str(ticket.limit)}
+    payload = {"status": "error", "error": ticket.reason, "message": QUOTA_MESSAGES[ticket.reason],
+               "retry_after": ticket.retry_after, "quota": {"remaining": ticket.remaining, "limit": ticket.limit}}
+    return json_response(payload, ticket.status, headers)
+
+def triage_text(item):
+    """Article text of a triage item: {"title", "content"}, {"prompt"} or a plain string."""
+    if not isinstance(item, dict):
+        return str(item)
+    if item.get('prompt'):
+        section = article_section(item['prompt'])
+        return section[0] if section else item['prompt']
+    return f"{item.get('title') or ''}\n{item.get('content') or ''}"
+
+def parse_min_score(value):
+    """A request's "min_score" as a float in [0, 1], None when absent; ValueError otherwise."""
+    if value is None:
+        return None
+    try:
+        if isinstance(value, bool):
+            raise TypeError
+        score = float(value)
+    except (TypeError, ValueError):
+        raise ValueError("min_score must be a number between 0 and 1") from None
+    if not 0 <= score <= 1:
+        raise ValueError("min_score must be a number between 0 and 1")
+    return score
+
+def triage_gate(req, data, prompt):
+    """
+    Inline pre-filter ("triage": true or {"min_score": x}): the skip response
+    when the local model expects no market impact (a 400 for a bad min_score),
+    else None. Runs after the cache lookups (those are free) and before
+    admission (which is not).
+    """
+    option = data.get('triage')
+    if not option:
+        return None
+    try:
+        min_score = parse_min_score(option.get('min_score') if isinstance(option, dict) else None)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+    section = article_section(prompt)
+    with span("triage"):
+        score, skip = triage.score([section[0] if section else prompt], min_score)[0]
+    trace_note(triage_score=score)
+    if not skip:
+        return None
+    req.outcome = "triaged"
+    return json_response({"status": "skipped", "reason": "triage",
+                          "message": "Local triage expects no market impact, not sent upstream.",
+                          "triage": {"score": score, "model": "naive_bayes" if triage.model else "keywords"}})
+
+def structured_response(answer, parsed, repairs, upstream_seconds):
+    payload = {"status": "success", "answer": answer, "parsed": parsed, "repairs": repairs, "backend": answer.backend}
+    headers = {"Server-Timing": f"upstream;dur={upstream_seconds * 1000:.1f}", "X-Backend": str(answer.backend)}
+    if answer.cached:
+        payload["cached"] = True
+    if answer.near_duplicate:
+        payload["near_duplicate"] = answer.near_duplicate
+        headers["X-Near-Duplicate-Of"] = str(answer.near_duplicate["source_request"])
+    return json_response(payload, headers=headers)
+
+async def ask_structured(req, data, prompt, response_format, use_cache, task, similar=True):
+    """/api/ask-gpt with response_format: extract, validate, and repair in the same chat if needed."""
+    key = structured_cache_key(prompt.strip(), response_format, bot_manager.backend.identity())
+    scope = response_format_fingerprint(response_format)
+    with span("cache"):
+        hit = bot_manager.cache.get(key) if use_cache else None
+    if hit is not None:
+        # Only answers that passed validation are stored under this key
+        return structured_response(Answer(hit[0], backend=hit[1], cached=True), json.loads(hit[0]), 0, 0.0)
+    near = bot_manager.similar_answer(prompt, scope) if use_cache and similar else None
+    if near is not None:
+        return structured_response(near, json.loads(near), 0, 0.0)
+    skipped = triage_gate(req, data, prompt)
+    if skipped is not None:
+        return skipped
+
+    client, priority = request_identity(req, data)
+    ticket = admit(client, priority)
+    if not ticket.allowed:
+        return quota_rejection(req, ticket)
+
+    repairs, upstream_seconds, last_answer = 0, 0.0, None
+    try:
+        async with scheduler.slot(client, priority):
+            result = await bot_manager.query_async(structured_prompt(prompt, response_format),
+                                                   cache_read=False, cache_write=False, task=task,
+                                                   allow_primary=ticket.primary)
+            settle_quota(ticket, result)
+
+            while isinstance(result, Answer):
+                last_answer = result
+                upstream_seconds += result.upstream_seconds
+                parsed, problems = check_structured(result, response_format)
+                if not problems or repairs >= response_format["max_repairs"]:
+                    break
+                ticket = admit(client, priority)
+                if not ticket.allowed:
+                    break
+                repairs += 1
+                chat = bot_manager.followup_chat(result)
+                print(f"[JSON] 🔧 Repair {repairs}/{response_format['max_repairs']} ({len(problems)} problem(s))")
+                EVENT_LOG.emit(EVENTS_LOG, "json_repair", schema=response_format["name"], round=repairs,
+                               same_chat=chat is not None, problems=problems[:8])
+                repair = build_repair_prompt(problems, response_format, None if chat is not None else str(result))
+                result = await bot_manager.followup_async(chat, repair, allow_primary=ticket.primary)
+                settle_quota(ticket, result)
+    finally:
+        settle_quota(ticket, None)
+
+    if last_answer is None:
+        # The first call already failed upstream: same body as a plain request
+        req.outcome = outcome_class(result)
+        return answer_response(result)
 
+    if problems:
+        STRUCTURED_TOTAL.inc("invalid")
+        req.outcome = "invalid_json"
+        message = "Answer did not match response_format: " + "; ".join(problems[:8])
+        if not isinstance(result, Answer):
+            message += f" (repair failed: {result})"
+        # 422, not 200: callers that only look at the status code must not take this as a result
+        return json_response({"status": "error", "message": message, "answer": last_answer,
+                              "schema_errors": problems, "repairs": repairs}, 422)
+
+    STRUCTURED_TOTAL.inc("repaired" if repairs else "valid")
+    req.outcome = "success"
+    impact = (parsed.get("article_info") or {}).get("has_market_impact") if isinstance(parsed, dict) else None
+    section = article_section(prompt)
+    if response_format["name"] == "news_analysis" and isinstance(impact, bool) and section:
+        # A labelled example for the triage model
+        triage.observe([(section[0], impact)])
+    text = json.dumps(parsed, ensure_ascii=False)
+    bot_manager.remember(prompt.strip(), key, text, last_answer.backend, scope)
+    return structured_response(Answer(text, backend=last_answer.backend), parsed, repairs, upstream_seconds)
+
+def request_prompt(data):
+    """
+    The prompt of a request body: "prompt"/"question", or a rendered "template" + "variables".
+    ValueError (TemplateError for template problems) when it isn't usable text.
+    """
+    if data.get('template') is not None:
+        return render_template(data['template'], data.get('variables') or {})
+    prompt = data.get('prompt') or data.get('question')
+    if prompt is not None and not isinstance(prompt, str):
+        raise ValueError("Prompt must be a string")
+    return prompt
+
+@route('/api/ask-gpt', methods=['POST'])
+async def api_ask(req):
+    data = req.json()
+    try:
+        prompt = request_prompt(data)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+    if not prompt:
+        return json_response({"error": "Missing prompt"}, 400)
+    if isinstance(prompt, TemplatePrompt) and 'response_format' not in data:
+        # A template can bring its own response_format; an explicit null turns it off
+        data['response_format'] = PROMPT_TEMPLATES[prompt.template].get("response_format")
+
+    # "cache": false skips the lookup but still refreshes the stored answer;
+    # "near_duplicates": false only skips reusing the answer of a similar article
+    use_cache = data.get('cache', True) is not False
+    similar = data.get('near_duplicates', True) is not False
+    fmt = stream_format(req, data)
     try:
-        data = request.get_json(silent=True) or {}
-        prompt = data.get('prompt') or data.get('question')
+        # "task" picks the chat pool, "stateless": true sends the prompt in a fresh chat
+        task = resolve_task(data, prompt)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+    if data.get('response_format') is not None:
+        try:
+            response_format = parse_response_format(data['response_format'])
+        except ResponseFormatError as e:
+            return json_response({"error": str(e)}, 400)
+        if fmt:
+            return json_response({"error": "response_format cannot be combined with stream"}, 400)
+        if response_format["name"] == "news_analysis" and 'task' not in data and task != ONESHOT_TASK:
+            task = "news"
+        return await ask_structured(req, data, prompt, response_format, use_cache, task, similar)
 
-        if not prompt:
-            return jsonify({"error": "Missing prompt"}), 400
+    cached = bot_manager.cached_answer(prompt, similar) if use_cache else None
+    if cached is not None:
+        # Served locally, no upstream call and no quota spent
+        if fmt:
+            async def replay(on_delta):
+                on_delta(str(cached))
+                return cached
+            return stream_response(fmt, replay, answer_payload)
+        return answer_response(cached)
+    if bot_manager.inflight_call(prompt) is not None:
+        # The same prompt is already on its way upstream: wait for that answer without
+        # taking a pacing token or a scheduler slot (streams get it as one chunk)
+        async def join(on_delta=None):
+            result = await bot_manager.join_inflight(prompt)
+            if result is None:
+                # Finished in between; the answer is cached now unless it failed
+                result = bot_manager.cached_answer(prompt, False) or Failure("Error: Coalesced call failed.", "error")
+            if on_delta is not None and isinstance(result, Answer):
+                on_delta(str(result))
+            req.outcome = outcome_class(result)
+            return result
+        if fmt:
+            return stream_response(fmt, join, answer_payload)
+        return answer_response(await join())
+    skipped = triage_gate(req, data, prompt)
+    if skipped is not None:
+        return skipped
 
-        result = bot_manager.query(prompt)
+    client, priority = request_identity(req, data)
+    # Admission happens before any waiting, so an over-budget caller gets its 429 at once
+    ticket = admit(client, priority)
+    if not ticket.allowed:
+        return quota_rejection(req, ticket)
 
-        if result and not result.startswith("Error"):
-            with QUOTA_LOCK:
-                SESSION_COUNTER += 1
-                if SESSION_COUNTER % 5 == 0:
-                    print(f"[API] 📊 Hourly Quota: {SESSION_COUNTER}/{MAX_HOURLY_REQUESTS}")
+    if fmt:
+        async def produce(on_delta):
+            try:
+                async with scheduler.slot(client, priority):
+                    result = await bot_manager.stream_async(prompt, on_delta, cache_read=False, task=task,
+                                                            allow_primary=ticket.primary)
+                settle_quota(ticket, result)
+            finally:
+                settle_quota(ticket, None)
+            req.outcome = outcome_class(result)
+            return result
+        return stream_response(fmt, produce, answer_payload)
 
-        return jsonify({"status": "success", "answer": result})
+    try:
+        async with scheduler.slot(client, priority):
+            result = await bot_manager.query_async(prompt, cache_read=False, task=task, allow_primary=ticket.primary)
+        settle_quota(ticket, result)
+        req.outcome = outcome_class(result)
+        return answer_response(result)
 
     except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
+        return json_response({"status": "error", "message": str(e)}, 500)
+    finally:
+        settle_quota(ticket, None)
+
+@route('/api/ask-gpt/batch', methods=['POST'])
+async def api_ask_batch(req):
+    data = req.json()
+    raw_items = data.get('items')
+    if raw_items is None and data.get('prompts') is not None:
+        prompts = data['prompts']
+        # A bare string would otherwise be iterated into one-character prompts
+        if not isinstance(prompts, list) or not all(isinstance(p, str) and p.strip() for p in prompts):
+            return json_response({"error": "prompts must be a list of non-empty strings"}, 400)
+        raw_items = [{"prompt": p} for p in prompts]
+    if not raw_items or not isinstance(raw_items, list):
+        return json_response({"error": "Missing items"}, 400)
+
+    use_cache = data.get('cache', True) is not False
+    similar = data.get('near_duplicates', True) is not False
+    client, priority = request_identity(req, data)
+    results = [None] * len(raw_items)
+    pending = []
+    for index, item in enumerate(raw_items):
+        prompt = (item.get('prompt') or item.get('question') or "") if isinstance(item, dict) else str(item)
+        client_id = item.get('id', index) if isinstance(item, dict) else index
+        if not isinstance(prompt, str):
+            results[index] = {"id": client_id, "status": "error", "message": "Prompt must be a string"}
+            continue
+        if not prompt.strip():
+            results[index] = {"id": client_id, "status": "error", "message": "Missing prompt"}
+            continue
+        cached = bot_manager.cached_answer(prompt, similar) if use_cache else None
+        if cached is not None:
+            results[index] = {"id": client_id, "status": "success", "answer": cached, "cached": True}
+            if cached.near_duplicate:
+                results[index]["near_duplicate"] = cached.near_duplicate
+        else:
+            results[index] = {"id": client_id, "status": "error", "message": "Not processed"}
+            pending.append((str(index), prompt))
+
+    # Items whose prompt is already in flight wait for that call instead of taking part in admission
+    joins = [(item_id, prompt) for item_id, prompt in pending if bot_manager.inflight_call(prompt) is not None]
+    if joins:
+        pending = [item for item in pending if item not in joins]
+        for (item_id, prompt), answer in zip(joins, await asyncio.gather(
+                *(bot_manager.join_inflight(prompt) for _, prompt in joins))):
+            if isinstance(answer, Answer):
+                results[int(item_id)].update(status="success", answer=answer, backend=answer.backend, coalesced=True)
+                results[int(item_id)].pop("message", None)
+            else:
+                # The call failed (or finished before we joined): the item goes out with the others
+                pending.append((item_id, prompt))
+
+    sent = set()  # item ids that went upstream at least once
+    upstream_calls = 0
+    rejected = None
+    for round_no in range(BATCH_RETRY_ROUNDS):
+        if not pending:
+            break
+        failed = []
+        for batch in pack_batches(pending):
+            ticket = admit(client, priority)
+            if not ticket.allowed:
+                rejected = ticket
+                for item_id, _ in batch:
+                    results[int(item_id)].update(status="error", retry_after=ticket.retry_after,
+                                                 message=f"Dropped ({ticket.reason})")
+                continue
+
+            try:
+                async with scheduler.slot(client, priority):
+                    if len(batch) == 1:
+                        # A lone item goes out as a plain prompt, no protocol overhead
+                        item_id, prompt = batch[0]
+                        answer = await bot_manager.query_async(prompt, cache_read=False, cache_write=False,
+                                                               allow_primary=ticket.primary)
+                        answers = {item_id: answer} if isinstance(answer, Answer) else {}
+                    else:
+                        # A packed batch is self-contained and large, it would only bloat a pooled chat
+                        answer = await bot_manager.query_async(build_batch_prompt(batch), cache_read=False,
+                                                               cache_write=False, task=ONESHOT_TASK,
+                                                               allow_primary=ticket.primary)
+                        answers = split_batch_answer(answer) if isinstance(answer, Answer) else {}
+                    upstream_calls += 1
+                    sent.update(item_id for item_id, _ in batch)
+                settle_quota(ticket, answer)
+            finally:
+                settle_quota(ticket, None)
+
+            for item_id, prompt in batch:
+                item_answer = answers.get(item_id)
+                if item_answer is not None and validate_item_answer(prompt, item_answer):
+                    results[int(item_id)].update(status="success", answer=item_answer, backend=answer.backend)
+                    results[int(item_id)].pop("message", None)
+                    bot_manager.remember(prompt.strip(), prompt_cache_key(prompt.strip(), bot_manager.backend.identity()),
+                                         item_answer, answer.backend)
+                else:
+                    reason = answer if not isinstance(answer, Answer) else "Missing or invalid item in batch answer"
+                    results[int(item_id)].update(status="error", message=reason)
+                    failed.append((item_id, prompt))
+
+        # Only the failed items go around again, re-packed into fresh batches
+        pending = failed
+        if pending and round_no + 1 < BATCH_RETRY_ROUNDS:
+            print(f"[BATCH] 🔁 Retrying {len(pending)} failed item(s).")
+
+    dropped = sum(1 for r in results if str(r.get("message", "")).startswith("Dropped ("))
+    print(f"[BATCH] 📦 {len(raw_items)} item(s), {len(sent)} sent upstream in {upstream_calls} call(s)"
+          + (f", {dropped} dropped by the limiter." if dropped else "."))
+    payload = {"status": "success", "upstream_calls": upstream_calls, "results": results}
+    if rejected is not None and not upstream_calls:
+        # Nothing could go upstream at all: tell the caller when to come back
+        req.outcome = "locked" if rejected.reason == "locked" else "quota_dropped"
+        payload.update(status="error", error=rejected.reason, retry_after=rejected.retry_after)
+        return json_response(payload, rejected.status, {"Retry-After": str(rejected.retry_after)})
+    return json_response(payload)
+
+class JobStream:
+    """Partial output of a running streaming job; lives on the manager loop."""
+    def __init__(self):
+        self.chunks = []
+        self.finished = False
+        self.changed = asyncio.get_running_loop().create_future()
+
+    def _wake(self):
+        if not self.changed.done():
+            self.changed.set_result(None)
+        self.changed = asyncio.get_running_loop().create_future()
+
+    def append(self, delta):
+        self.chunks.append(delta)
+        self._wake()
+
+    def finish(self):
+        self.finished = True
+        self._wake()
+
+JOB_STREAMS = {}
+
+async def process_job(job):
+    deadline = job["options"].get("deadline")
+    if deadline is not None:
+        # A job nobody waits for any more is dropped instead of sent upstream
+        CURRENT_DEADLINE.set(time.monotonic() + deadline - time.time())
+    try:
+        if job["options"].get("stream"):
+            stream = JOB_STREAMS.setdefault(job["id"], JobStream())
+            try:
+                return await within_deadline(run_job(job, stream.append))
+            finally:
+                stream.finish()
+                JOB_STREAMS.pop(job["id"], None)
+        return await within_deadline(run_job(job))
+    except DeadlineExceeded as e:
+        REQUESTS_ABANDONED_TOTAL.inc("deadline")
+        return "failed", f"Error: {e}"
+
+async def run_job(job, on_delta=None):
+    prompt = job["prompt"]
+    template = job["options"].get("template")
+    if template:
+        try:
+            prompt = render_template(template["name"], template["variables"])
+        except TemplateError:
+            # Template gone since the job was queued, the stored full text still works
+            pass
+    use_cache = job["options"].get("cache", True) is not False
+    if use_cache:
+        cached = bot_manager.cached_answer(prompt, job["options"].get("near_duplicates", True) is not False)
+        if cached is not None:
+            return "done", str(cached)
+
+    client = job["options"].get("client", "default")
+    priority = job["options"].get("priority", "normal")
+    ticket = admit(client, priority)
+    if not ticket.allowed:
+        # Stays queued; no worker picks it up again before the limiter's retry_after
+        return "queued", ticket.retry_after
+    task = job["options"].get("task")
+    try:
+        async with scheduler.slot(client, priority):
+            if on_delta is None:
+                result = await bot_manager.query_async(prompt, cache_read=False, task=task,
+                                                       allow_primary=ticket.primary)
+            else:
+                result = await bot_manager.stream_async(prompt, on_delta, cache_read=False, task=task,
+                                                        allow_primary=ticket.primary)
+        settle_quota(ticket, result)
+    finally:
+        settle_quota(ticket, None)
+    if isinstance(result, Answer):
+        return "done", str(result)
+    return "failed", result
+
+# Workers are plain threads; each job runs as a coroutine on the manager loop
+job_queue = JobQueue(lambda job: bot_manager.call(process_job(job)))
+
+@route('/api/jobs', methods=['POST'])
+async def api_submit_job(req):
+    data = req.json()
+    try:
+        prompt = request_prompt(data)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+    if not prompt:
+        return json_response({"error": "Missing prompt"}, 400)
+
+    client, priority = request_identity(req, data)
+    try:
+        options = {"cache": data.get('cache', True), "near_duplicates": data.get('near_duplicates', True),
+                   "client": client, "priority": priority,
+                   "stream": bool(data.get('stream')), "task": resolve_task(data, prompt)}
+        if data.get('expires_in') is not None:
+            # Seconds the result stays useful; a job still queued by then fails without going upstream
+            options["deadline"] = time.time() + float(data['expires_in'])
+        if isinstance(prompt, TemplatePrompt):
+            # The queue stores plain text, the worker re-renders to get the short turn back
+            options["template"] = {"name": prompt.template, "variables": data.get('variables')}
+        job_id, position = job_queue.submit(prompt, options)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+    except QueueFullError as e:
+        return json_response({"status": "error", "message": str(e)}, 503)
 
-@app.route('/', methods=['GET', 'POST'])
-def web_index():
+    return json_response({"status": "queued", "job_id": job_id, "position": position}, 202)
+
+@route('/api/jobs/<job_id>')
+async def api_get_job(req, job_id):
+    # ?wait=N long-polls up to N seconds for the job to finish
+    wait = min(max(req.arg_float('wait'), 0), JOB_MAX_WAIT_SECONDS)
+    job = await job_queue.wait(job_id, wait)
+    if job is None:
+        return json_response({"status": "error", "message": "Unknown job"}, 404)
+    return json_response(job)
+
+@route('/api/jobs/<job_id>/stream')
+async def api_stream_job(req, job_id):
+    # Jobs submitted with "stream": true forward partial output; others send one final chunk
+    job = job_queue.get(job_id)
+    if job is None:
+        return json_response({"status": "error", "message": "Unknown job"}, 404)
+    fmt = "jsonl" if req.args.get('format') in ("jsonl", "ndjson") else "sse"
+
+    async def produce(on_delta):
+        stream = JOB_STREAMS.get(job_id)
+        sent = 0
+        while True:
+            if stream is not None:
+                for delta in stream.chunks[sent:]:
+                    on_delta(delta)
+                sent = len(stream.chunks)
+            current = job_queue.get(job_id)
+            if current is None or current["status"] in ("done", "failed"):
+                if not sent and current and current.get("answer"):
+                    on_delta(current["answer"])
+                return current
+            stream = JOB_STREAMS.get(job_id)
+            try:
+                # Re-check the job row now and then, the worker finishes it from another thread
+                if stream is not None and not stream.finished:
+                    await asyncio.wait_for(asyncio.shield(stream.changed), 2.0)
+                else:
+                    await asyncio.sleep(0.5)
+            except asyncio.TimeoutError:
+                pass
+
+    return stream_response(fmt, produce, lambda job: job or {"status": "error", "message": "Unknown job"})
+
+@route('/api/scheduler')
+async def api_scheduler(req):
+    snapshot = scheduler.snapshot(MAX_HOURLY_REQUESTS, quota.usage())
+    snapshot["quota"] = quota.snapshot()
+    return json_response(snapshot)
+
+@route('/api/cache-stats')
+async def api_cache_stats(req):
+    return json_response(dict(bot_manager.cache.snapshot(), near_duplicates=bot_manager.near_dups.snapshot()))
+
+@route('/api/triage', methods=['POST'])
+async def api_triage(req):
+    """Scores articles locally (no upstream call, no quota) by how likely the analysis finds a market impact."""
+    data = req.json()
+    items = data.get('articles')
+    if not items or not isinstance(items, list):
+        return json_response({"error": "Missing articles"}, 400)
+    if len(items) > TRIAGE_MAX_BATCH:
+        return json_response({"error": f"At most {TRIAGE_MAX_BATCH} articles per call"}, 400)
+    try:
+        min_score = parse_min_score(data.get('min_score'))
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+    started = time.perf_counter()
+    verdicts = triage.score([triage_text(item) for item in items], min_score)
+    ranks = {index: rank for rank, index in enumerate(sorted(range(len(items)), key=lambda i: -verdicts[i][0]), 1)}
+    results = [{"id": item.get('id', index) if isinstance(item, dict) else index,
+                "score": score, "skip": skip, "rank": ranks[index]}
+               for index, (item, (score, skip)) in enumerate(zip(items, verdicts))]
+    return json_response({"status": "success", "scored_ms": round((time.perf_counter() - started) * 1000, 2),
+                          "model": triage.snapshot(), "results": results})
+
+@route('/api/triage/examples', methods=['POST'])
+async def api_triage_examples(req):
+    """Imports labelled articles ({"title", "content", "has_market_impact"}), e.g. from analyses stored elsewhere."""
+    data = req.json()
+    items = data.get('examples')
+    if not items or not isinstance(items, list):
+        return json_response({"error": "Missing examples"}, 400)
+    examples = [(triage_text(item), item['has_market_impact']) for item in items
+                if isinstance(item, dict) and isinstance(item.get('has_market_impact'), bool)]
+    # "refit": true fits the model before answering instead of in the background
+    await asyncio.to_thread(triage.observe, examples, bool(data.get('refit')))
+    return json_response({"status": "success", "added": len(examples), "model": triage.snapshot()})
+
+@route('/api/chats')
+async def api_chats(req):
+    return json_response(bot_manager.pool.snapshot())
+
+@route('/api/breaker')
+async def api_breaker(req):
+    return json_response(bot_manager.breaker.snapshot())
+
+@route('/api/backends')
+async def api_backends(req):
+    return json_response(dict(bot_manager.router.snapshot(), timeouts=bot_manager.latency.snapshot()))
+
+@route('/api/state')
+async def api_state(req):
+    return json_response(state_snapshot.snapshot())
+
+@route('/api/templates')
+async def api_templates(req):
+    return json_response({
+        name: {"variables": template_variables(t), "task": t.get("task"), "response_format": t.get("response_format")}
+        for name, t in PROMPT_TEMPLATES.items()
+    })
+
+@route('/debug/requests')
+async def debug_requests(req):
+    # Newest first; ?limit=N, ?route=/api/ask-gpt, ?min_ms=5000, ?outcome=timeout
+    limit = int(min(max(req.arg_float('limit', 50), 1), DEBUG_RING_SIZE))
+    entries = REQUEST_LOG.recent(limit, req.args.get('route'), req.arg_float('min_ms'), req.args.get('outcome'))
+    return json_response({"capacity": DEBUG_RING_SIZE, "slow_seconds": SLOW_REQUEST_SECONDS,
+                          "slow_logged": REQUEST_LOG.slow_total, "requests": entries})
+
+@route('/debug/requests/<req_id>')
+async def debug_request(req, req_id):
+    entry = REQUEST_LOG.find(req_id)
+    if entry is None:
+        return json_response({"status": "error", "message": "Unknown or expired request id"}, 404)
+    return json_response(entry)
+
+def cache_counters():
+    stats = bot_manager.cache.snapshot()
+    return {(name,): stats[name] for name in ("hits", "misses", "stores", "evictions")}
+
+METRICS.add(Callback("gateway_chat_sessions", "Pooled upstream chat sessions by task.",
+                     lambda: {(t,): len(ss) for t, ss in bot_manager.pool.sessions.items()}, ("task",)))
+METRICS.add(Callback("gateway_template_saved_chars_total", "Prompt chars not resent thanks to primed chats.",
+                     lambda: bot_manager.pool.saved_chars, kind="counter"))
+METRICS.add(Callback("gateway_chat_turns", "Turns sent in the busiest pooled chat of each task.",
+                     lambda: {(t,): max((x.turns for x in ss), default=0)
+                              for t, ss in bot_manager.pool.sessions.items()}, ("task",)))
+METRICS.add(Callback("gateway_chat_context_chars", "Largest accumulated context among a task's sessions.",
+                     lambda: {(t,): max((x.context_chars for x in ss), default=0)
+                              for t, ss in bot_manager.pool.sessions.items()}, ("task",)))
+METRICS.add(Callback("gateway_upstream_in_flight", "Distinct upstream calls in flight (after coalescing).",
+                     lambda: len(bot_manager.inflight)))
+METRICS.add(Callback("gateway_quota_remaining", "Upstream calls left in the rolling hour.",
+                     lambda: quota.snapshot()["remaining"]))
+METRICS.add(Callback("gateway_quota_tokens", "Calls the pacing token bucket would allow right now.",
+                     lambda: quota.snapshot()["tokens"]))
+METRICS.add(Callback("gateway_quota_limit", "Hourly upstream call budget.", lambda: quota.limit))
+METRICS.add(Callback("gateway_breaker_state", "Circuit breaker per error class: 0 closed, 1 half-open, 2 open.",
+                     lambda: {(k,): BREAKER_STATE_VALUES[b["state"]]
+                              for k, b in bot_manager.breaker.snapshot()["breakers"].items()}, ("kind",)))
+METRICS.add(Callback("gateway_backend_latency_seconds", "Router latency estimate (EWMA) per backend.",
+                     lambda: {(u.name,): u.expected_seconds() for u in bot_manager.router.upstreams}, ("backend",)))
+METRICS.add(Callback("gateway_backend_error_rate", "Router error rate estimate (EWMA) per backend.",
+                     lambda: {(u.name,): u.error_rate for u in bot_manager.router.upstreams}, ("backend",)))
+METRICS.add(Callback("gateway_upstream_timeout_seconds", "Current adaptive attempt timeout per backend and prompt size.",
+                     lambda: {(b, k): v["timeout"] for b, ks in bot_manager.latency.snapshot()["backends"].items()
+                              for k, v in ks.items()}, ("backend", "size")))
+METRICS.add(Callback("gateway_backend_budget_left", "Share of each backend's hourly budget still unused.",
+                     lambda: {(u.name,): u.budget_left() for u in bot_manager.router.upstreams}, ("backend",)))
+METRICS.add(Callback("gateway_breaker_retry_seconds", "Seconds until an open breaker lets a trial through.",
+                     lambda: {(k,): b["retry_in"] for k, b in bot_manager.breaker.snapshot()["breakers"].items()},
+                     ("kind",)))
+METRICS.add(Callback("gateway_scheduler_queued", "Requests waiting for a scheduler slot.",
+                     lambda: {(p,): len(scheduler.waiting[p]) for p in PRIORITY_CLASSES}, ("priority",)))
+METRICS.add(Callback("gateway_scheduler_free_slots", "Idle upstream slots.", lambda: scheduler.free))
+METRICS.add(Callback("gateway_cache_events_total", "Response cache lookups and writes.",
+                     cache_counters, ("event",), kind="counter"))
+METRICS.add(Callback("gateway_near_duplicate_entries", "Articles in the near-duplicate index.",
+                     lambda: len(bot_manager.near_dups.entries)))
+def job_counts():
+    counts = dict.fromkeys(("queued", "running", "done", "failed"), 0)
+    counts.update(job_queue.depth())
+    return {(status,): n for status, n in counts.items()}
+
+METRICS.add(Callback("gateway_jobs", "Jobs in the queue by status.", job_counts, ("status",)))
+METRICS.add(Callback("gateway_log_dropped_total", "Log records dropped because the writer queue was full.",
+                     lambda: EVENT_LOG.dropped_total, kind="counter"))
+
+@route('/metrics')
+async def api_metrics(req):
+    return ApiResponse(METRICS.render().encode("utf-8"), content_type=METRICS_CONTENT_TYPE)
+
+@route('/healthz')
+async def api_healthz(req):
+    # Liveness: answering at all means the manager loop is running
+    return json_response({"status": "ok", "uptime": round(time.time() - (bot_manager.started_at or time.time()), 1)})
+
+@route('/readyz')
+async def api_readyz(req):
+    # Readiness: route traffic here only once the first request will be fast
+    ready, reasons = bot_manager.readiness()
+    payload = {"status": "ready" if ready else "not_ready", "backend": bot_manager.backend.identity()}
+    if reasons:
+        payload["reasons"] = reasons
+    return json_response(payload, 200 if ready else 503)
+
+@route('/', methods=['GET', 'POST'])
+async def web_index(req):
     answer, error, question = "", "", ""
-    if request.method == 'POST':
-        question = request.form.get('question', '')
-        answer = bot_manager.query(question)
-        if answer.startswith("Error"):
-            error, answer = answer, ""
-    return render_template_string(HTML_TEMPLATE, answer=answer, question=question, error=error)
+    if req.method == 'POST':
+        question = req.form().get('question', '')
+        answer = bot_manager.cached_answer(question) if question.strip() else None
+        if answer is None and question.strip():
+            # Same admission as /api/ask-gpt: breaker (one half-open trial at a time), then quota
+            client, priority = scheduler.resolve("web", priority="interactive")
+            ticket = admit(client, priority)
+            if not ticket.allowed:
+                req.outcome = "locked" if ticket.reason == "locked" else "quota_dropped"
+                error = f"{QUOTA_MESSAGES[ticket.reason]} Retry in {ticket.retry_after}s."
+                answer = ""
+            else:
+                try:
+                    async with scheduler.slot(client, priority):
+                        answer = await bot_manager.query_async(question, cache_read=False, task="question",
+                                                               allow_primary=ticket.primary)
+                    settle_quota(ticket, answer)
+                finally:
+                    settle_quota(ticket, None)
+        if answer:
+            req.outcome = outcome_class(answer)
+            if answer.startswith("Error"):
+                error, answer = answer, ""
+    html = HTML_PAGE.render(answer=answer, question=question, error=error)
+    return ApiResponse(html.encode("utf-8"), content_type="text/html; charset=utf-8")
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -530,7 +4926,7 @@ HTML_TEMPLATE = """
     <div class="container" style="max-width: 800px;">
         <h2 class="mb-4">🤖 Gemini API</h2>
         <div class="card p-3 mb-4">
-            <h5>🧪 Stress Test Control</h5>
+            <h5>🧪 Benchmark Control</h5>
             <div class="d-flex gap-2">
                 <button onclick="fetch('/api/test-limit', {method:'POST'}).then(r=>r.json()).then(d=>alert(d.message))" class="btn btn-warning">Start Test</button>
                 <button onclick="fetch('/api/stop-test', {method:'POST'}).then(r=>r.json()).then(d=>alert(d.message))" class="btn btn-danger">Stop Test</button>
@@ -547,6 +4943,197 @@ HTML_TEMPLATE = """
 </html>
 """
 
+HTML_PAGE = jinja2.Environment(autoescape=True).from_string(HTML_TEMPLATE)
+
+# ==================================================================================
+# [FLASK] APP SETUP
+# ==================================================================================
+app = Flask(__name__)
+log = logging.getLogger('werkzeug')
+log.setLevel(logging.ERROR)
+
+def flask_view(handler):
+    def view(**params):
+        req = ApiRequest(request.method, request.path, dict(request.headers),
+                         request.args.to_dict(), request.get_data(), request.host_url)
+        # One hop from the WSGI worker thread onto the manager loop per request
+        resp = bot_manager.call(handler(req, **params))
+        body = flask_stream(resp.stream) if resp.stream is not None else resp.body
+        return Response(body, status=resp.status, headers=resp.headers, content_type=resp.content_type)
+    view.__name__ = handler.__name__
+    return view
+
+def flask_stream(agen):
+    """Pulls an async body stream from the manager loop into a WSGI generator."""
+    try:
+        while True:
+            chunk = bot_manager.call(next_chunk(agen))
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        # Runs on client disconnect too: closing the stream cancels the upstream work
+        bot_manager.call(agen.aclose())
+
+for path, methods, handler in ROUTES:
+    app.add_url_rule(path, handler.__name__, flask_view(handler), methods=list(methods))
+
+# ==================================================================================
+# [ASGI] APP SETUP
+# ==================================================================================
+# python3 my-ai-webserver.py --asgi serves asgi_app with uvicorn on bot_manager.loop:
+# handlers and upstream calls share one event loop, no thread per in-flight request.
+ASGI_ROUTES = [
+    (re.compile("^" + re.sub(r"<(\w+)>", r"(?P<\1>[^/]+)", path) + "$"), methods, handler)
+    for path, methods, handler in ROUTES
+]
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # Served by an external ASGI server: nothing ran at import, start up now
+                startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    resp = None
+    allowed = False
+    for pattern, methods, handler in ASGI_ROUTES:
+        match = pattern.match(scope["path"])
+        if not match:
+            continue
+        allowed = True
+        if scope["method"] not in methods:
+            continue
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]}
+        args = {k: v[0] for k, v in parse_qs(scope.get("query_string", b"").decode("latin-1")).items()}
+        base_url = f"{scope.get('scheme', 'http')}://{headers.get('host', 'localhost')}/"
+        req = ApiRequest(scope["method"], scope["path"], headers, args, body, base_url)
+        coro = handler(req, **match.groupdict())
+        if asyncio.get_running_loop() is bot_manager.loop:
+            handling = asyncio.ensure_future(coro)
+        else:
+            # Served by an external ASGI server on its own loop
+            handling = asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, bot_manager.loop))
+        # A client that hangs up before the answer is ready cancels the work behind it
+        watcher = asyncio.ensure_future(wait_disconnect(receive))
+        try:
+            await asyncio.wait({handling, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            watcher.cancel()
+            abandoned = not handling.done()
+            if abandoned:
+                handling.cancel()
+        if abandoned:
+            return
+        resp = handling.result()
+        break
+
+    if resp is None:
+        resp = json_response({"error": "Method not allowed" if allowed else "Not found"}, 405 if allowed else 404)
+
+    headers = [(b"content-type", resp.content_type.encode("latin-1"))]
+    headers += [(k.lower().encode("latin-1"), str(v).encode("latin-1")) for k, v in resp.headers.items()]
+    await send({"type": "http.response.start", "status": resp.status, "headers": headers})
+    if resp.stream is None:
+        await send({"type": "http.response.body", "body": resp.body})
+        return
+    await asgi_stream(resp.stream, receive, send)
+
+
+async def wait_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def asgi_stream(agen, receive, send):
+    # A client that goes away stops the stream, which cancels the upstream work
+    watcher = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        while True:
+            pending = asyncio.ensure_future(next_chunk(agen))
+            await asyncio.wait({pending, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not pending.done():
+                pending.cancel()
+                break
+            chunk = pending.result()
+            if chunk is None:
+                await send({"type": "http.response.body", "body": b""})
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    finally:
+        watcher.cancel()
+        await agen.aclose()
+
+
+# ==================================================================================
+# [SETUP] STARTUP
+# ==================================================================================
+# Importing this module does no work: no cookie conversion, no files opened, no
+# threads. startup() does all of it once; the client warms up in the background
+# while /readyz answers 503.
+STARTED = False
+
+state_snapshot = StateSnapshot(bot_manager.loop)
+state_snapshot.register("chats", bot_manager.dump_chats, bot_manager.load_chats, on_loop=True)
+state_snapshot.register("router", bot_manager.router.dump_state, bot_manager.router.load_state, on_loop=True)
+state_snapshot.register("timeouts", bot_manager.latency.dump_state, bot_manager.latency.load_state, on_loop=True)
+state_snapshot.register("near_duplicates", bot_manager.near_dups.dump_state, bot_manager.near_dups.load_state)
+state_snapshot.register("cache_hot_set", bot_manager.cache.dump_state, bot_manager.cache.load_state)
+
+def startup(prewarm=True):
+    global STARTED
+    if STARTED:
+        return
+    STARTED = True
+    if bot_manager.backend.name == "gemini":
+        if GeminiClient is None:
+            print(f"[CRITICAL] Import failed: {GEMINI_IMPORT_ERROR}")
+            sys.exit(1)
+        convert_netscape_to_json()
+    quota.open()
+    triage.open()
+    bot_manager.start()
+    # Before anything can take a chat from the pool or trip a breaker
+    state_snapshot.restore()
+    job_queue.start()
+    if prewarm:
+        bot_manager.prewarm()
+    state_snapshot.start()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gemini gateway")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--asgi", action="store_true", help="serve with uvicorn on the manager event loop")
+    parser.add_argument("--no-prewarm", action="store_true", help="initialise the client on the first request")
+    args = parser.parse_args(argv)
+
+    startup(prewarm=not args.no_prewarm)
+    print(f"[SYS] Server starting at http://localhost:{args.port}")
+    if args.asgi:
+        if uvicorn is None:
+            print("[CRITICAL] --asgi needs uvicorn (pip install uvicorn)")
+            sys.exit(1)
+        config = uvicorn.Config(asgi_app, host=args.host, port=args.port, log_level="warning")
+        bot_manager.run_in_foreground(uvicorn.Server(config).serve())
+    else:
+        app.run(host=args.host, port=args.port, debug=False)
+
 if __name__ == '__main__':
-    print("[SYS] Server starting at http://localhost:5000")
-    app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+    main()
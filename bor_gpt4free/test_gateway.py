@@ -0,0 +1,1067 @@
+"""
+Regression tests for my-ai-webserver.py. Importing the gateway has no side
+effects (no files, threads or network), so everything runs in-process against
+the stub backend:  python -m pytest -q test_gateway.py
+"""
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import pytest
+
+os.environ.setdefault("GATEWAY_BACKEND", "stub")
+_spec = importlib.util.spec_from_file_location(
+    "gateway", os.path.join(os.path.dirname(os.path.abspath(__file__)), "my-ai-webserver.py"))
+gateway = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(gateway)
+import bench_gateway as bench  # noqa: E402
+
+
+def on_loop(fn, *args):
+    """Runs fn on the manager loop, where the pool and the in-flight table live."""
+    async def run():
+        return fn(*args)
+    return gateway.bot_manager.call(run())
+
+
+@pytest.fixture(scope="module", autouse=True)
+def workdir(tmp_path_factory):
+    """Every test runs in a temp dir: the SQLite files and event logs the gateway writes land there."""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("gateway"))
+    yield
+    gateway.EVENT_LOG.flush()
+    os.chdir(cwd)
+
+
+@pytest.fixture(scope="module")
+def started(workdir):
+    """Flask test client on a started manager."""
+    gateway.quota.open()
+    gateway.bot_manager.start()
+    return gateway.app.test_client()
+
+
+@pytest.fixture
+def client(started):
+    """The shared client with a full quota, so a test doesn't depend on what ran before it."""
+    with gateway.quota.lock:
+        gateway.quota.tokens = gateway.quota.burst
+        gateway.quota.events.clear()
+    return started
+
+
+def test_refused_job_backs_off_across_workers(tmp_path):
+    calls = []
+
+    def refuse(job):
+        calls.append(time.monotonic())
+        return "queued", 0.5
+
+    queue = gateway.JobQueue(refuse, path=str(tmp_path / "jobs.sqlite3"), workers=2)
+    queue.start()
+    try:
+        job_id, _ = queue.submit("hello")
+        time.sleep(1.2)
+    finally:
+        queue.stop()
+    # Tried at 0, 0.5 and 1.0s, not passed back and forth between the two workers
+    assert 2 <= len(calls) <= 3
+    assert all(b - a >= 0.45 for a, b in zip(calls, calls[1:]))
+    assert queue.get(job_id)["status"] in ("queued", "running")
+
+
+@pytest.mark.parametrize("value", [12, ["x"], {"text": "x"}])
+def test_non_string_prompt_is_a_json_400(client, value):
+    for path in ("/api/ask-gpt", "/api/jobs"):
+        resp = client.post(path, json={"question": value})
+        assert resp.status_code == 400
+        assert resp.get_json() == {"error": "Prompt must be a string"}
+    resp = client.post("/api/ask-gpt/batch", json={"items": [{"prompt": value}]})
+    assert resp.get_json()["results"][0]["message"] == "Prompt must be a string"
+
+
+def test_quota_writes_are_batched_and_survive_reopen(tmp_path):
+    path = str(tmp_path / "quota.sqlite3")
+    quota = gateway.QuotaLimiter(10, burst=5, path=path)
+    quota.open()
+    tickets = [quota.acquire() for _ in range(3)]
+    assert all(t.allowed for t in tickets)
+    quota.settle(tickets[0], spent=False)
+    quota.flush()
+
+    reopened = gateway.QuotaLimiter(10, burst=5, path=path)
+    reopened.open()
+    assert [e[1] for e in reopened.events] == [t.event_id for t in tickets[1:]]
+    assert round(reopened.tokens) == 3
+
+
+def test_busy_chat_is_never_shared():
+    pool = gateway.ChatPool(per_task=2)
+    client = gateway.StubClient(gateway.StubBackend())
+    leased = [pool.lease(client, "news") for _ in range(3)]
+    assert len({id(s.chat) for s in leased}) == 3
+    assert len(pool.sessions["news"]) == 2 and leased[2] not in pool.sessions["news"]
+    for session in leased:
+        pool.release(session, 10, 10, 0.1)
+    assert pool.lease(client, "news") in leased[:2]
+
+
+def test_web_form_goes_through_admission(client):
+    breaker = gateway.bot_manager.breaker
+    breaker.record_failure("503", "503 Service Unavailable")
+    try:
+        resp = client.post("/", data={"question": "Is the form admitted?"})
+    finally:
+        breaker.record_success()
+    page = resp.get_data(as_text=True)
+    assert "Upstream circuit open" in page and "Retry in" in page
+
+
+def test_saved_chats_survive_a_request_before_prewarm():
+    client = gateway.StubClient(gateway.StubBackend())
+    before = gateway.ChatPool(per_task=2)
+    for _ in range(2):
+        session = before.lease(client, "news")
+        session.chat.turns, session.chat.context_chars = 4, 4000
+    state = before.dump_state()
+
+    pool = gateway.ChatPool(per_task=2)
+    pool.load_state(state)
+    # A request lands on the new client before prewarm gets to warm()
+    first = pool.lease(client, "news")
+    pool.release(first, 100, 100, 0.1)
+    pool.warm(client)
+    assert pool.resumed == 2 and not pool.saved["news"]
+    # Both conversations continue (the request took one of them), no fresh chat was opened
+    assert [s.chat.context_chars for s in pool.sessions["news"]] == [4000, 4000]
+    assert first in pool.sessions["news"]
+
+
+def test_metrics_report_chat_turns_per_task(client):
+    pool = gateway.bot_manager.pool
+    session = gateway.ChatSession("news", None, gateway.StubChat(gateway.StubBackend()))
+    session.turns = 7
+    pool.sessions["news"].append(session)
+    try:
+        body = client.get("/metrics").get_data(as_text=True)
+    finally:
+        pool.sessions["news"].remove(session)
+    assert 'gateway_chat_turns{task="news"} 7' in body
+
+
+def test_quota_works_in_memory_before_open():
+    quota = gateway.QuotaLimiter(10, burst=2, path=None)
+    first, second, third = (quota.acquire(priority="interactive") for _ in range(3))
+    assert first.allowed and second.allowed and first.event_id != second.event_id
+    assert not third.allowed and third.reason == "rate"
+    quota.settle(first, spent=False)
+    quota.flush()
+    assert quota.snapshot()["used"] == 1
+
+
+def test_identical_request_joins_inflight_call_without_admission(client):
+    import threading
+    prompt = "Coalescing check: what moved the DAX today?"
+    first = {}
+    leader = threading.Thread(target=lambda: first.update(resp=client.post("/api/ask-gpt", json={"question": prompt})))
+    leader.start()
+    deadline = time.time() + 5
+    while on_loop(gateway.bot_manager.inflight_call, prompt) is None:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    quota = gateway.quota
+    with quota.lock:
+        saved, quota.tokens = quota.tokens, 0.0
+    try:
+        follower = client.post("/api/ask-gpt", json={"question": prompt})
+    finally:
+        with quota.lock:
+            quota.tokens = saved
+    leader.join()
+    assert follower.status_code == 200 and follower.get_json()["coalesced"] is True
+    assert first["resp"].get_json()["answer"] == follower.get_json()["answer"]
+
+
+@pytest.mark.parametrize("min_score", ["high", [0.5], True, -0.1, 1.5])
+def test_bad_triage_min_score_is_a_json_400(client, min_score):
+    article = {"title": "Fed hikes", "content": "Rates rise by 50bp."}
+    resp = client.post("/api/triage", json={"articles": [article], "min_score": min_score})
+    assert resp.status_code == 400 and "min_score" in resp.get_json()["error"]
+    resp = client.post("/api/ask-gpt", json={"template": "news_analysis", "variables": article,
+                                             "triage": {"min_score": min_score}})
+    assert resp.status_code == 400 and "min_score" in resp.get_json()["error"]
+
+
+def test_triage_min_score_overrides_threshold(client):
+    resp = client.post("/api/triage", json={"articles": ["Fed hikes rates"], "min_score": "1"})
+    assert resp.status_code == 200 and resp.get_json()["results"][0]["skip"] is True
+
+
+@pytest.mark.parametrize("body", [{"prompts": "What is 2+2?"}, {"prompts": ["ok", 42]},
+                                  {"prompts": ["ok", "  "]}, {"prompts": []}, {"items": "What is 2+2?"}])
+def test_bad_batch_prompts_are_a_json_400(client, body):
+    resp = client.post("/api/ask-gpt/batch", json=body)
+    assert resp.status_code == 400 and "error" in resp.get_json()
+
+
+def test_batch_prompts_answer_each_item(client):
+    resp = client.post("/api/ask-gpt/batch", json={"prompts": ["What is 2+2?", "Name a prime."]})
+    body = resp.get_json()
+    assert resp.status_code == 200
+    assert [r["status"] for r in body["results"]] == ["success", "success"]
+
+
+def test_structured_answer_that_stays_invalid_is_a_422(client):
+    schema = {"type": "object", "required": ["answer"], "properties": {"answer": {"type": "string"}}}
+    resp = client.post("/api/ask-gpt", json={"prompt": "Reply in JSON", "response_format": {
+        "type": "json_schema", "schema": schema, "max_repairs": 0}})
+    body = resp.get_json()
+    assert resp.status_code == 422
+    assert body["status"] == "error" and body["schema_errors"] and body["repairs"] == 0
+
+
+def stub_outcomes(backend, prompts):
+    async def run():
+        results = []
+        for prompt in prompts:
+            try:
+                results.append(await backend.generate(prompt))
+            except Exception as e:
+                results.append(f"raised {e}")
+        return results
+    return asyncio.run(run())
+
+
+def test_stub_backend_replays_the_same_outcomes_for_a_seed():
+    config = dict(latency_dist="fixed", latency_mean=0.0, error_rates={"429": 0.2, "content": 0.1}, seed=7)
+    prompts = [f"question {i}" for i in range(40)]
+    first = stub_outcomes(gateway.create_backend("stub", **config), prompts)
+    assert first == stub_outcomes(gateway.create_backend("stub", **config), prompts)
+    assert first != stub_outcomes(gateway.create_backend("stub", **dict(config, seed=8)), prompts)
+    errors = [r for r in first if r.startswith("raised")]
+    assert errors and len(errors) < len(prompts)
+    assert {gateway.upstream_error_kind(e.lower()) for e in errors} <= {"429", "content_failure"}
+
+
+def test_stub_backend_rejects_unknown_settings():
+    with pytest.raises(ValueError):
+        gateway.create_backend("stub", error_rates={"418": 0.5})
+    with pytest.raises(ValueError):
+        gateway.create_backend("stub", latency_dist="pareto")
+
+
+def test_bench_report_percentiles_and_outcomes():
+    assert bench.percentile([], 50) is None
+    assert bench.percentile([5, 1, 4, 2, 3], 50) == 3
+    assert bench.percentile(list(range(1, 101)), 95) == 95
+    timing = "cache;dur=0.5, upstream;dur=1500;desc=\"gemini\", bad;dur=x, total;dur=1600"
+    assert bench.parse_server_timing(timing) == {"cache": 0.0005, "upstream": 1.5, "total": 1.6}
+    assert bench.classify_answer({"answer": "Paris"}) == "success"
+    assert bench.classify_answer({"answer": "Error: 429 Too Many Requests"}) == "429"
+    assert bench.classify_answer({"answer": "Error: upstream circuit open (503)"}) == "locked"
+    assert bench.classify_answer({}) == "quota_dropped"
+
+    samples = [{"outcome": "success", "latency": 2.0, "upstream": 1.5, "backend": "stub"},
+               {"outcome": "429", "latency": 1.0, "upstream": None}]
+    report = bench.build_report({}, samples, wall_time=2.0)
+    assert report["outcomes"] == {"success": 1, "429": 1} and report["backends"] == {"stub": 1}
+    assert report["success_rps"] == 0.5 and report["gateway_overhead"]["mean"] == 0.5
+
+
+def test_bench_workload_is_seeded():
+    payloads = [bench.make_payload(random.Random(3), "mixed", (300, 600)) for _ in range(2)]
+    assert payloads[0] == payloads[1]
+    item = bench.make_payload(random.Random(3), "news", (300, 600), use_template=True)
+    assert item["template"] == "news_analysis" and len(item["variables"]["content"]) <= 600
+
+
+def test_cache_memory_tier_is_lru_and_expires():
+    cache = gateway.ResponseCache(path=None, ttl=60, memory_entries=2)
+    cache.put("a", "answer a", "stub")
+    cache.put("b", "answer b")
+    assert cache.get("a") == ("answer a", "stub")
+    cache.put("c", "answer c")  # "b" is now the least recently used
+    assert cache.get("b") is None and cache.get("a") is not None and cache.get("c") is not None
+
+    answer, backend, _ = cache.memory["a"]
+    cache.memory["a"] = (answer, backend, time.time() - 61)
+    assert cache.get("a") is None and "a" not in cache.memory
+    stats = cache.snapshot()
+    assert (stats["hits"], stats["misses"], stats["memory_entries"]) == (3, 2, 1)
+
+
+def test_cache_disk_tier_survives_reopen_and_evicts_least_recently_hit(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = gateway.ResponseCache(path=path, disk_bytes=25)
+    cache.open()
+    cache.put("old", "x" * 10)
+    cache.put("new", "y" * 10)
+    time.sleep(0.01)
+    assert cache.get("old") is not None
+    assert cache.touched and "old" in cache.touched
+    cache.flush_touched()
+    assert not cache.touched
+    cache.put("third", "z" * 10)  # over 25 bytes: "new" was hit least recently
+
+    reopened = gateway.ResponseCache(path=path)
+    reopened.open()
+    assert reopened.get("new") is None
+    assert reopened.get("old") == ("x" * 10, None) and reopened.get("third") is not None
+    assert reopened.snapshot()["disk_hits"] == 2
+
+
+def test_repeated_question_is_served_from_cache(client):
+    first = client.post("/api/ask-gpt", json={"question": "Who   wrote Hamlet?"}).get_json()
+    again = client.post("/api/ask-gpt", json={"question": "Who wrote Hamlet?"}).get_json()
+    assert first["status"] == "success" and not first.get("cached")
+    assert again["cached"] is True and again["answer"] == first["answer"]
+
+
+def test_concurrent_identical_prompts_share_one_upstream_call(client):
+    manager = gateway.bot_manager
+    prompt = "Name three types of clouds."
+
+    async def ask_three():
+        calls = manager.backend.calls
+        results = await asyncio.gather(*(manager.query_async(p, cache_read=False)
+                                         for p in (prompt, prompt + "  ", "  " + prompt)))
+        return results, manager.backend.calls - calls
+
+    results, upstream = manager.call(ask_three())
+    assert upstream == 1 and len(set(results)) == 1
+    # Exactly one caller pays for the call, the others are marked as coalesced
+    assert sorted(r.coalesced for r in results) == [False, True, True]
+    assert not manager.inflight
+
+
+def test_call_is_cancelled_once_every_waiter_gives_up(client):
+    manager = gateway.bot_manager
+
+    async def abandon():
+        waiter = asyncio.ensure_future(manager.query_async("Explain how a rainbow is formed.", cache_read=False))
+        await asyncio.sleep(0)
+        (call,) = manager.inflight.values()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        await asyncio.wait([call], timeout=1)
+        return call.cancelled()
+
+    assert manager.call(abandon()) is True
+
+
+def test_batches_pack_short_prompts_and_split_back_per_item():
+    items = [("0", "a" * 100), ("1", "b" * 100), ("2", "c" * 500), ("3", "d" * 50)]
+    assert [[i for i, _ in b] for b in gateway.pack_batches(items, max_items=2, max_chars=300)] == \
+        [["0", "1"], ["2"], ["3"]]
+    assert len(gateway.pack_batches(items, max_items=8, max_chars=10000)) == 1
+
+    prompt = gateway.build_batch_prompt([("0", " first "), ("7", "second")])
+    assert "<<<TASK 0>>>\nfirst\n<<<END TASK 0>>>" in prompt
+    answer = "<<<ITEM 7>>>\n two \n<<<END 7>>>\nnoise\n<<<ITEM 0>>> one <<<END 0>>>\n<<<ITEM 9>>> cut off"
+    assert gateway.split_batch_answer(answer) == {"7": "two", "0": "one"}
+
+
+def test_batch_item_answers_are_validated_one_by_one():
+    assert gateway.validate_item_answer("Who wrote Hamlet?", "Shakespeare")
+    assert not gateway.validate_item_answer("Who wrote Hamlet?", "Error: 429")
+    assert not gateway.validate_item_answer("return in json", "no braces here")
+    assert gateway.validate_item_answer("return in json", 'Sure: {"markets": []} done')
+
+
+def test_stub_backend_answers_each_batch_task():
+    backend = gateway.create_backend("stub", latency_dist="fixed", latency_mean=0.0)
+    prompt = gateway.build_batch_prompt([("0", "first"), ("1", "second")])
+    (answer,) = stub_outcomes(backend, [prompt])
+    assert sorted(gateway.split_batch_answer(answer)) == ["0", "1"]
+
+
+def test_jobs_finish_in_order_and_survive_a_restart(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    queue = gateway.JobQueue(lambda job: None, path=path, max_queued=2)
+    queue.open()
+    first, position = queue.submit("first")
+    second, _ = queue.submit("second")
+    assert position == 1 and queue.get(second)["position"] == 2
+    with pytest.raises(gateway.QueueFullError):
+        queue.submit("third")
+    assert queue._claim()["id"] == first  # a worker dies with the job running
+
+    seen = []
+
+    def handler(job):
+        seen.append(job["prompt"])
+        return ("failed", "Error: boom") if job["prompt"] == "second" else ("done", job["prompt"].upper())
+
+    restarted = gateway.JobQueue(handler, path=path, workers=1)
+    restarted.start()
+    try:
+        finished = asyncio.run(restarted.wait(second, 5))
+    finally:
+        restarted.stop()
+    assert seen == ["first", "second"]
+    assert restarted.get(first)["answer"] == "FIRST"
+    assert finished["status"] == "failed" and finished["error"] == "Error: boom"
+    assert restarted.depth() == {"done": 1, "failed": 1}
+
+
+def test_job_handler_exception_fails_the_job(tmp_path):
+    def handler(job):
+        raise RuntimeError("no client")
+
+    queue = gateway.JobQueue(handler, path=str(tmp_path / "jobs.sqlite3"), workers=1)
+    queue.start()
+    try:
+        job_id, _ = queue.submit("hello")
+        job = asyncio.run(queue.wait(job_id, 5))
+    finally:
+        queue.stop()
+    assert job["status"] == "failed" and job["error"] == "Error: no client"
+
+
+def test_job_api_runs_a_prompt_to_completion(client):
+    gateway.job_queue.start()
+    try:
+        resp = client.post("/api/jobs", json={"question": "What is the capital of Australia?"})
+        assert resp.status_code == 202
+        job_id = resp.get_json()["job_id"]
+        job = client.get(f"/api/jobs/{job_id}?wait=10").get_json()
+    finally:
+        gateway.job_queue.stop()
+    assert job["status"] == "done" and job["answer"].startswith("[stub")
+    assert client.get("/api/jobs/nope").status_code == 404
+
+
+SCHEDULER_CLIENTS = {"ui": {"weight": 1, "priority": "interactive"},
+                     "heavy": {"weight": 3, "priority": "bulk"}, "light": {"weight": 1, "priority": "bulk"}}
+
+
+def dispatch_order(scheduler, requests):
+    """Queues (client, priority) requests behind one held slot; returns the order they get it."""
+    async def run():
+        order = []
+
+        async def call(n, client, priority):
+            async with scheduler.slot(client, priority):
+                order.append(n)
+
+        await scheduler.acquire("ui", "interactive")
+        calls = [asyncio.ensure_future(call(n, *r)) for n, r in enumerate(requests)]
+        await asyncio.sleep(0)
+        scheduler.release()
+        await asyncio.gather(*calls)
+        return order
+    return asyncio.run(run())
+
+
+def test_scheduler_serves_urgent_classes_first_and_weights_clients():
+    scheduler = gateway.FairScheduler(SCHEDULER_CLIENTS, slots=1)
+    order = dispatch_order(scheduler, [("heavy", "bulk")] * 6 + [("light", "bulk")] * 2 + [("ui", "interactive")])
+    assert order[0] == 8
+    # Weight 3 against 1: the light client's calls are spread out, not queued behind all six
+    assert order.index(6) < 5 and order.index(7) > order.index(6)
+    assert scheduler.free == 1 and scheduler.snapshot(90, {})["classes"]["bulk"]["dispatched"] == 8
+
+
+def test_cancelled_waiter_does_not_count_against_its_client():
+    scheduler = gateway.FairScheduler(SCHEDULER_CLIENTS, slots=1)
+
+    async def run():
+        await scheduler.acquire("ui", "interactive")
+        waiter = asyncio.ensure_future(scheduler.acquire("light", "bulk"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        scheduler.release()
+    asyncio.run(run())
+    assert ("bulk", "light") not in scheduler.last_finish and scheduler.free == 1
+
+
+def test_scheduler_resolves_identity_and_shares_the_budget():
+    scheduler = gateway.FairScheduler(SCHEDULER_CLIENTS)
+    assert scheduler.resolve("heavy", priority="interactive") == ("heavy", "bulk")
+    assert scheduler.resolve("ui", priority="bulk") == ("ui", "bulk")
+    assert scheduler.resolve("stranger") == ("default", "normal")
+    assert scheduler.share("heavy", 60) == 30
+    assert scheduler.may_spend("heavy", 60, used_total=40, usage={"heavy": 40})
+    # Borrowing stops while the idle interactive client's reserve would be eaten into
+    assert not scheduler.may_spend("heavy", 60, used_total=57, usage={"heavy": 57})
+
+
+def asgi_request(method, path, body=b"", disconnect=False):
+    """Drives asgi_app from its own loop, as an external ASGI server would; returns (status, body)."""
+    async def run():
+        messages = [{"type": "http.request", "body": body}]
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            if disconnect:
+                return {"type": "http.disconnect"}
+            await asyncio.sleep(3600)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": method, "path": path, "query_string": b"",
+                 "headers": [(b"content-type", b"application/json")]}
+        await gateway.asgi_app(scope, receive, send)
+        if not sent:
+            return None, None
+        return sent[0]["status"], b"".join(m.get("body", b"") for m in sent[1:])
+    return asyncio.run(run())
+
+
+def test_asgi_app_serves_the_same_routes(client):
+    status, body = asgi_request("POST", "/api/ask-gpt", json.dumps({"question": "Write a haiku about coding."}).encode())
+    assert status == 200 and json.loads(body)["status"] == "success"
+    assert asgi_request("GET", "/healthz")[0] == 200
+    assert asgi_request("GET", "/api/ask-gpt")[0] == 405
+    assert asgi_request("GET", "/nope")[0] == 404
+
+
+def test_asgi_client_hanging_up_cancels_the_request(client):
+    calls = gateway.bot_manager.backend.calls
+    body = json.dumps({"question": "Who painted the Mona Lisa?", "cache": False}).encode()
+    assert asgi_request("POST", "/api/ask-gpt", body, disconnect=True) == (None, None)
+    time.sleep(0.1)
+    assert not gateway.bot_manager.inflight
+    assert gateway.bot_manager.backend.calls - calls <= 1
+
+
+def test_streamed_answer_is_the_sum_of_its_deltas(client):
+    resp = client.post("/api/ask-gpt", json={"question": "Explain the theory of relativity.", "stream": "jsonl"})
+    assert resp.status_code == 200 and resp.content_type.startswith("application/x-ndjson")
+    events = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    deltas = [e["text"] for e in events if e["event"] == "delta"]
+    assert len(deltas) > 1 and events[-1]["event"] == "done"
+    assert "".join(deltas) == events[-1]["answer"]
+
+    sse = client.post("/api/ask-gpt", json={"question": "Convert 100 Celsius to Fahrenheit."},
+                      headers={"Accept": "text/event-stream"})
+    text = sse.get_data(as_text=True)
+    assert sse.content_type.startswith("text/event-stream")
+    assert text.startswith("event: delta\n") and "event: done\n" in text
+
+
+def test_metrics_render_in_prometheus_text_format():
+    registry = gateway.MetricsRegistry()
+    hist = registry.add(gateway.Histogram("t_seconds", "Latency.", ("route",), buckets=(0.1, 1)))
+    for value in (0.05, 0.5, 5):
+        hist.observe(value, "/x")
+    registry.add(gateway.Counter("t_total", "Requests.", ("path",))).inc('a"b\n')
+    registry.add(gateway.Callback("t_broken", "Raises.", lambda: 1 / 0))
+    lines = registry.render().splitlines()
+    assert 't_seconds_bucket{route="/x",le="0.1"} 1.0' in lines
+    assert 't_seconds_bucket{route="/x",le="1"} 2.0' in lines
+    assert 't_seconds_bucket{route="/x",le="+Inf"} 3.0' in lines
+    assert 't_seconds_count{route="/x"} 3.0' in lines and 't_seconds_sum{route="/x"} 5.55' in lines
+    assert 't_total{path="a\\"b\\n"} 1.0' in lines
+    # A failing callback drops its own samples only
+    assert "# TYPE t_broken gauge" in lines and not any(line.startswith("t_broken ") for line in lines)
+
+
+def test_metrics_endpoint_counts_requests(client):
+    client.get("/healthz")
+    text = client.get("/metrics").get_data(as_text=True)
+    assert 'gateway_requests_total{route="/healthz",outcome="success"}' in text
+    assert 'gateway_request_seconds_count{route="/healthz"}' in text
+
+
+def read_json_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_event_log_queues_hashes_prompts_and_counts_drops(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    log = gateway.EventLog(flush_seconds=3600)
+    fields = log.prompt_fields("secret prompt")
+    assert "prompt" not in fields and fields["prompt_chars"] == 13
+    assert "prompt" in gateway.EventLog(full_prompts=True).prompt_fields("secret prompt")
+    log.emit("errors.log", "upstream_error", **fields)
+    assert not os.path.exists("errors.log")  # nothing is written on the emitting thread
+    log.flush()
+    assert read_json_lines("errors.log")[0]["prompt_sha256"] == fields["prompt_sha256"]
+
+    log = gateway.EventLog(queue_limit=3, flush_seconds=3600)
+    for n in range(5):
+        log.emit("dropped.log", "upstream_error", n=n)
+    log.flush()
+    assert [r["n"] for r in read_json_lines("dropped.log")] == [0, 1, 2]
+    dropped = read_json_lines(gateway.EVENTS_LOG)[-1]
+    assert dropped["event"] == "log_dropped" and dropped["count"] == 2
+    assert log.dropped == 0 and log.dropped_total == 2
+
+
+def test_event_log_rotates_by_size(tmp_path):
+    path = str(tmp_path / "events.log")
+    log = gateway.EventLog(max_bytes=200, backups=2, flush_seconds=3600)
+    for n in range(4):
+        log.emit(path, "tick", pad="x" * 100, n=n)
+        log.flush()
+    assert [r["n"] for r in read_json_lines(path)] == [3]
+    assert [r["n"] for r in read_json_lines(path + ".1")] == [2]
+    assert [r["n"] for r in read_json_lines(path + ".2")] == [1]
+    assert not os.path.exists(path + ".3")
+
+
+def test_response_format_specs_and_json_extraction():
+    parse = gateway.parse_response_format
+    assert parse("json") == {"name": "json_object", "schema": None, "max_repairs": 1}
+    assert parse("news_analysis")["schema"] is gateway.NEWS_ANALYSIS_SCHEMA
+    assert parse({"type": "json_schema", "json_schema": {"schema": {"type": "array"}}, "max_repairs": 9}) == \
+        {"name": "inline", "schema": {"type": "array"}, "max_repairs": 2}
+    for bad in ("nope", 3, {"type": "xml"}, {"schema": []}, {"type": "json_object", "max_repairs": "x"}):
+        with pytest.raises(gateway.ResponseFormatError):
+            parse(bad)
+
+    assert gateway.extract_json('Here:\n```json\n{"a": 1}\n```') == ({"a": 1}, None)
+    assert gateway.extract_json('Sure! {"a": [1, 2]} Hope that helps.') == ({"a": [1, 2]}, None)
+    assert gateway.extract_json("no json at all") == (None, "no JSON found")
+
+
+def test_schema_errors_name_every_problem_by_path():
+    schema = {"type": "object", "required": ["items", "score"], "additionalProperties": False,
+              "properties": {"items": {"type": "array", "minItems": 1, "items": {"type": "string", "minLength": 2}},
+                             "score": {"type": "integer", "minimum": 0, "maximum": 10},
+                             "label": {"enum": ["a", "b"]}}}
+    assert gateway.schema_errors({"items": ["ok"], "score": 3, "label": "a"}, schema) == []
+    assert gateway.schema_errors({"items": ["x", 5], "score": 11, "label": "c", "extra": True}, schema) == [
+        "$.items[0]: must be at least 2 characters",
+        "$.items[1]: expected string, got integer",
+        "$.score: must be <= 10",
+        '$.label: must be one of ["a", "b"]',
+        "$: unexpected property 'extra'",
+    ]
+    assert gateway.schema_errors({"score": True}, schema) == [
+        "$: missing required property 'items'", "$.score: expected integer, got boolean"]
+
+
+def test_structured_answer_is_parsed_and_repaired_in_the_same_chat(client):
+    resp = client.post("/api/ask-gpt", json={"question": "Fed hikes rates, return in json",
+                                             "response_format": "news_analysis"})
+    body = resp.get_json()
+    assert resp.status_code == 200 and body["repairs"] == 0
+    assert body["parsed"]["article_info"]["has_market_impact"] is False
+
+    # The stub never produces this shape: one repair turn is tried, then the caller gets a 422
+    schema = {"type": "object", "required": ["verdict"]}
+    resp = client.post("/api/ask-gpt", json={"question": "Give a verdict", "response_format": {
+        "type": "json_schema", "schema": schema, "max_repairs": 1}})
+    assert resp.status_code == 422 and resp.get_json()["repairs"] == 1
+    assert resp.get_json()["schema_errors"] == ["$: missing required property 'verdict'"]
+
+
+def test_quota_paces_calls_and_keeps_a_reserve_for_interactive():
+    quota = gateway.QuotaLimiter(100, burst=2, path=None)
+    assert quota.acquire(priority="normal").allowed
+    refused = quota.acquire(priority="normal")  # one token left, normal leaves it to interactive
+    assert (refused.allowed, refused.status, refused.reason) == (False, 429, "rate")
+    assert refused.retry_after == 36  # (2 - 1) tokens at 100 per hour
+    ticket = quota.acquire(priority="interactive")
+    assert ticket.allowed and not quota.acquire(priority="interactive").allowed
+
+    quota.settle(ticket, spent=False)  # never went upstream: the call and the token come back
+    assert quota.snapshot()["used"] == 1 and quota.acquire(priority="interactive").allowed
+
+
+def test_quota_window_slides_and_client_shares_apply():
+    quota = gateway.QuotaLimiter(2, window=0.3, burst=2, path=None)
+    assert quota.acquire("a", "interactive").allowed and quota.acquire("b", "interactive").allowed
+    full = quota.acquire("a", "interactive")
+    assert full.reason == "quota" and full.remaining == 0
+    time.sleep(0.35)
+    assert quota.usage() == {}
+
+    def one_call_for_a(usage, used):
+        return usage.get("a", 0) < 1
+
+    assert quota.acquire("a", "interactive", share_check=one_call_for_a).allowed
+    assert quota.acquire("a", "interactive", share_check=one_call_for_a).reason == "client_quota"
+
+
+def test_import_has_no_side_effects(tmp_path):
+    script = (
+        "import importlib.util, os, sys, threading\n"
+        "spec = importlib.util.spec_from_file_location('gateway', sys.argv[1])\n"
+        "module = importlib.util.module_from_spec(spec)\n"
+        "spec.loader.exec_module(module)\n"
+        "print(threading.active_count(), sorted(os.listdir('.')), module.bot_manager.readiness())\n"
+    )
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "my-ai-webserver.py")
+    out = subprocess.run([sys.executable, "-c", script, path], cwd=tmp_path, capture_output=True, text=True,
+                         env=dict(os.environ, GATEWAY_BACKEND="stub"), timeout=60)
+    assert out.returncode == 0, out.stderr
+    assert out.stdout.splitlines()[-1] == "1 [] (False, ['not started'])"
+
+
+def test_readyz_is_ready_after_prewarm(client):
+    gateway.bot_manager.prewarm().result(timeout=10)
+    resp = client.get("/readyz")
+    assert resp.status_code == 200 and resp.get_json() == {"status": "ready", "backend": "stub:stub-1"}
+    assert client.get("/healthz").get_json()["status"] == "ok"
+
+
+def test_chat_sessions_are_recycled_on_context_drift_and_errors():
+    pool = gateway.ChatPool(per_task=1)
+    client = gateway.StubClient(gateway.StubBackend())
+
+    session = pool.lease(client, "question")
+    pool.release(session, gateway.CHAT_MAX_CONTEXT_CHARS, 0, 1.0)
+    assert pool.recycled["context"] == 1 and not pool.sessions["question"]
+
+    # Three turns set the baseline cost, then the chat gets much slower for the same sizes
+    leased = []
+    for seconds in (1.0, 1.0, 1.0, 4.0, 4.0):
+        leased.append(pool.lease(client, "question"))
+        pool.release(leased[-1], 500, 500, seconds)
+    assert len(set(leased)) == 1
+    assert pool.recycled["latency_drift"] == 1 and not pool.sessions["question"]
+
+    session = pool.lease(client, "question")
+    pool.release(session, 100, broken=True)
+    assert pool.recycled["error"] == 1
+    assert pool.lease(client, "question") is not session
+    assert gateway.classify_task("from NEWS title:\nFed") == "news"
+    assert gateway.classify_task("Give me a market summary of the dow") == "summary"
+    assert gateway.resolve_task({"stateless": True}, "x") == gateway.ONESHOT_TASK
+    with pytest.raises(ValueError):
+        gateway.resolve_task({"task": "poetry"}, "x")
+
+
+class FixedRandom(random.Random):
+    """No jitter: uniform() always returns the midpoint."""
+    def uniform(self, a, b):
+        return (a + b) / 2
+
+
+def test_breaker_opens_per_class_and_closes_after_a_good_trial():
+    breaker = gateway.CircuitBreaker({"500": (2, 0.2, 10), "429": (1, 100, 3600)}, rng=FixedRandom())
+    assert breaker.record_failure("406", "406 Invalid response") is False  # not a health signal
+    assert breaker.record_failure("500") is False and breaker.admit() == (0, False)
+    assert breaker.record_failure("500") is True
+    assert breaker.admit() == (1, False) and breaker.open_for()[1] == ["500"]
+
+    time.sleep(0.25)
+    assert breaker.admit() == (0, True)  # half-open: exactly one trial goes through
+    assert breaker.admit() == (gateway.BREAKER_PROBE_WAIT, False)
+    assert breaker.record_failure("500") is True  # failed trial: open again, twice as long
+    assert breaker.snapshot()["breakers"]["500"]["trips"] == 2
+    time.sleep(0.45)
+    assert breaker.admit() == (0, True)
+    breaker.record_success()
+    assert breaker.admit() == (0, False) and breaker.snapshot()["breakers"]["500"]["trips"] == 0
+
+
+def test_breaker_honours_retry_hints_and_restores_state():
+    breaker = gateway.CircuitBreaker({"429": (1, 100, 3600)}, rng=FixedRandom())
+    breaker.record_failure("429", "429 Too Many Requests, retry-after: 900")
+    retry_in, kinds = breaker.open_for()
+    assert kinds == ["429"] and 895 <= retry_in <= 900
+
+    restored = gateway.CircuitBreaker({"429": (1, 100, 3600)})
+    restored.load_state(breaker.dump_state())
+    assert restored.admit()[0] >= 895 and restored.snapshot()["breakers"]["429"]["state"] == "open"
+
+
+def test_templates_render_verbatim_and_report_what_is_missing():
+    prompt = gateway.render_template("news_analysis", {"title": " Fed {hikes} ", "content": "Rates rise."})
+    assert prompt.startswith("from NEWS title:\nFed {hikes}\nfrom NEWS content:\nRates rise.\n\nfor markets:")
+    assert prompt.template == "news_analysis" and "Fed {hikes}" in prompt.turn and len(prompt.turn) < len(prompt)
+    assert gateway.classify_task(prompt) == "news" and gateway.article_section(prompt)[0] == "Fed {hikes}\nRates rise."
+    for name, variables, message in (("nope", {}, "Unknown template"), ("news_analysis", [], "must be an object"),
+                                     ("news_analysis", {"title": "t"}, "Missing template variables: content")):
+        with pytest.raises(gateway.TemplateError, match=message):
+            gateway.render_template(name, variables)
+
+
+def test_template_instructions_go_to_a_chat_only_once(client):
+    pool = gateway.bot_manager.pool
+    on_loop(pool.clear)  # start from fresh chats that haven't seen the instructions
+    primed = pool.primed_turns
+    for n in range(2):
+        resp = client.post("/api/ask-gpt", json={"template": "news_analysis", "cache": False, "variables": {
+            "title": f"Headline {n}", "content": f"Body of article {n}."}})
+        assert resp.status_code == 200 and resp.get_json()["parsed"]["markets"] == []
+    assert pool.primed_turns == primed + 1 and pool.saved_chars > 0
+    resp = client.post("/api/ask-gpt", json={"template": "news_analysis", "variables": {"title": "t"}})
+    assert resp.status_code == 400 and "content" in resp.get_json()["error"]
+
+
+def test_request_trace_breakdown_is_exposed_and_kept(client):
+    resp = client.post("/api/ask-gpt", json={"question": "What is the boiling point of nitrogen?", "cache": False})
+    timings = bench.parse_server_timing(resp.headers["Server-Timing"])
+    assert {"upstream", "queue", "total"} <= set(timings) and timings["total"] >= timings["upstream"]
+
+    entry = client.get(f"/debug/requests/{resp.headers['X-Request-Id']}").get_json()
+    assert entry["route"] == "/api/ask-gpt" and entry["status"] == 200 and entry["outcome"] == "success"
+    assert "upstream" in entry["breakdown_ms"] and entry["queries"]
+    recent = client.get("/debug/requests?route=/api/ask-gpt&limit=1").get_json()["requests"]
+    assert [e["id"] for e in recent] == [entry["id"]]
+    assert client.get("/debug/requests/unknown").status_code == 404
+
+
+def test_trace_keeps_handler_timings_and_caps_spans():
+    trace = gateway.RequestTrace("GET", "/x")
+    now = time.perf_counter()
+    trace.add("cache", now, now + 0.002)
+    trace.add("cache", now, now + 0.003)
+    for _ in range(gateway.TRACE_MAX_SPANS):
+        trace.add("retry_sleep", now, now)
+    assert len(trace.spans) == gateway.TRACE_MAX_SPANS and trace.dropped_spans == 2
+    timing = trace.server_timing("upstream;dur=7.0")
+    assert timing.startswith("upstream;dur=7.0, cache;dur=5.0, retry_sleep;dur=0.0, total;dur=")
+
+
+def test_request_deadline_takes_the_tighter_header_and_cancels_work():
+    def deadline(headers):
+        req = gateway.ApiRequest("POST", "/api/ask-gpt", headers, {}, b"", "http://localhost/")
+        value = gateway.request_deadline(req)
+        return None if value is None else round(value - time.monotonic())
+
+    assert deadline({}) is None and deadline({"X-Request-Timeout": "soon"}) is None
+    assert deadline({"X-Request-Timeout": "30", "X-Request-Deadline": str(time.time() + 10)}) == 10
+
+    async def run(budget):
+        gateway.CURRENT_DEADLINE.set(time.monotonic() + budget)
+        slow = asyncio.ensure_future(asyncio.sleep(5))
+        try:
+            await gateway.within_deadline(slow)
+        except gateway.DeadlineExceeded as e:
+            await asyncio.sleep(0)
+            return str(e), slow.cancelled()
+
+    message, cancelled = asyncio.run(run(0.05))
+    assert message.startswith("Deadline exceeded") and cancelled
+    assert asyncio.run(run(-1))[0] == "Deadline passed before the work started"
+
+
+def test_request_past_its_deadline_is_a_504_and_refunds_quota(client):
+    used = gateway.quota.snapshot()["used"]
+    resp = client.post("/api/ask-gpt", json={"question": "How many bones are in the human body?", "cache": False},
+                       headers={"X-Request-Timeout": "0.05"})
+    assert resp.status_code == 504 and resp.get_json()["error"] == "deadline_exceeded"
+    time.sleep(0.05)
+    assert gateway.quota.snapshot()["used"] == used and not gateway.bot_manager.inflight
+
+
+class NoExplore(random.Random):
+    """The router never swaps in the runner-up."""
+    def random(self):
+        return 1.0
+
+
+def test_router_ranks_by_expected_cost_and_skips_unusable_backends():
+    def upstream(name, latency=None, **routing):
+        u = gateway.Upstream(gateway.create_backend("stub", model=name), gateway.CircuitBreaker(name=name), **routing)
+        u.latency = latency
+        return u
+
+    primary = upstream("primary", 8.0, primary=True)
+    fast, slow = upstream("fast", 2.0, max_concurrency=1), upstream("slow", 5.0, hourly_budget=1)
+    router = gateway.BackendRouter(primary, [slow, fast], rng=NoExplore())
+    assert router.rank() == [fast, slow, primary]
+    fast.observe(ok=False)
+    fast.observe(ok=False)  # error rate 0.36: expected 2 x (1 + 4 x 0.36) = 4.9s
+    assert router.rank() == [fast, slow, primary]
+    fast.observe(ok=False)
+    assert router.rank() == [slow, fast, primary]
+    fast.in_flight = 1  # saturated backends go last, even behind the primary
+    assert router.rank() == [slow, primary, fast]
+
+    slow.calls.append(time.time())  # hourly budget used up
+    fast.breaker.record_failure("503")
+    assert router.rank() == [primary] and router.rank(allow_primary=False) == []
+    assert router.unavailable() is None
+    assert router.unavailable(allow_primary=False).kind == "locked"
+
+
+def test_failed_primary_call_fails_over_to_a_fallback():
+    primary = gateway.create_backend("stub", latency_dist="fixed", latency_mean=0.01, error_rates={"503": 1.0})
+    fallback = gateway.create_backend("stub", latency_dist="fixed", latency_mean=0.01, model="stub-fallback")
+    manager = gateway.GeminiManager(backend=primary, cache=gateway.ResponseCache(path=None))
+    backup = gateway.Upstream(fallback, gateway.CircuitBreaker(name="fallback"))
+    backup.latency = 60.0  # ranked behind the primary until the primary fails
+    manager.router = gateway.BackendRouter(gateway.Upstream(primary, manager.breaker, primary=True), [backup],
+                                           rng=NoExplore())
+    manager.start()
+    try:
+        first = manager.call(manager.query_async("Name a prime.", cache_read=False))
+        # The 503 opened the primary's breaker, so the next call goes straight to the fallback
+        second = manager.call(manager.query_async("Name another prime.", cache_read=False))
+    finally:
+        manager.loop.call_soon_threadsafe(manager.loop.stop)
+    assert isinstance(first, gateway.Answer) and first.backend == "stub:stub-fallback"
+    assert second.backend == "stub:stub-fallback"
+    assert (primary.calls, fallback.calls) == (1, 2)
+
+
+def news_prompt(title, content):
+    return gateway.render_template("news_analysis", {"title": title, "content": content})
+
+
+def test_near_duplicate_index_finds_edited_articles_only(monkeypatch):
+    article = bench.make_news_item(random.Random(11), (1500, 1500))
+    other = bench.make_news_item(random.Random(12), (1500, 1500))
+    edited = article["content"].replace(".", "", 1) + " Reporting by staff."
+    index = gateway.NearDuplicateIndex(threshold=0.8, max_entries=2)
+    assert index.add(news_prompt(article["title"], article["content"]), "key-a", source="req-1")
+    assert not index.add(news_prompt("Short", "Too few words to compare."), "key-short")
+
+    key, source, similarity = index.lookup(news_prompt("Another headline", edited))
+    assert (key, source) == ("key-a", "req-1") and similarity >= 0.8
+    assert index.lookup(news_prompt(other["title"], other["content"])) is None
+    assert index.lookup(news_prompt(article["title"], article["content"]), scope="json") is None
+
+    # The pure-Python signature matches numpy's, so either can read the other's snapshot
+    with_numpy = index.signature({1, 2, 3})
+    monkeypatch.setattr(gateway, "np", None)
+    assert index.signature({1, 2, 3}) == with_numpy
+
+
+def test_near_duplicate_index_evicts_and_survives_dump_load():
+    items = [bench.make_news_item(random.Random(seed), (1200, 1200)) for seed in range(3)]
+    index = gateway.NearDuplicateIndex(max_entries=2)
+    for n, item in enumerate(items):
+        index.add(news_prompt(item["title"], item["content"]), f"key-{n}")
+    assert list(index.entries) == ["key-1", "key-2"] and index.snapshot()["evictions"] == 1
+
+    restored = gateway.NearDuplicateIndex(max_entries=2)
+    restored.load_state(json.loads(json.dumps(index.dump_state())))
+    assert restored.lookup(news_prompt("t", items[2]["content"]))[0] == "key-2"
+    restored.discard("key-2", stale=True)
+    assert restored.lookup(news_prompt("t", items[2]["content"])) is None and restored.snapshot()["stale"] == 1
+    foreign = gateway.NearDuplicateIndex(seed=1)
+    foreign.load_state(index.dump_state())  # another hash family: its signatures mean nothing here
+    assert not foreign.entries
+
+
+def test_near_duplicate_article_reuses_the_earlier_answer(client):
+    item = bench.make_news_item(random.Random(21), (1500, 1500))
+    first = client.post("/api/ask-gpt", json={"template": "news_analysis", "variables": item}).get_json()
+    edited = dict(item, title="Syndicated: " + item["title"], content=item["content"] + " Reporting by staff.")
+    again = client.post("/api/ask-gpt", json={"template": "news_analysis", "variables": edited}).get_json()
+    assert again["cached"] is True and again["parsed"] == first["parsed"]
+    resp = client.post("/api/ask-gpt", json={"template": "news_analysis", "variables": edited,
+                                             "near_duplicates": False, "cache": False})
+    assert not resp.get_json().get("cached")
+
+
+def labelled_articles(rng, count):
+    macro = ["fed", "rates", "inflation", "payrolls", "yields", "treasury", "ecb", "tariffs", "dollar", "gdp"]
+    fluff = ["celebrity", "recipe", "football", "festival", "fashion", "gardening", "movie", "concert", "travel", "pets"]
+    common = ["today", "report", "people", "said", "week", "city", "new", "after", "during", "local"]
+    examples = []
+    for n in range(count):
+        impact = n % 3 == 0
+        words = rng.choices(macro if impact else fluff, k=12) + rng.choices(common, k=30)
+        rng.shuffle(words)
+        examples.append((" ".join(words), impact))
+    return examples
+
+
+@pytest.mark.skipif(gateway.np is None, reason="the triage model needs numpy")
+def test_triage_model_learns_to_skip_articles_without_impact(tmp_path):
+    triage = gateway.TriageModel(path=str(tmp_path / "triage.sqlite3"), target_recall=0.95)
+    triage.open()
+    rng = random.Random(5)
+    triage.observe(labelled_articles(rng, 60), wait=True)
+    assert triage.model is None  # too few examples: keyword scores rank but never skip
+    assert [skip for _, skip in triage.score(["fed rates", "movie night"])] == [False, False]
+
+    triage.observe(labelled_articles(rng, 240), wait=True)
+    assert triage.model is not None and triage.snapshot()["model"] == "naive_bayes"
+    held_out = labelled_articles(random.Random(6), 90)
+    verdicts = triage.score([text for text, _ in held_out])
+    kept = [not skip for _, skip in verdicts]
+    assert all(k for k, (_, impact) in zip(kept, held_out) if impact)
+    assert sum(not k for k, (_, impact) in zip(kept, held_out) if not impact) >= 50
+    assert all(skip for _, skip in triage.score(["fed rates inflation"], min_score=1.0))
+
+
+def test_keyword_score_ranks_macro_news_higher():
+    assert gateway.keyword_score("Fed hikes rates as inflation and yields rise") > \
+        gateway.keyword_score("Local festival draws record crowds") == 0
+
+
+def test_attempt_timeout_follows_observed_latency():
+    tracker = gateway.LatencyTracker(quantile=0.9, safety=2.0, low=1.0, high=60.0, retry_factor=2.0, min_samples=10)
+    assert tracker.timeout("stub", 100) == 60.0  # no samples yet
+    for n in range(10):
+        tracker.observe("stub", 100, 3.0 + n)  # 3..12s
+    assert tracker.quantile("stub", 100) == 12.0 and tracker.timeout("stub", 100) == 24.0
+    assert tracker.timeout("stub", 100, retry=1) == 48.0 and tracker.timeout("stub", 100, retry=2) == 60.0
+    assert tracker.timeout("stub", 5000) == 60.0  # another size bucket learns on its own
+    for _ in range(10):
+        tracker.observe("fast", 100, 0.1)
+    assert tracker.timeout("fast", 100) == 1.0
+
+    restored = gateway.LatencyTracker(quantile=0.9, safety=2.0, low=1.0, high=60.0, min_samples=10)
+    restored.load_state(json.loads(json.dumps(tracker.dump_state())))
+    assert restored.timeout("stub", 100) == 24.0
+
+
+def test_hanging_upstream_is_cut_off_at_the_adaptive_timeout():
+    backend = gateway.create_backend("stub", latency_dist="fixed", latency_mean=0.01, error_rates={"timeout": 1.0})
+    manager = gateway.GeminiManager(backend=backend, cache=gateway.ResponseCache(path=None))
+    manager.latency = gateway.LatencyTracker(low=0.05, high=0.2)
+    manager.start()
+    started = time.monotonic()
+    try:
+        result = manager.call(manager.query_async("Who wrote Hamlet?", cache_read=False))
+    finally:
+        manager.loop.call_soon_threadsafe(manager.loop.stop)
+    assert isinstance(result, gateway.Failure) and result.kind == "timeout"
+    assert time.monotonic() - started < 2
+    # Each timed-out attempt counts as a sample at its limit
+    assert list(manager.latency.samples[("stub", "xs")]) == [0.2] * backend.calls
+
+
+def test_snapshot_restores_component_state_and_skips_broken_parts(tmp_path):
+    path = str(tmp_path / "state.json")
+    breaker, latency = gateway.CircuitBreaker(), gateway.LatencyTracker()
+    breaker.record_failure("503", "503 Service Unavailable")
+    latency.observe("stub", 100, 1.5)
+
+    def broken():
+        raise RuntimeError("not today")
+
+    saved = gateway.StateSnapshot(asyncio.new_event_loop(), path=path)
+    saved.register("breaker", breaker.dump_state, breaker.load_state)
+    saved.register("timeouts", latency.dump_state, latency.load_state, on_loop=True)
+    saved.register("broken", broken, broken)
+    saved.save()
+    assert not os.path.exists(path + ".tmp") and saved.snapshot()["bytes"] == os.path.getsize(path)
+
+    breaker2, latency2 = gateway.CircuitBreaker(), gateway.LatencyTracker()
+    restored = gateway.StateSnapshot(asyncio.new_event_loop(), path=path)
+    restored.register("breaker", breaker2.dump_state, breaker2.load_state)
+    restored.register("timeouts", latency2.dump_state, latency2.load_state, on_loop=True)
+    restored.restore()
+    assert sorted(restored.restored) == ["breaker", "timeouts"]
+    assert breaker2.open_for()[1] == ["503"] and list(latency2.samples[("stub", "xs")]) == [1.5]
+
+
+@pytest.mark.parametrize("content", ["{not json", json.dumps({"version": 99, "saved_at": 0}),
+                                     json.dumps({"version": 1, "saved_at": 0, "breaker": {}})])
+def test_unusable_snapshot_means_a_cold_start(tmp_path, content):
+    path = tmp_path / "state.json"
+    path.write_text(content)
+    loaded = []
+    snapshot = gateway.StateSnapshot(asyncio.new_event_loop(), path=str(path))
+    snapshot.register("breaker", dict, loaded.append)
+    snapshot.restore()  # corrupt, another version, or older than max_age
+    assert loaded == [] and snapshot.restored == {}
+
+
+def test_state_endpoint_reports_the_snapshot(client):
+    state = client.get("/api/state").get_json()
+    assert {"chats", "router", "timeouts", "near_duplicates", "cache_hot_set"} <= set(state["parts"])
+    assert state["path"] == gateway.SNAPSHOT_FILENAME
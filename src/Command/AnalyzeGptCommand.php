@@ -51,48 +51,66 @@ class AnalyzeGptCommand extends Command
             return self::SUCCESS;
         }
 
+        // Rank with the gateway's local triage model (no quota spent), so the hourly budget goes to the
+        // articles most likely to move markets first; the ones it expects no impact from are not sent at all
+        $triage = $this->triage($newsItems, $io);
+        if ($triage) {
+            usort($newsItems, fn($a, $b) => ($triage[$b->getId()]['score'] ?? 1) <=> ($triage[$a->getId()]['score'] ?? 1));
+        }
+
         $io->progressStart($total);
 
         foreach ($newsItems as $newsItem) {
-            $question = <<<TEXT
-from NEWS title: 
-{$newsItem->getTitle()}
-from NEWS content: 
-{$newsItem->getContent()}
-
-for markets: dow, audjpy, audusd, dxy, fed interest rate, dax, cac 40
-give: market sentiment , short summary
-return in json
-for each market in format:
-
-"markets": [
-{
-   "magnitude": "", // classify from 1 min to 10 max
-   "market": "",
-   "sentiment": "Bearish or Bullish or Neutral",
-   "reason": "...",
-   "keywords": [],
-   "categories": []
-}
-],
-"article_info": {
-   "has_market_impact": false or true,
-   "title_headline": "",
-   "news_surprise_index": 0, // classify from 1 min to 10 max
-   "economy_impact": 0, // classify from 1 min to 10 max
-   "macro_keyword_heatmap": [],
-   "summary": ""
-}
-TEXT;
+            $verdict = $triage[$newsItem->getId()] ?? null;
+            if ($verdict && $verdict['skip']) {
+                $newsItem->setAnalyzed(true);
+                $newsItem->setGptAnalysis([
+                    'status' => 'skipped',
+                    'triage_score' => $verdict['score'],
+                    'timestamp' => date('c')
+                ]);
+                $newsItem->setCompleted(false);
+                $this->em->persist($newsItem);
+                $this->em->flush();
+                $io->progressAdvance();
+                continue;
+            }
+
             try {
                 // 1. Send Request
                 // Pass 'false' to toArray so 500 errors don't throw immediately, letting us handle the message
-                $response = $this->http->request('POST', 'http://localhost:5000/api/ask-gpt', [
-                    'json' => ['question' => $question],
-                ]);
-
-                $statusCode = $response->getStatusCode();
-                $data = $response->toArray(false);
+                do {
+                    $response = $this->http->request('POST', 'http://localhost:5000/api/ask-gpt', [
+                        // The gateway owns the instruction block (sent once per chat) and validates the
+                        // answer against the news_analysis schema, repairing it if needed
+                        'json' => [
+                            'template' => 'news_analysis',
+                            'variables' => ['title' => $newsItem->getTitle(), 'content' => $newsItem->getContent()],
+                            'response_format' => 'news_analysis',
+                        ],
+                        // The gateway drops the request (and refunds its quota) once we would have stopped waiting
+                        'headers' => ['X-Client-Id' => 'analyzer', 'X-Request-Timeout' => 295],
+                        'timeout' => 300,
+                    ]);
+
+                    $statusCode = $response->getStatusCode();
+                    $data = $response->toArray(false);
+
+                    // The gateway paces calls across the hour and backs off after upstream errors:
+                    // wait when the next slot (or the breaker's trial) is close
+                    $retryAfter = (int)($data['retry_after'] ?? 0);
+                    $paced = in_array($statusCode, [429, 503], true) && $retryAfter > 0 && $retryAfter <= 120;
+                    if ($paced) {
+                        sleep($retryAfter);
+                    }
+                } while ($paced);
+
+                // Budget used up or circuit open for a while: leave this and the remaining items for the next run
+                if ($statusCode === 429 || $statusCode === 503) {
+                    $io->warning('Gateway refused (' . ($data['error'] ?? $statusCode) . '), retry in '
+                        . ($data['retry_after'] ?? '?') . 's. Leaving the remaining items for the next run.');
+                    break;
+                }
 
                 // 2. Handle API Errors (HTTP 500 or JSON status 'error')
                 if ($statusCode !== 200 || ($data['status'] ?? 'success') === 'error') {
@@ -106,19 +124,22 @@ TEXT;
                     throw new \RuntimeException("GPT returned error: $answer");
                 }
 
-                // 4. Extract JSON
-                $start = strpos($answer, '{');
-                $end = strrpos($answer, '}');
-                if ($start === false || $end === false || $end <= $start) {
-                    // Throwing here sends us to the catch block to mark as failed
-                    throw new \RuntimeException("No JSON found in response");
-                }
-
-                $jsonString = substr($answer, $start, $end - $start + 1);
-                $json = json_decode($jsonString, true);
-
-                if (json_last_error() !== JSON_ERROR_NONE) {
-                    throw new \RuntimeException('Malformed JSON received');
+                // 4. Extract JSON (already parsed by the gateway when response_format was honoured)
+                $json = $data['parsed'] ?? null;
+                if (!is_array($json)) {
+                    $start = strpos($answer, '{');
+                    $end = strrpos($answer, '}');
+                    if ($start === false || $end === false || $end <= $start) {
+                        // Throwing here sends us to the catch block to mark as failed
+                        throw new \RuntimeException("No JSON found in response");
+                    }
+
+                    $jsonString = substr($answer, $start, $end - $start + 1);
+                    $json = json_decode($jsonString, true);
+
+                    if (json_last_error() !== JSON_ERROR_NONE) {
+                        throw new \RuntimeException('Malformed JSON received');
+                    }
                 }
 
                 // --- SUCCESS PATH ---
@@ -163,6 +184,33 @@ TEXT;
         return self::SUCCESS;
     }
 
+    /**
+     * Triage verdicts by NewsItem id ({score, skip, rank}); empty when the gateway can't triage.
+     */
+    private function triage(array $newsItems, SymfonyStyle $io): array
+    {
+        try {
+            $response = $this->http->request('POST', 'http://localhost:5000/api/triage', [
+                'json' => ['articles' => array_map(fn(NewsItem $item) => [
+                    'id' => $item->getId(),
+                    'title' => $item->getTitle(),
+                    'content' => $item->getContent(),
+                ], $newsItems)],
+                'timeout' => 30,
+            ]);
+            $verdicts = [];
+            foreach ($response->toArray()['results'] ?? [] as $result) {
+                $verdicts[$result['id']] = $result;
+            }
+            $skipped = count(array_filter($verdicts, fn($v) => $v['skip']));
+            $io->note("Triage: $skipped of " . count($newsItems) . ' items not expected to have market impact.');
+            return $verdicts;
+        } catch (\Throwable $e) {
+            $io->warning('Triage unavailable, analyzing everything in order: ' . $e->getMessage());
+            return [];
+        }
+    }
+
     private function completeNewsItem(NewsItem $newsItem, SymfonyStyle $io): void
     {
         $gpt = $newsItem->getGptAnalysis();
@@ -128,56 +128,61 @@ class BecomeRichCommand extends Command
         $io->progressStart(count($newItems));
 
         foreach ($newItems as $newsItem) {
-            $question = <<<TEXT
-from NEWS title: 
-{$newsItem->getTitle()}
-from NEWS content: 
-{$newsItem->getContent()}
-
-for markets: dow, audjpy, audusd, dxy, fed interest rate, dax, cac 40
-give: market sentiment , short summary
-return in json
-for each market in format:
-
-"markets": [
-{
-   "magnitude": "", // classify from 1 min to 10 max
-   "market": "",
-   "sentiment": "Bearish or Bullish or Neutral",
-   "reason": "...",
-   "keywords": [],
-   "categories": []
-}
-],
-"article_info": {
-   "has_market_impact": false or true,
-   "title_headline": "",
-   "news_surprise_index": 0, // classify from 1 min to 10 max
-   "economy_impact": 0, // classify from 1 min to 10 max
-   "macro_keyword_heatmap": [],
-   "summary": ""
-}
-TEXT;
             try {
-                $data = $this->requestWithRetries(function() use ($question) {
-                    $response = $this->httpClient->request('POST', 'http://localhost:5000/api/ask-gpt', [
-                        'json' => ['question' => $question],
-                        // optionally, set timeout: 'timeout' => 40
-                    ]);
-                    return $response->toArray();
+                [$statusCode, $data] = $this->requestWithRetries(function() use ($newsItem) {
+                    do {
+                        $response = $this->httpClient->request('POST', 'http://localhost:5000/api/ask-gpt', [
+                            'json' => [
+                                'template' => 'news_analysis',
+                                'variables' => ['title' => $newsItem->getTitle(), 'content' => $newsItem->getContent()],
+                                'response_format' => 'news_analysis',
+                            ],
+                            'headers' => ['X-Client-Id' => 'become-rich', 'X-Request-Timeout' => 295],
+                            'timeout' => 300,
+                        ]);
+                        // toArray(false): 429/503 carry retry_after in the body instead of throwing
+                        $statusCode = $response->getStatusCode();
+                        $data = $response->toArray(false);
+
+                        // The gateway paces calls across the hour and backs off after upstream errors:
+                        // wait when the next slot (or the breaker's trial) is close
+                        $retryAfter = (int)($data['retry_after'] ?? $response->getHeaders(false)['retry-after'][0] ?? 0);
+                        $paced = in_array($statusCode, [429, 503], true) && $retryAfter > 0 && $retryAfter <= 120;
+                        if ($paced) {
+                            sleep($retryAfter);
+                        }
+                    } while ($paced);
+                    return [$statusCode, $data];
                 }, 3, 3);
-                $answer = $data['answer'] ?? '';
 
-                $start = strpos($answer, '{');
-                $end = strrpos($answer, '}');
-                if ($start === false || $end === false || $end <= $start) {
-                    throw new \RuntimeException("Could not extract JSON from answer for link: " . $newsItem->getLink());
+                // Budget used up or circuit open for a while: leave this and the remaining items for app:analyze-gpt
+                if ($statusCode === 429 || $statusCode === 503) {
+                    $io->warning('Gateway refused (' . ($data['error'] ?? $statusCode) . '), retry in '
+                        . ($data['retry_after'] ?? '?') . 's. Leaving the remaining items for the next run.');
+                    break;
+                }
+                if ($statusCode !== 200) {
+                    throw new \RuntimeException(($data['message'] ?? $data['error'] ?? "API HTTP $statusCode") . ' for link: ' . $newsItem->getLink());
+                }
+
+                $answer = $data['answer'] ?? '';
+                if (($data['status'] ?? 'success') === 'error') {
+                    throw new \RuntimeException(($data['message'] ?? 'Invalid answer') . ' for link: ' . $newsItem->getLink());
                 }
-                $jsonString = substr($answer, $start, $end - $start + 1);
-                $json = json_decode($jsonString, true);
 
-                if (json_last_error() !== JSON_ERROR_NONE) {
-                    throw new \RuntimeException('Malformed JSON for link: ' . $newsItem->getLink());
+                $json = $data['parsed'] ?? null;
+                if (!is_array($json)) {
+                    $start = strpos($answer, '{');
+                    $end = strrpos($answer, '}');
+                    if ($start === false || $end === false || $end <= $start) {
+                        throw new \RuntimeException("Could not extract JSON from answer for link: " . $newsItem->getLink());
+                    }
+                    $jsonString = substr($answer, $start, $end - $start + 1);
+                    $json = json_decode($jsonString, true);
+
+                    if (json_last_error() !== JSON_ERROR_NONE) {
+                        throw new \RuntimeException('Malformed JSON for link: ' . $newsItem->getLink());
+                    }
                 }
 
                 $newsItem->setGptAnalysis($json);
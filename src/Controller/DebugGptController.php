@@ -109,44 +109,16 @@ class DebugGptController extends AbstractController
             ], 500);
         }
 
-        // 2. Prepare the Question
-        $question = <<<TEXT
-from NEWS title: 
-{$newsItem->getTitle()}
-from NEWS content: 
-{$newsItem->getContent()}
-
-for markets: dow, audjpy, audusd, dxy, fed interest rate, dax, cac 40
-give: market sentiment , short summary
-return in json
-for each market in format:
-
-"markets": [
-{
-   "magnitude": "", // classify from 1 min to 10 max
-   "market": "",
-   "sentiment": "Bearish or Bullish or Neutral",
-   "reason": "...",
-   "keywords": [],
-   "categories": []
-}
-],
-"article_info": {
-   "has_market_impact": false or true,
-   "title_headline": "",
-   "news_surprise_index": 0, // classify from 1 min to 10 max
-   "economy_impact": 0, // classify from 1 min to 10 max
-   "macro_keyword_heatmap": [],
-   "summary": ""
-}
-TEXT;
+        // 2. Prepare the Question (the gateway's news_analysis template holds the instructions)
+        $variables = ['title' => $newsItem->getTitle(), 'content' => $newsItem->getContent()];
 
         // 3. Call External API
         $logs[] = 'Attempting to call http://localhost:5000/api/ask-gpt...';
 
             // Note: Use a short timeout for debug endpoint so it fails fast if server is down
             $response = $this->http->request('POST', 'http://localhost:5000/api/ask-gpt', [
-                'json' => ['prompt' => $question],
+                'json' => ['template' => 'news_analysis', 'variables' => $variables, 'response_format' => null],
+                'headers' => ['X-Client-Id' => 'debug', 'X-Request-Timeout' => 115],
                 'timeout' => 120,
             ]);
 
@@ -155,7 +127,7 @@ TEXT;
 
             if ($statusCode !== 200) {
 
-                dd($question);
+                dd($variables);
                 // [FIX 2] readable error reporting
                 $msg = $data['message'] ?? $data['error'] ?? 'Error';
                 return $this->json([
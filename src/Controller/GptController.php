@@ -53,6 +53,7 @@ final class GptController extends AbstractController
         try {
             $response = $this->http->request('POST', 'http://localhost:5000/api/ask-gpt', [
                 'json' => $payload,
+                'headers' => ['X-Client-Id' => 'dashboard'],
             ]);
 
             $data = $response->toArray();
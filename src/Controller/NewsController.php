@@ -401,7 +401,8 @@ TEXT;
         for ($attempt = 1; $attempt <= $maxRetries; $attempt++) {
             try {
                 $response = $http->request('POST', 'http://localhost:5000/api/ask-gpt', [
-                    'json' => ['question' => $question]
+                    'json' => ['question' => $question],
+                    'headers' => ['X-Client-Id' => 'dashboard'],
                 ]);
 
                 if ($response->getStatusCode() !== 200) {